@@ -2,32 +2,40 @@
 FastAPI приложение для обработки файлов через Perplexity API.
 """
 
+import asyncio
 import uuid
-import re
 import json
 from pathlib import Path
+from typing import Optional
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
 
 from wpd.init_core import init_core
-from wpd.merge_with_docx import generate_docx_from_template
-from wpd.fill_tables import fill_one_table_from_perplexity, _to_zero_based_table_index
-from wpd.fill_result_table import fill_table_row_major
+from wpd.executors import build_document, run_blocking, shutdown_render_pool, start_loop_lag_monitor, start_render_pool
+from wpd.fill_tables import TABLE_FILL_CONCURRENCY, TABLE_FILL_MODE, request_tables_values, _to_zero_based_table_index
 from wpd.tables_config import TABLE_SPECS, TABLE_INDEX_OFFSET
 from wpd.table_prompts import TABLE_PROMPTS
-from wpd.request_api import read_file_content, _load_chat_messages, _save_chat_messages
+from wpd.request_api import materials_message, _load_chat_messages, _save_chat_messages
+from wpd.compiled_template import COMPILED_TEMPLATES_AVAILABLE, get_compiled_template
+from wpd.template_artifact import get_template_artifact
+from wpd import token_budget
+from wpd.job_queue import DONE, FAILED, QUEUED, JobFailed, QueueFull, get_job_queue, set_stage, subscribe
+from wpd.uploads import UploadSizeLimit, UploadTooLarge, check_docx, save_upload
 from dotenv import load_dotenv
-from docx import Document
 
 load_dotenv()
 app = FastAPI(title="ГУАП - Формирование учебной программы")
+# Размер загрузки ограничивается по мере приёма тела, до разбора формы (UPLOAD_MAX_MB)
+app.add_middleware(UploadSizeLimit, paths=("/upload",))
 
 # Папка для временных файлов и результатов
 UPLOAD_DIR = Path("files/uploads")
 RESULT_DIR = Path("files/results")
 VARIABLES_DIR = Path("files/variables")  # Папка для сохранения JSON с переменными
 TEMPLATE_PATH = Path("files/Шаблон.docx")
+# Как часто отправлять пинг в поток событий задания, чтобы прокси не закрывал соединение (секунды)
+SSE_KEEPALIVE_SECONDS = 15
 
 # Создаем папки если их нет
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
@@ -723,6 +731,85 @@ async def read_root():
             });
             
             // Отправка файла
+            const JOB_STAGES = {
+                variables: 'Заполнение переменных через ИИ',
+                tables: 'Заполнение таблиц',
+                render: 'Генерация документа'
+            };
+            
+            function formatWait(seconds) {
+                return seconds < 60 ? `~${Math.max(seconds, 1)} с` : `~${Math.ceil(seconds / 60)} мин`;
+            }
+            
+            function describeJob(job) {
+                if (job.state === 'queued') {
+                    const parts = [];
+                    if (job.queue_position) parts.push(`перед вами заданий: ${job.queue_position}`);
+                    if (job.estimated_wait_seconds) parts.push(`ожидание ${formatWait(job.estimated_wait_seconds)}`);
+                    return parts.length ? `В очереди (${parts.join(', ')})` : 'В очереди';
+                }
+                const stage = JOB_STAGES[job.stage] || 'Обработка файла';
+                return job.detail ? `${stage}: ${job.detail}` : `${stage}...`;
+            }
+            
+            async function waitForJob(job) {
+                while (job.state !== 'done') {
+                    if (job.state === 'failed') {
+                        throw new Error(job.error || 'Ошибка при обработке файла');
+                    }
+                    status.innerHTML = '<div class="spinner"></div><br>' + describeJob(job);
+                    await new Promise(resolve => setTimeout(resolve, 2000));
+                    const response = await fetch(job.status_url);
+                    if (!response.ok) {
+                        const error = await response.json();
+                        throw new Error(error.detail || 'Не удалось получить состояние задания');
+                    }
+                    job = await response.json();
+                }
+                return job;
+            }
+            
+            // Ход задания через поток событий сервера; если он недоступен — опрос состояния
+            function watchJob(job) {
+                if (!window.EventSource) {
+                    return waitForJob(job);
+                }
+                return new Promise((resolve, reject) => {
+                    const source = new EventSource(`${job.status_url}/events`);
+                    let finished = false;
+                    const finish = (callback, value) => {
+                        finished = true;
+                        source.close();
+                        callback(value);
+                    };
+                    const show = () => {
+                        status.innerHTML = '<div class="spinner"></div><br>' + describeJob(job);
+                    };
+                    source.addEventListener('status', (e) => {
+                        job = JSON.parse(e.data);
+                        if (job.state === 'done') {
+                            finish(resolve, job);
+                        } else if (job.state === 'failed') {
+                            finish(reject, new Error(job.error || 'Ошибка при обработке файла'));
+                        } else {
+                            show();
+                        }
+                    });
+                    source.addEventListener('stage', (e) => {
+                        const stage = JSON.parse(e.data);
+                        job.stage = stage.stage;
+                        job.detail = stage.detail;
+                        show();
+                    });
+                    source.onerror = () => {
+                        if (finished) return;
+                        finished = true;
+                        source.close();
+                        waitForJob(job).then(resolve, reject);
+                    };
+                });
+            }
+            
             async function submitFile() {
                 const file = fileInput.files[0];
                 if (!file) {
@@ -780,12 +867,13 @@ async def read_root():
                         throw new Error(error.detail || 'Ошибка при обработке файла');
                     }
                     
-                    const result = await response.json();
+                    // Сервер ставит задание в очередь и сразу отвечает: дальше следим за его ходом
+                    const result = await watchJob(await response.json());
                     
                     status.className = 'status success show';
                     status.textContent = 'Файл успешно обработан!';
                     
-                    downloadBtn.href = `/download/${result.file_id}`;
+                    downloadBtn.href = result.result_url;
                     downloadBtn.style.display = 'block';
                     
                 } catch (error) {
@@ -809,7 +897,7 @@ async def upload_file(
     tables: str = Form(None)
 ):
     """
-    Загружает файл от пользователя, JSON с переменными и таблицами, обрабатывает через ядро.
+    Загружает файл от пользователя, JSON с переменными и таблицами и ставит задание обработки в очередь.
     
     Args:
         file: загруженный файл учебника
@@ -817,7 +905,7 @@ async def upload_file(
         tables: JSON строка с таблицами в формате {"tables": [...], "count": N} (опционально)
     
     Returns:
-        dict с file_id для скачивания результата
+        состояние задания (job_id, status_url для опроса /jobs/{job_id}) и file_id для скачивания результата
     """
     # Проверяем расширение файла
     if not file.filename.endswith('.docx'):
@@ -826,37 +914,144 @@ async def upload_file(
     # Генерируем уникальный ID для сессии
     file_id = str(uuid.uuid4())
     
-    # Сохраняем загруженный файл
+    # Сохраняем загруженный файл: частями, с проверкой сигнатуры и размера по ходу копирования.
+    # sha256 содержимого считается тут же — для ключа повторной загрузки
     uploaded_file_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
-    with open(uploaded_file_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    try:
+        digest = await save_upload(file, uploaded_file_path)
+        await run_blocking(check_docx, uploaded_file_path)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        uploaded_file_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Парсим и сохраняем JSON с переменными
+    variables_file_path = VARIABLES_DIR / f"{file_id}_variables.json"
     try:
         variables_data = json.loads(variables)
-        variables_file_path = VARIABLES_DIR / f"{file_id}_variables.json"
-        with open(variables_file_path, 'w', encoding='utf-8') as f:
-            json.dump(variables_data, f, ensure_ascii=False, indent=2)
+        await run_blocking(_write_json, variables_file_path, variables_data)
         print(f"Сохранен JSON с переменными: {variables_file_path}")
     except json.JSONDecodeError as e:
+        uploaded_file_path.unlink(missing_ok=True)
         raise HTTPException(status_code=400, detail=f"Ошибка парсинга JSON с переменными: {str(e)}")
     except Exception as e:
+        uploaded_file_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"Ошибка сохранения переменных: {str(e)}")
     
     # Парсим и сохраняем JSON с таблицами (если передан)
+    tables_file_path = None
     if tables:
         try:
             tables_data = json.loads(tables)
             tables_file_path = VARIABLES_DIR / f"{file_id}_tables.json"
-            with open(tables_file_path, 'w', encoding='utf-8') as f:
-                json.dump(tables_data, f, ensure_ascii=False, indent=2)
+            await run_blocking(_write_json, tables_file_path, tables_data)
             print(f"Сохранен JSON с таблицами: {tables_file_path}")
         except json.JSONDecodeError as e:
+            _remove_files((uploaded_file_path, variables_file_path))
             raise HTTPException(status_code=400, detail=f"Ошибка парсинга JSON с таблицами: {str(e)}")
         except Exception as e:
+            _remove_files((uploaded_file_path, variables_file_path, tables_file_path))
             raise HTTPException(status_code=500, detail=f"Ошибка сохранения таблиц: {str(e)}")
     
+    # Обработка идёт в очереди заданий: запрос сразу возвращает id задания,
+    # а повтор той же загрузки (например, после обрыва соединения) получает уже запущенное задание
+    digest.update(b"\0" + variables.encode("utf-8") + b"\0" + (tables or "").encode("utf-8"))
+    dedupe_key = digest.hexdigest()
+    try:
+        status = await run_blocking(
+            _enqueue_upload, file_id, file.filename, uploaded_file_path, variables_file_path, tables_file_path, dedupe_key
+        )
+    except QueueFull as e:
+        # Очередь заполнена: клиенту — 429 и время, через которое имеет смысл повторить
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return JSONResponse(status_code=202, content=status)
+
+
+def _write_json(path: Path, data) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        # Без отступов: файл читает только обработчик задания
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def _read_json(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _remove_files(paths) -> None:
+    for path in paths:
+        if path is not None and path.exists():
+            path.unlink()
+
+
+def _enqueue_upload(
+    file_id: str,
+    filename: str,
+    uploaded_file_path: Path,
+    variables_file_path: Path,
+    tables_file_path: Optional[Path],
+    dedupe_key: str,
+) -> dict:
+    """
+    Ставит задание обработки загрузки в очередь и возвращает его состояние для клиента.
+    """
+    saved_files = (uploaded_file_path, variables_file_path, tables_file_path)
+    try:
+        job = get_job_queue().submit(
+            "upload",
+            {
+                "file_id": file_id,
+                "uploaded_file_path": str(uploaded_file_path),
+                "variables_path": str(variables_file_path),
+                "tables_path": str(tables_file_path) if tables_file_path else None,
+            },
+            dedupe_key=dedupe_key,
+        )
+    except QueueFull:
+        _remove_files(saved_files)
+        raise
+    if job["payload"]["file_id"] != file_id:
+        # Задание с этой загрузкой уже есть — сохранённые сейчас файлы не нужны
+        _remove_files(saved_files)
+    else:
+        print(f"Задание {job['id']} поставлено в очередь (файл {filename})")
+    return _job_status(job)
+
+
+async def _upload_job(job_id: str, payload: dict) -> dict:
+    """
+    Обработчик задания "upload" (выполняется воркером очереди): читает сохранённые при загрузке файлы
+    и запускает обработку. Ошибки обработки передаются в задание текстом для пользователя.
+    """
+    variables_data = await run_blocking(_read_json, payload["variables_path"])
+    tables_data = None
+    if payload.get("tables_path"):
+        tables_data = await run_blocking(_read_json, payload["tables_path"])
+    try:
+        return await _process_upload(
+            payload["file_id"], Path(payload["uploaded_file_path"]), variables_data, tables_data
+        )
+    except HTTPException as e:
+        raise JobFailed(e.detail)
+
+
+async def _process_upload(
+    file_id: str,
+    uploaded_file_path: Path,
+    variables_data: dict,
+    tables_data: Optional[dict],
+) -> dict:
+    """
+    Обрабатывает загрузку через ядро: переменные (в том числе через ИИ), рендер шаблона, таблицы.
+    Этапы записываются в задание (см. wpd/job_queue.py).
+    
+    Returns:
+        dict с file_id для скачивания результата и токенами задания
+    """
+    # Учёт токенов всех запросов к модели в рамках этой загрузки
+    token_usage = token_budget.start_job()
+    
     try:
         # Путь к шаблону (фиксированный)
         template_path = str(TEMPLATE_PATH)
@@ -903,6 +1098,7 @@ async def upload_file(
         
         if auto_generate_variables:
             print(f"Обрабатываем {len(auto_generate_variables)} переменных через ИИ...")
+            await set_stage("variables", f"переменных через ИИ: {len(auto_generate_variables)}")
             prompt = (
             "Привет, ты профессиональный эксперт-методист с 15-летним стажем работы в сфере. "
             "Я прикрепляю для тебя 2 файла: шаблон Рабочей программы дисциплины от ВУЗа, а также учебные материалы. "
@@ -924,7 +1120,7 @@ async def upload_file(
             
             # Вызываем API для получения значений переменных
             from wpd.request_api import call_api_in_one
-            answer, thread_id = call_api_in_one(
+            answer, thread_id = await call_api_in_one(
                 file1_path=str(template_path),  # Используем оригинальный шаблон
                 file2_path=str(uploaded_file_path),  # Загруженный учебник от пользователя
                 prompt=prompt,
@@ -950,18 +1146,12 @@ async def upload_file(
             
             print(f"Переменные с автогенерацией заполнены: {updated_count} из {len(ai_variables)} полученных от ИИ")
         
-        # Шаг 4: Генерируем документ со всеми переменными (включая пустые для условных блоков)
-        print(f"Генерируем документ с {len(all_variables_dict)} переменными...")
-        generate_docx_from_template(
-            {},  # Пустой словарь, так как все переменные уже в all_variables_dict
-            template_path, 
-            str(result_path),
-            all_variables=all_variables_dict  # Передаем все переменные для поддержки условных блоков
-        )
-        print(f"Создан файл с переменными: {result_path}")
+        # Все таблицы записываются в документ одним проходом при рендере:
+        # из JSON — сразу, через ИИ — после параллельного запроса
+        fills = []
         
         # Шаг 3: Обработка таблиц из JSON
-        if tables:
+        if tables_data is not None:
             tables_list = tables_data.get('tables', [])
             
             # Если thread_id еще не создан (не было переменных с автогенерацией), создаем его
@@ -969,23 +1159,25 @@ async def upload_file(
                 import uuid as _uuid
                 thread_id = str(_uuid.uuid4())
                 
-                # Загружаем файлы в историю чата для контекста
-                messages = _load_chat_messages(thread_id)
+                # Загружаем файлы в историю чата для контекста: большой учебник — фрагментами
+                # по запросам таблиц, полный текст остаётся в чате {thread_id}:source
+                messages = await run_blocking(_load_chat_messages, thread_id)
                 if not messages:
-                    file1_content = read_file_content(str(template_path))
-                    file2_content = read_file_content(str(uploaded_file_path))
+                    table_prompts = [
+                        TABLE_PROMPTS[s.prompt_idx]
+                        for s in TABLE_SPECS
+                        if any(t.get('table_index') == s.table_index and t.get('should_fill_with_ai') for t in tables_list)
+                    ] or TABLE_PROMPTS
+                    materials = await run_blocking(
+                        materials_message, thread_id, str(template_path), str(uploaded_file_path), table_prompts
+                    )
                     messages = [
                         {"role": "system", "content": "Вы — полезный ассистент, который анализирует файлы и отвечает на вопросы."},
-                        {
-                            "role": "user",
-                            "content": (
-                                f"Файл 1 ({Path(template_path).name}):\n{file1_content}\n\n"
-                                f"Файл 2 ({Path(uploaded_file_path).name}):\n{file2_content}"
-                            ),
-                        }
+                        {"role": "user", "content": materials},
                     ]
-                    _save_chat_messages(thread_id, messages)
+                    await run_blocking(_save_chat_messages, thread_id, messages)
             
+            ai_specs = []
             for table in tables_list:
                 table_index = table.get('table_index')
                 should_fill_with_ai = table.get('should_fill_with_ai', False)
@@ -1001,6 +1193,13 @@ async def upload_file(
                     print(f"Предупреждение: Не найдена конфигурация для таблицы с table_index={table_index}")
                     continue
                 
+                # Преобразуем table_index в индекс для python-docx
+                doc_table_index = _to_zero_based_table_index(
+                    spec.table_index,
+                    index_base=1,
+                    table_index_offset=TABLE_INDEX_OFFSET
+                )
+                
                 if not should_fill_with_ai:
                     # Заполняем таблицу из JSON данных
                     print(f"Заполняем таблицу {table_index} из JSON данных...")
@@ -1016,43 +1215,51 @@ async def upload_file(
                             flat_values.extend(row_cells)
                     print(f"Извлечено {len(flat_values)} значений из JSON данных (строк: {len(table_data)}, start_row: {spec.start_row}, start_col: {spec.start_col})")
                     
-                    # Преобразуем table_index в индекс для python-docx
-                    doc_table_index = _to_zero_based_table_index(
-                        spec.table_index,
-                        index_base=1,
-                        table_index_offset=TABLE_INDEX_OFFSET
-                    )
-                    
-                    fill_table_row_major(
-                        result_docx_path=str(result_path),
-                        values=flat_values,
-                        table_index=doc_table_index,
-                        cols_per_row=spec.cols_per_row,
-                        start_row=spec.start_row,
-                        start_col=spec.start_col,
-                    )
-                    print(f"Таблица {table_index} заполнена из JSON")
+                    fills.append({
+                        "values": flat_values,
+                        "table_index": doc_table_index,
+                        "cols_per_row": spec.cols_per_row,
+                        "start_row": spec.start_row,
+                        "start_col": spec.start_col,
+                    })
                 else:
-                    # Заполняем таблицу через ИИ
-                    print(f"Заполняем таблицу {table_index} через ИИ...")
-                    prompt_idx = spec.prompt_idx
-                    prompt = TABLE_PROMPTS[prompt_idx]
-                    
-                    fill_one_table_from_perplexity(
-                        result_docx_path=str(result_path),
-                        table_index=spec.table_index,
-                        cols_per_row=spec.cols_per_row,
-                        start_row=spec.start_row,
-                        start_col=spec.start_col,
-            prompt=prompt,
-            model="sonar",
-                        thread_id=thread_id,
-                        index_base=1,
-                        table_index_offset=TABLE_INDEX_OFFSET,
-        )
-                    print(f"Таблица {table_index} заполнена через ИИ")
+                    ai_specs.append((spec, doc_table_index))
+            
+            if ai_specs:
+                # Заполняем таблицы через ИИ: параллельные запросы от одного снимка чата
+                # или один общий запрос (TABLE_FILL_MODE=single_call)
+                print(f"Заполняем {len(ai_specs)} таблиц через ИИ...")
+                await set_stage("tables", f"таблиц через ИИ: {len(ai_specs)}")
+                ai_values = await request_tables_values(
+                    table_indices=[spec.table_index for spec, _ in ai_specs],
+                    prompts=[TABLE_PROMPTS[spec.prompt_idx] for spec, _ in ai_specs],
+                    depends_on_list=[spec.depends_on for spec, _ in ai_specs],
+                    model="sonar",
+                    thread_id=thread_id,
+                    max_concurrency=TABLE_FILL_CONCURRENCY,
+                    mode=TABLE_FILL_MODE,
+                )
+                for (spec, doc_table_index), values in zip(ai_specs, ai_values):
+                    fills.append({
+                        "values": values,
+                        "table_index": doc_table_index,
+                        "cols_per_row": spec.cols_per_row,
+                        "start_row": spec.start_row,
+                        "start_col": spec.start_col,
+                    })
         
-        return {"file_id": file_id, "message": "Файл успешно обработан"}
+        # Шаг 4: Генерируем документ со всеми переменными (включая пустые для условных блоков)
+        # и заполняем таблицы. Рендер, запись таблиц и сохранение — синхронная работа с CPU,
+        # поэтому она идёт в пуле процессов с уже скомпилированным шаблоном (см. wpd/executors.py)
+        print(f"Генерируем документ с {len(all_variables_dict)} переменными...")
+        await set_stage("render", f"переменных: {len(all_variables_dict)}, таблиц: {len(fills)}")
+        await build_document(template_path, all_variables_dict, fills, str(result_path))
+        if fills:
+            print(f"Заполнено таблиц: {len(fills)}")
+        print(f"Создан файл: {result_path}")
+        
+        print(f"Токены за задание: {token_usage.as_dict()}")
+        return {"file_id": file_id, "message": "Файл успешно обработан", "tokens": token_usage.as_dict()}
         
     except ValueError as e:
         # Ошибки валидации (например, отсутствие API ключа)
@@ -1098,6 +1305,98 @@ async def upload_file(
         raise HTTPException(status_code=500, detail=f"Ошибка при обработке: {error_msg}")
 
 
+def _job_status(job: dict) -> dict:
+    """
+    Состояние задания для ответа клиенту.
+    """
+    status = {
+        "job_id": job["id"],
+        "state": job["state"],
+        "stage": job["stage"],
+        "detail": job["detail"],
+        "status_url": f"/jobs/{job['id']}",
+        "file_id": job["payload"].get("file_id"),
+    }
+    if job["state"] == QUEUED:
+        estimate = get_job_queue().queue_estimate(job["id"])
+        if estimate is not None:
+            status["queue_position"], wait = estimate
+            status["estimated_wait_seconds"] = round(wait)
+    if job["state"] == DONE:
+        result = job["result"] or {}
+        status["result_url"] = f"/download/{result['file_id']}" if result.get("file_id") else None
+        status["tokens"] = result.get("tokens")
+    if job["state"] == FAILED:
+        status["error"] = job["error"]
+    return status
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Состояние задания обработки: queued / running / done / failed, текущий этап и ссылка на результат.
+    
+    Args:
+        job_id: ID задания из ответа /upload
+    """
+    status = await run_blocking(_load_job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return status
+
+
+def _load_job_status(job_id: str) -> Optional[dict]:
+    job = get_job_queue().get(job_id)
+    return _job_status(job) if job is not None else None
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, tokens: bool = False):
+    """
+    Поток событий задания (Server-Sent Events). События приходят из воркера по мере работы, без опроса:
+    - status: состояние задания, как в /jobs/{job_id} (в начале, при смене состояния и сдвиге очереди);
+    - stage: смена этапа {"stage", "detail"};
+    - table: таблица заполнена через ИИ {"table_index", "done", "total", "values"};
+    - tokens: фрагменты ответа модели {"label", "text", "final"} — только при ?tokens=true.
+    Поток закрывается после завершения задания.
+    
+    Args:
+        job_id: ID задания из ответа /upload
+        tokens: передавать ли фрагменты ответа модели
+    """
+    if await run_blocking(get_job_queue().get, job_id) is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    
+    async def stream():
+        # Подписка до чтения состояния: переход между чтением и подпиской не теряется
+        with subscribe(job_id, tokens=tokens) as events:
+            status = await run_blocking(_load_job_status, job_id)
+            yield _sse("status", status)
+            while status["state"] not in (DONE, FAILED):
+                try:
+                    event = await asyncio.wait_for(events.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Комментарий SSE: прокси не закрывает простаивающее соединение
+                    yield ": keepalive\n\n"
+                    continue
+                kind = event["type"]
+                if kind == "state" or (kind == "queue" and status["state"] == QUEUED):
+                    status = await run_blocking(_load_job_status, job_id)
+                    yield _sse("status", status)
+                elif kind in ("stage", "table", "tokens"):
+                    yield _sse(kind, {k: v for k, v in event.items() if k != "type"})
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/download/{file_id}")
 async def download_file(file_id: str):
     """
@@ -1135,32 +1434,8 @@ async def get_template_variables():
                 detail=f"Шаблон не найден: {TEMPLATE_PATH}"
             )
         
-        # Извлекаем переменные из шаблона
-        doc = Document(str(TEMPLATE_PATH))
-        variables = set()
-        
-        # Регулярное выражение для поиска переменных в формате {{переменная}}
-        pattern = re.compile(r'\{\{\s*([^}]+)\s*\}\}')
-        
-        # Извлекаем текст из параграфов
-        for paragraph in doc.paragraphs:
-            text = paragraph.text
-            matches = pattern.findall(text)
-            for match in matches:
-                var_name = match.strip()
-                if var_name:
-                    variables.add(var_name)
-        
-        # Извлекаем текст из таблиц
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    text = cell.text
-                    matches = pattern.findall(text)
-                    for match in matches:
-                        var_name = match.strip()
-                        if var_name:
-                            variables.add(var_name)
+        # Переменные берём из предразобранного артефакта шаблона (без повторного чтения .docx)
+        variables = get_template_artifact(str(TEMPLATE_PATH)).variables
         
         # Формируем список переменных
         # Каждая переменная содержит:
@@ -1258,6 +1533,15 @@ async def favicon():
     return Response(status_code=204)  # No Content
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Метрики процесса в JSON (кэш ответов модели и т.д.).
+    """
+    from wpd import metrics
+    return JSONResponse(content=metrics.snapshot())
+
+
 @app.on_event("startup")
 async def startup_event():
     """Событие запуска приложения"""
@@ -1280,15 +1564,40 @@ async def startup_event():
     else:
         print("ℹ️  TELEGRAM_BOT_TOKEN не установлен (Telegram бот не будет работать)")
     
-    # Проверка шаблона
+    # Проверка шаблона, его однократный разбор (текст, переменные, таблицы) и компиляция:
+    # синтаксическая ошибка в шаблоне видна здесь, а не на первом запросе пользователя
     if TEMPLATE_PATH.exists():
         print(f"✅ Шаблон найден: {TEMPLATE_PATH}")
+        try:
+            if COMPILED_TEMPLATES_AVAILABLE:
+                get_compiled_template(str(TEMPLATE_PATH))
+        except Exception as e:
+            print(f"❌ Не удалось разобрать шаблон: {e}")
     else:
         print(f"❌ Шаблон НЕ найден: {TEMPLATE_PATH}")
     
+    # Воркеры очереди заданий: /upload только ставит задание
+    queue = get_job_queue()
+    queue.register("upload", _upload_job)
+    queue.start()
+    # Процессы рендера с предзагруженным шаблоном и замер задержки event loop веб-сервера
+    if TEMPLATE_PATH.exists():
+        start_render_pool(str(TEMPLATE_PATH))
+    start_loop_lag_monitor("web")
+    
     print("=" * 60)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Событие остановки приложения: останавливаем очередь заданий и закрываем пулы соединений к Perplexity"""
+    from wpd.llm_client import close_client
+    # Воркеры дорабатывают текущие задания (JOB_STOP_TIMEOUT) и закрывают свой клиент Perplexity
+    await run_blocking(get_job_queue().stop)
+    await close_client()
+    shutdown_render_pool()
+
+
 if __name__ == "__main__":
     import uvicorn
     print("Запуск веб-сервера...")
@@ -3,6 +3,7 @@
 """
 
 import argparse
+import asyncio
 import sys
 
 from wpd.init_core import init_core
@@ -50,12 +51,12 @@ if __name__ == "__main__":
         sys.exit(1)
 
     # Запускаем инициализацию ядра
-    result_path, thread_id = init_core(
+    result_path, thread_id = asyncio.run(init_core(
         file1_path=args.file1,
         file2_path=args.file2,
         prompt=prompt,
         model="sonar", #"sonar", "sonar-pro"
         template_path="files/Шаблон.docx",
         result_path="files/result.docx",
-    )
+    ))
     print(f"Обработка завершена. Результат: {result_path}, thread_id: {thread_id}")
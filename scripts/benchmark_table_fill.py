@@ -0,0 +1,87 @@
+"""
+Бенчмарк заполнения больших таблиц: поячеечный python-docx против пакетной записи (wpd/table_writer.py).
+
+Для каждой таблицы шаблона с данными (или для синтетической таблицы) заполняет N строк
+обоими способами в памяти, сверяет текст ячеек и печатает время.
+
+Запуск:
+    python scripts/benchmark_table_fill.py             # 1000 и 3000 строк
+    python scripts/benchmark_table_fill.py 500 5000    # свои размеры
+"""
+
+import sys
+import time
+from pathlib import Path
+
+from docx import Document
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from wpd.document_session import fill_doc_table  # noqa: E402
+
+
+TEMPLATE_PATH = Path(__file__).resolve().parent.parent / "files" / "Шаблон.docx"
+# Таблица шаблона, на которой меряем (календарный план: 6 колонок, заголовок в первой строке)
+TABLE_INDEX = 7
+COLS_PER_ROW = 6
+START_ROW = 1
+
+
+def fill_per_cell(doc, values, table_index, cols_per_row, start_row, start_col=0):
+    """
+    Прежний способ: add_row() по одной строке и table.rows[r].cells[c].text на каждое значение.
+    """
+    table = doc.tables[table_index]
+    needed_rows = start_row + ((len(values) + cols_per_row - 1) // cols_per_row)
+    while len(table.rows) < needed_rows:
+        table.add_row()
+    for idx, value in enumerate(values):
+        r = start_row + (idx // cols_per_row)
+        c = start_col + (idx % cols_per_row)
+        table.rows[r].cells[c].text = str(value)
+
+
+def _load():
+    if TEMPLATE_PATH.exists():
+        return Document(str(TEMPLATE_PATH)), TABLE_INDEX
+    # Без шаблона — синтетическая таблица с заголовком
+    doc = Document()
+    table = doc.add_table(rows=1, cols=COLS_PER_ROW)
+    for c in range(COLS_PER_ROW):
+        table.rows[0].cells[c].text = f"Колонка {c + 1}"
+    return doc, 0
+
+
+def _cell_texts(doc, table_index):
+    return [[c.text for c in r.cells] for r in doc.tables[table_index].rows]
+
+
+def run(rows: int) -> None:
+    values = [f"Значение {i}" for i in range(rows * COLS_PER_ROW)]
+
+    doc_old, table_index = _load()
+    started = time.perf_counter()
+    fill_per_cell(doc_old, values, table_index, COLS_PER_ROW, START_ROW)
+    old_seconds = time.perf_counter() - started
+
+    doc_new, table_index = _load()
+    started = time.perf_counter()
+    fill_doc_table(doc_new, values, table_index, COLS_PER_ROW, START_ROW, 0)
+    new_seconds = time.perf_counter() - started
+
+    same = _cell_texts(doc_old, table_index) == _cell_texts(doc_new, table_index)
+    print(
+        f"{rows:>6} строк: python-docx {old_seconds:8.2f} с, пакетная запись {new_seconds:6.2f} с, "
+        f"ускорение x{old_seconds / max(new_seconds, 1e-9):.0f}; результат совпадает: {same}"
+    )
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 3000]
+    print(f"Шаблон: {TEMPLATE_PATH if TEMPLATE_PATH.exists() else '(синтетическая таблица)'}")
+    for rows in sizes:
+        run(rows)
+
+
+if __name__ == "__main__":
+    main()
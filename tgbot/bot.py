@@ -2,6 +2,7 @@
 Telegram бот для обработки учебников через Perplexity API.
 """
 
+import asyncio
 import os
 import sys
 import uuid
@@ -15,7 +16,12 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
-from wpd.merge_with_docx import generate_docx_from_template
+from wpd.executors import build_document, run_blocking, start_loop_lag_monitor, start_render_pool
+from wpd.compiled_template import COMPILED_TEMPLATES_AVAILABLE, get_compiled_template
+from wpd.job_queue import (
+    DONE, FAILED, QUEUED, RUNNING, JobFailed, QueueFull, format_wait, get_job_queue, set_stage, subscribe,
+)
+from wpd.uploads import UPLOAD_MAX_BYTES, UPLOAD_MAX_MB, check_docx
 
 # Токен бота должен быть установлен через переменную окружения TELEGRAM_BOT_TOKEN
 # Получите токен у @BotFather в Telegram
@@ -31,6 +37,9 @@ UPLOAD_DIR = BASE_DIR / "files" / "telegram_uploads"
 RESULT_DIR = BASE_DIR / "files" / "telegram_results"
 TEMPLATE_PATH = BASE_DIR / "files" / "Шаблон.docx"
 
+# Состояние задания перечитывается по его событиям; интервал — на случай пропущенного события (секунды)
+JOB_POLL_SECONDS = 30.0
+
 # Создаем папки если их нет
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 RESULT_DIR.mkdir(parents=True, exist_ok=True)
@@ -63,7 +72,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик загруженных документов"""
+    """Обработчик загруженных документов: ставит задание в очередь, результат отправляется по готовности"""
     document = update.message.document
 
     # Проверяем, что это .docx файл
@@ -74,6 +83,11 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
+    # Размер известен до скачивания: большой файл не скачиваем вовсе
+    if document.file_size and document.file_size > UPLOAD_MAX_BYTES:
+        await update.message.reply_text(f"❌ Файл слишком большой: максимум {UPLOAD_MAX_MB:g} МБ")
+        return
+
     # Отправляем сообщение о начале обработки
     processing_msg = await update.message.reply_text(
         "⏳ Файл получен. Начинаю обработку...\n"
@@ -89,6 +103,12 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         uploaded_file_path = UPLOAD_DIR / f"{file_id}_{document.file_name}"
 
         await file.download_to_drive(uploaded_file_path)
+        try:
+            await run_blocking(check_docx, uploaded_file_path)
+        except ValueError as e:
+            uploaded_file_path.unlink(missing_ok=True)
+            await processing_msg.edit_text(f"❌ {e}")
+            return
 
         # Проверяем наличие шаблона
         if not TEMPLATE_PATH.exists():
@@ -98,68 +118,160 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
 
-        # Путь к результату
-        result_path = RESULT_DIR / f"{file_id}_result.docx"
-
-        # Обновляем сообщение о прогрессе
-        await processing_msg.edit_text(
-            "Генерация документа из шаблона...\n"
-            "Это займет несколько секунд."
-        )
-
-        # Генерируем документ из шаблона без автогенерации через ИИ
-        # Просто создаем документ с пустыми переменными
-        generate_docx_from_template(
-            data={},  # Пустой словарь - все переменные будут пустыми
-            template_path=str(TEMPLATE_PATH),
-            output_path=str(result_path),
-            all_variables={}  # Пустой словарь для всех переменных
-        )
-
-        # Проверяем, что файл результата создан
-        if not result_path.exists():
-            await processing_msg.edit_text(
-                "Ошибка: Файл результата не был создан. "
-                "Попробуйте отправить файл еще раз."
+        # Обработка идёт в общей очереди заданий; обработчик сообщения сразу освобождается,
+        # а ожидание и отправка результата идут отдельной задачей
+        # Чат и сообщение о ходе обработки хранятся в задании: после перезапуска бота
+        # результат задания, поставленного до него, всё равно будет отправлен (см. _resume_deliveries)
+        try:
+            job = await run_blocking(
+                get_job_queue().submit,
+                "telegram",
+                {
+                    "uploaded_file_path": str(uploaded_file_path),
+                    "result_path": str(RESULT_DIR / f"{file_id}_result.docx"),
+                    "chat_id": update.effective_chat.id,
+                    "message_id": update.message.message_id,
+                    "progress_message_id": processing_msg.message_id,
+                },
             )
+        except QueueFull as e:
+            # Очередь заполнена: файл не обрабатываем, пользователю — когда попробовать снова
+            uploaded_file_path.unlink(missing_ok=True)
+            await processing_msg.edit_text(f"⏳ {e}")
             return
+        await processing_msg.edit_text("Файл поставлен в очередь на обработку...")
+        context.application.create_task(_deliver_result(context.bot, job))
 
-        # Отправляем файл результата
-        await processing_msg.edit_text("Обработка завершена! Отправляю файл...")
-
-        with open(result_path, 'rb') as result_file:
-            await update.message.reply_document(
-                document=result_file,
-                filename="result.docx",
-                caption="Готовый файл result.docx"
-            )
+    except Exception as e:
+        error_msg = f"Произошла ошибка при обработке файла: {str(e)}"
+        await processing_msg.edit_text(error_msg)
+        # Логируем ошибку для отладки
+        print(f"Ошибка в handle_document: {e}")
+        import traceback
+        traceback.print_exc()
 
-        await processing_msg.edit_text("Файл успешно обработан и отправлен!")
 
+async def _process_document(job_id: str, payload: dict) -> dict:
+    """
+    Обработчик задания "telegram" (выполняется воркером очереди): генерирует документ из шаблона.
+    """
+    uploaded_file_path = Path(payload["uploaded_file_path"])
+    try:
+        await set_stage("render")
+        # Генерируем документ из шаблона без автогенерации через ИИ
+        # Просто создаем документ с пустыми переменными (рендер — в пуле процессов, см. wpd/executors.py)
+        result_path = await build_document(
+            str(TEMPLATE_PATH),
+            {},  # Пустой словарь для всех переменных
+            [],
+            payload["result_path"],
+        )
+    except FileNotFoundError as e:
+        raise JobFailed(f"Ошибка: Файл не найден - {str(e)}")
+    except ValueError as e:
+        raise JobFailed(f"Ошибка: {str(e)}")
+    finally:
         # Удаляем временные файлы
         try:
             uploaded_file_path.unlink()
-            result_path.unlink()
         except Exception:
             pass  # Игнорируем ошибки удаления
+    return {"result_path": result_path}
+
+
+async def _deliver_result(bot, job: dict) -> None:
+    """
+    Ждёт завершения задания, показывает этапы в сообщении о ходе обработки и отправляет результат.
+    Чат и сообщения берутся из задания, поэтому доставку можно продолжить после перезапуска бота.
+    """
+    stages = {
+        "render": "Генерация документа из шаблона...",
+    }
+    queue = get_job_queue()
+    job_id = job["id"]
+    chat_id = job["payload"]["chat_id"]
+    progress_message_id = job["payload"]["progress_message_id"]
+    shown = None
+
+    async def show(text: str) -> None:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=progress_message_id)
 
-    except FileNotFoundError as e:
-        await processing_msg.edit_text(
-            f"Ошибка: Файл не найден - {str(e)}"
-        )
-    except ValueError as e:
-        await processing_msg.edit_text(
-            f"Ошибка: {str(e)}"
+    try:
+        with subscribe(job_id) as events:
+            while True:
+                job = await run_blocking(queue.get, job_id)
+                if job is None or job["state"] in (DONE, FAILED):
+                    break
+                text = stages.get(job["stage"], "Файл в очереди на обработку...")
+                if job["state"] == QUEUED:
+                    estimate = await run_blocking(queue.queue_estimate, job_id)
+                    if estimate is not None and estimate[0] > 0:
+                        text = (
+                            f"Файл в очереди на обработку (перед вами заданий: {estimate[0]}, "
+                            f"ожидание {format_wait(estimate[1])})..."
+                        )
+                if text != shown:
+                    await show(text)
+                    shown = text
+                # Ждём следующего события задания (смена этапа или состояния, сдвиг очереди)
+                try:
+                    await asyncio.wait_for(events.get(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+        if job is None or job["state"] == FAILED:
+            await show((job or {}).get("error") or "Произошла ошибка при обработке файла")
+            return
+
+        # Отправляем файл результата
+        await show("Обработка завершена! Отправляю файл...")
+        result_path = Path(job["result"]["result_path"])
+        await bot.send_document(
+            chat_id,
+            document=await run_blocking(result_path.read_bytes),
+            filename="result.docx",
+            caption="Готовый файл result.docx",
+            reply_to_message_id=job["payload"].get("message_id"),
+            allow_sending_without_reply=True,
         )
+        await show("Файл успешно обработан и отправлен!")
+        # Удалённый файл результата — признак того, что задание доставлено
+        try:
+            result_path.unlink()
+        except Exception:
+            pass
+
     except Exception as e:
         error_msg = f"Произошла ошибка при обработке файла: {str(e)}"
-        await processing_msg.edit_text(error_msg)
+        try:
+            await show(error_msg)
+        except Exception:
+            pass
         # Логируем ошибку для отладки
-        print(f"Ошибка в handle_document: {e}")
+        print(f"Ошибка при отправке результата: {e}")
         import traceback
         traceback.print_exc()
 
 
+async def _resume_deliveries(application: Application) -> None:
+    """
+    Продолжает доставку заданий, поставленных до перезапуска бота: незавершённые (их воркеры
+    выполнят заново) и завершённые, но не отправленные (файл результата ещё на месте).
+    """
+    queue = get_job_queue()
+    jobs = await run_blocking(queue.list_jobs, "telegram", (QUEUED, RUNNING, DONE))
+    resumed = 0
+    for job in jobs:
+        if "chat_id" not in job["payload"]:
+            continue
+        if job["state"] == DONE and not Path((job["result"] or {}).get("result_path", "")).is_file():
+            continue
+        application.create_task(_deliver_result(application.bot, job))
+        resumed += 1
+    if resumed:
+        print(f"Продолжена доставка результатов после перезапуска: заданий {resumed}")
+
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик текстовых сообщений"""
     await update.message.reply_text(
@@ -168,6 +280,17 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     )
 
 
+async def _post_init(application: Application) -> None:
+    """Замер задержки event loop бота (метрика event_loop_lag_seconds_bot) и доставка заданий с прошлого запуска"""
+    start_loop_lag_monitor("bot")
+    await _resume_deliveries(application)
+
+
+async def _post_shutdown(application: Application) -> None:
+    """Остановка воркеров очереди заданий (с веб-сервером в одном процессе остановка общая)"""
+    await run_blocking(get_job_queue().stop)
+
+
 def run_bot() -> None:
     """Запуск бота (для использования в отдельном потоке)"""
     if not BOT_TOKEN:
@@ -176,8 +299,20 @@ def run_bot() -> None:
     
     token = BOT_TOKEN
     
+    # Разбираем и компилируем шаблон заранее, чтобы обработка документов его не перечитывала
+    # (и ошибка в шаблоне была видна при запуске)
+    if TEMPLATE_PATH.exists() and COMPILED_TEMPLATES_AVAILABLE:
+        get_compiled_template(str(TEMPLATE_PATH))
+    
+    # Документы обрабатываются воркерами общей очереди заданий (с веб-сервером, если он запущен)
+    queue = get_job_queue()
+    queue.register("telegram", _process_document)
+    queue.start()
+    if TEMPLATE_PATH.exists():
+        start_render_pool(str(TEMPLATE_PATH))
+    
     # Создаем приложение
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_init(_post_init).post_shutdown(_post_shutdown).build()
 
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
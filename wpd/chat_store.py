@@ -0,0 +1,145 @@
+"""
+Хранилище истории чатов (локальных CHAT_ID) в SQLite.
+
+Каждое сообщение — отдельная строка (chat_id, seq), поэтому:
+- загрузка и сохранение затрагивают только один чат, а не весь файл истории;
+- сохранение дописывает только новые сообщения (или переписывает хвост с первого отличия);
+- параллельные задания (веб и бот) пишут в разных транзакциях и не теряют чужие записи (WAL).
+
+При первом открытии базы история из старого perplexity_chats.json переносится автоматически.
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+_init_lock = threading.Lock()
+_initialized_paths: set[str] = set()
+
+
+def _db_path(store_path: str) -> Path:
+    # Старые вызовы передают путь к perplexity_chats.json — база лежит рядом с тем же именем
+    p = Path(store_path)
+    return p.with_suffix(".sqlite3") if p.suffix == ".json" else p
+
+
+def _migrate_json(conn: sqlite3.Connection, json_path: Path) -> None:
+    """
+    Переносит чаты из старого JSON-файла ({chat_id: [messages]}) и переименовывает его в *.migrated.
+    """
+    try:
+        data = json.loads(json_path.read_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"Не удалось прочитать старую историю чатов {json_path}: {e}")
+        return
+    if not isinstance(data, dict):
+        return
+
+    migrated = 0
+    with conn:
+        for chat_id, msgs in data.items():
+            if not isinstance(msgs, list):
+                continue
+            exists = conn.execute("SELECT 1 FROM chat_messages WHERE chat_id = ? LIMIT 1", (chat_id,)).fetchone()
+            if exists:
+                continue
+            conn.executemany(
+                "INSERT INTO chat_messages (chat_id, seq, message) VALUES (?, ?, ?)",
+                [(chat_id, i, json.dumps(m, ensure_ascii=False)) for i, m in enumerate(msgs)],
+            )
+            migrated += 1
+
+    json_path.rename(json_path.with_name(f"{json_path.name}.migrated"))
+    print(f"История чатов перенесена из {json_path} в SQLite (чатов: {migrated})")
+
+
+def _connect(store_path: str) -> sqlite3.Connection:
+    db_path = _db_path(store_path)
+    key = str(db_path)
+    if key not in _initialized_paths:
+        with _init_lock:
+            if key not in _initialized_paths:
+                db_path.parent.mkdir(parents=True, exist_ok=True)
+                conn = sqlite3.connect(key, timeout=30)
+                try:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS chat_messages ("
+                        " chat_id TEXT NOT NULL,"
+                        " seq INTEGER NOT NULL,"
+                        " message TEXT NOT NULL,"
+                        " PRIMARY KEY (chat_id, seq))"
+                    )
+                    conn.commit()
+                    legacy_json = db_path.with_suffix(".json")
+                    if legacy_json.exists():
+                        _migrate_json(conn, legacy_json)
+                finally:
+                    conn.close()
+                _initialized_paths.add(key)
+
+    conn = sqlite3.connect(key, timeout=30)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def load_messages(chat_id: str, store_path: str) -> list[dict]:
+    """
+    Возвращает историю сообщений чата (пустой список, если чата нет).
+    """
+    conn = _connect(store_path)
+    try:
+        rows = conn.execute(
+            "SELECT message FROM chat_messages WHERE chat_id = ? ORDER BY seq", (chat_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    messages = []
+    for (raw,) in rows:
+        try:
+            messages.append(json.loads(raw))
+        except Exception:
+            continue
+    return messages
+
+
+def save_messages(chat_id: str, messages: list[dict], store_path: str) -> None:
+    """
+    Сохраняет полную историю чата.
+
+    Совпадающее начало истории не переписывается: новые сообщения дописываются,
+    а если история изменилась (например, после нормализации) — переписывается хвост с первого отличия.
+    """
+    encoded = [json.dumps(m, ensure_ascii=False) for m in messages]
+
+    conn = _connect(store_path)
+    try:
+        # IMMEDIATE: берём блокировку на запись сразу, чтобы сравнение и запись были одной транзакцией
+        conn.execute("BEGIN IMMEDIATE")
+        stored = [
+            raw for (raw,) in conn.execute(
+                "SELECT message FROM chat_messages WHERE chat_id = ? ORDER BY seq", (chat_id,)
+            )
+        ]
+        common = 0
+        for old, new in zip(stored, encoded):
+            if old != new:
+                break
+            common += 1
+
+        if common < len(stored):
+            conn.execute("DELETE FROM chat_messages WHERE chat_id = ? AND seq >= ?", (chat_id, common))
+        conn.executemany(
+            "INSERT INTO chat_messages (chat_id, seq, message) VALUES (?, ?, ?)",
+            [(chat_id, i, encoded[i]) for i in range(common, len(encoded))],
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,263 @@
+"""
+Скомпилированный шаблон docxtpl: разбор и компиляция один раз, на рендер — только подстановка.
+
+`DocxTemplate(...).render()` на каждый запрос заново разбирает .docx, прогоняет XML через
+десятки регулярных выражений docxtpl (patch_xml) и компилирует Jinja: для шаблона РПД это ~0.5 с,
+из которых сама подстановка переменных занимает доли миллисекунды.
+
+Здесь всё, что зависит только от шаблона, делается один раз на хэш содержимого:
+- исходный документ python-docx разбирается и хранится нетронутым, на каждый рендер делается его копия в памяти;
+- подготовленный (patch_xml) XML тела, колонтитулов и сносок сохраняется;
+- Jinja-шаблоны компилируются заранее, поэтому синтаксическая ошибка в шаблоне видна при запуске,
+  а не на запросе пользователя.
+"""
+
+from __future__ import annotations
+
+import copy
+import inspect
+import io
+import re
+import threading
+from dataclasses import dataclass
+
+from docx import Document
+from docxtpl import DocxTemplate
+from docx.oxml.parser import element_class_lookup
+from jinja2 import Environment, TemplateError
+from lxml import etree
+
+from wpd.docx_package import SourcePackage
+from wpd.template_artifact import get_template_artifact
+
+_FOOTNOTES_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml"
+# Сколько скомпилированных версий шаблона держать (старые хэши после замены файла не нужны)
+_CACHE_SIZE = 4
+
+# Парсер отрендеренного XML: как в docxtpl (recover), но с классами элементов python-docx
+_RENDER_PARSER = etree.XMLParser(recover=True, resolve_entities=False)
+_RENDER_PARSER.set_element_class_lookup(element_class_lookup)
+_NS_DECL_RE = re.compile(r'\s+xmlns(?::[\w.-]+)?="[^"]*"')
+
+
+# Методы docxtpl, которые переопределяет CompiledDocxTemplate или вызывает _compile, и их параметры.
+# Это внутренние методы docxtpl (проверено на 0.20.x, версия закреплена в requirements.txt);
+# если в установленной версии их нет или сигнатура другая, рендер идёт обычным DocxTemplate.
+_DOCXTPL_HOOKS = {
+    "init_docx": ("reload",),
+    "build_xml": ("context", "jinja_env"),
+    "build_headers_footers_xml": ("context", "uri", "jinja_env"),
+    "map_tree": ("tree",),
+    "render_footnotes": ("context", "jinja_env"),
+    "render_xml_part": ("src_xml", "part", "context", "jinja_env"),
+    "render": ("context", "jinja_env", "autoescape"),
+    "patch_xml": ("src_xml",),
+    "get_xml": (),
+    "get_part_xml": ("part",),
+    "get_headers_footers": ("uri",),
+    "get_headers_footers_encoding": ("xml",),
+}
+
+
+def _docxtpl_hooks_available() -> bool:
+    for name, params in _DOCXTPL_HOOKS.items():
+        method = getattr(DocxTemplate, name, None)
+        if method is None:
+            return False
+        try:
+            actual = list(inspect.signature(method).parameters)[1:]
+        except (TypeError, ValueError):
+            return False
+        if actual[:len(params)] != list(params):
+            return False
+    return True
+
+
+# Можно ли рендерить через скомпилированный шаблон (иначе — обычный DocxTemplate на каждый рендер)
+COMPILED_TEMPLATES_AVAILABLE = _docxtpl_hooks_available()
+if not COMPILED_TEMPLATES_AVAILABLE:
+    print(
+        "Предупреждение: установленная версия docxtpl не совпадает с ожидаемой (0.20.x), "
+        "шаблон будет разбираться на каждый рендер"
+    )
+
+
+class _CompilingEnvironment(Environment):
+    """
+    Окружение Jinja, которое компилирует каждый исходник один раз.
+
+    docxtpl вызывает `jinja_env.from_string(xml)` на каждый рендер; для уже скомпилированного
+    исходника возвращается готовый шаблон.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._templates: dict = {}
+        self._templates_lock = threading.Lock()
+
+    def from_string(self, source, globals=None, template_class=None):
+        template = self._templates.get(source)
+        if template is None:
+            template = super().from_string(source, globals=globals, template_class=template_class)
+            with self._templates_lock:
+                self._templates[source] = template
+        return template
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """
+    Всё, что docxtpl вычисляет из шаблона независимо от переменных.
+    """
+
+    sha256: str
+    # Нетронутый разобранный документ: рендер работает с его копией
+    document: object
+    env: _CompilingEnvironment
+    # Подготовленный XML частей по имени части (/word/document.xml, /word/header1.xml, ...)
+    patched_xml: dict
+    # Кодировка XML колонтитулов (docxtpl кодирует результат обратно в неё)
+    encodings: dict
+    # Разметка корня document.xml до и после <w:body>
+    root_open: str
+    root_close: str
+    root_ns_decls: frozenset
+    # Исходный пакет: неизменённые части результата копируются из него без перепаковки
+    source: SourcePackage
+
+
+class CompiledDocxTemplate(DocxTemplate):
+    """
+    DocxTemplate, который берёт документ и подготовленный XML из CompiledTemplate.
+
+    Логика рендера (fix_tables, колонтитулы, сноски, свойства документа) остаётся в docxtpl;
+    переопределены только шаги, которые зависят лишь от шаблона.
+    """
+
+    def __init__(self, compiled: CompiledTemplate):
+        super().__init__(io.BytesIO())
+        self._compiled = compiled
+
+    def init_docx(self, reload: bool = True):
+        if not self.docx or (self.is_rendered and reload):
+            self.docx = copy.deepcopy(self._compiled.document)
+            self.is_rendered = False
+
+    def render(self, context, jinja_env=None, autoescape=False) -> None:
+        super().render(context, jinja_env=jinja_env or self._compiled.env, autoescape=autoescape)
+
+    def build_xml(self, context, jinja_env=None):
+        part = self.docx._part
+        return self.render_xml_part(self._compiled.patched_xml[str(part.partname)], part, context, jinja_env)
+
+    def build_headers_footers_xml(self, context, uri, jinja_env=None):
+        for relKey, part in self.get_headers_footers(uri):
+            name = str(part.partname)
+            xml = self.render_xml_part(self._compiled.patched_xml[name], part, context, jinja_env)
+            yield relKey, xml.encode(self._compiled.encodings[name])
+
+    def map_tree(self, tree):
+        # docxtpl переносит отрендеренное тело в документ через replace(): lxml при этом
+        # пересчитывает пространства имён на каждом узле (~0.15 с для шаблона РПД).
+        # Разбор корня документа целиком из текста даёт то же дерево заметно быстрее.
+        part = self.docx.part
+        body = etree.tostring(tree, encoding="unicode")
+        # Объявления пространств имён, уже объявленные на корне, в тексте тела не повторяем
+        tag_end = body.index(">")
+        body = _NS_DECL_RE.sub(
+            lambda m: "" if m.group(0).strip() in self._compiled.root_ns_decls else m.group(0),
+            body[:tag_end],
+        ) + body[tag_end:]
+        xml = self._compiled.root_open + body + self._compiled.root_close
+        part._element = etree.fromstring(xml, _RENDER_PARSER)
+        self.docx = part.document
+
+    def render_footnotes(self, context, jinja_env=None) -> None:
+        for part in self.docx.part.package.parts:
+            if part.content_type == _FOOTNOTES_CONTENT_TYPE:
+                xml = self.render_xml_part(self._compiled.patched_xml[str(part.partname)], part, context, jinja_env)
+                part._blob = xml.encode("utf-8")
+
+
+def _compile(data: bytes, sha256: str, template_path: str) -> CompiledTemplate:
+    document = Document(io.BytesIO(data))
+    # Экземпляр нужен только для вспомогательных методов docxtpl (patch_xml, get_part_xml, ...)
+    helper = DocxTemplate(io.BytesIO(data))
+    helper.docx = document
+
+    patched: dict = {}
+    encodings: dict = {}
+    patched[str(document.part.partname)] = helper.patch_xml(helper.get_xml())
+    for uri in (DocxTemplate.HEADER_URI, DocxTemplate.FOOTER_URI):
+        for _, part in helper.get_headers_footers(uri):
+            xml = helper.get_part_xml(part)
+            encodings[str(part.partname)] = helper.get_headers_footers_encoding(xml)
+            patched[str(part.partname)] = helper.patch_xml(xml)
+    for part in document.part.package.parts:
+        if part.content_type == _FOOTNOTES_CONTENT_TYPE:
+            blob = part.blob.decode("utf-8") if isinstance(part.blob, bytes) else part.blob
+            patched[str(part.partname)] = helper.patch_xml(blob)
+
+    root = document.element
+    shell = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+    root_open = etree.tostring(shell, encoding="unicode")[:-2] + ">"
+    root_ns_decls = frozenset(m.group(0).strip() for m in _NS_DECL_RE.finditer(root_open))
+    root_close = f"</{root.prefix}:{etree.QName(root).localname}>"
+    body_index = list(root).index(root.body)
+    root_open += "".join(etree.tostring(el, encoding="unicode") for el in root[:body_index])
+    root_close = "".join(etree.tostring(el, encoding="unicode") for el in root[body_index + 1:]) + root_close
+
+    env = _CompilingEnvironment()
+    for name, xml in patched.items():
+        # Тот же исходник, что строит DocxTemplate.render_xml_part, — чтобы рендер попадал в кэш
+        source = re.sub(r"<w:p([ >])", r"\n<w:p\1", xml)
+        try:
+            env.from_string(source)
+        except TemplateError as e:
+            line = getattr(e, "lineno", None)
+            context = ""
+            if line:
+                lines = source.splitlines()[max(line - 4, 0):line + 3]
+                context = " ".join(re.sub(r"<[^>]+>", "", x).strip() for x in lines).strip()[:300]
+            raise ValueError(f"Ошибка синтаксиса в шаблоне {template_path} ({name}): {e} Фрагмент: {context}")
+
+    return CompiledTemplate(
+        sha256=sha256,
+        document=document,
+        env=env,
+        patched_xml=patched,
+        encodings=encodings,
+        root_open=root_open,
+        root_close=root_close,
+        root_ns_decls=root_ns_decls,
+        source=SourcePackage.from_document(data, document),
+    )
+
+
+_lock = threading.Lock()
+_compiled: dict[str, CompiledTemplate] = {}
+
+
+def get_compiled_template(template_path: str) -> CompiledTemplate:
+    """
+    Скомпилированный шаблон для текущего содержимого файла (кэш по sha256 из артефакта шаблона).
+
+    Raises:
+        FileNotFoundError: если шаблона нет
+        ValueError: если шаблон не удалось разобрать, в нём синтаксическая ошибка Jinja
+            или версия docxtpl не поддерживает скомпилированные шаблоны
+    """
+    if not COMPILED_TEMPLATES_AVAILABLE:
+        raise ValueError("Скомпилированные шаблоны недоступны: несовместимая версия docxtpl (нужна 0.20.x)")
+    artifact = get_template_artifact(template_path)
+    with _lock:
+        compiled = _compiled.get(artifact.sha256)
+        if compiled is not None:
+            return compiled
+
+        compiled = _compile(artifact.data, artifact.sha256, artifact.path)
+        _compiled[artifact.sha256] = compiled
+        while len(_compiled) > _CACHE_SIZE:
+            _compiled.pop(next(iter(_compiled)))
+        print(f"Шаблон скомпилирован: {artifact.path} (частей: {len(compiled.patched_xml)}, sha256: {artifact.sha256[:12]})")
+        return compiled
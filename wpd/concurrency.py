@@ -0,0 +1,162 @@
+"""
+Адаптивное ограничение числа одновременных запросов к Perplexity (AIMD).
+
+Статический лимит то слишком осторожен, то слишком агрессивен: пропускная способность API зависит
+от времени суток и модели. Поэтому лимит (отдельно для каждой модели) подстраивается по ответам:
+- успешный запрос при насыщении лимита — аддитивное увеличение (+1 за каждые `limit` успешных запросов);
+- 429/5xx, зависание потока или время до первого фрагмента сильно выше базового — мультипликативное
+  уменьшение (не чаще раза за базовую задержку, чтобы одна волна ошибок не обнулила лимит).
+
+Лимит общий для процесса: веб-сервер и Telegram бот работают в разных event loop'ах,
+поэтому ожидающие хранятся как (loop, future) и пробуждаются через call_soon_threadsafe.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from wpd import metrics
+
+PPLX_CONCURRENCY_ADAPTIVE = os.getenv("PPLX_CONCURRENCY_ADAPTIVE", "true").lower() == "true"
+PPLX_CONCURRENCY_INITIAL = int(os.getenv("PPLX_CONCURRENCY_INITIAL", "4"))
+PPLX_CONCURRENCY_MIN = int(os.getenv("PPLX_CONCURRENCY_MIN", "1"))
+PPLX_CONCURRENCY_MAX = int(os.getenv("PPLX_CONCURRENCY_MAX", "32"))
+# Во сколько раз время до первого фрагмента может превышать базовое, прежде чем считаться перегрузкой
+PPLX_CONCURRENCY_LATENCY_TOLERANCE = float(os.getenv("PPLX_CONCURRENCY_LATENCY_TOLERANCE", "3"))
+# Коэффициент уменьшения лимита при перегрузке
+PPLX_CONCURRENCY_DECREASE_FACTOR = float(os.getenv("PPLX_CONCURRENCY_DECREASE_FACTOR", "0.5"))
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_OVERLOAD = "overload"
+OUTCOME_ERROR = "error"
+
+
+def _set_result(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Семафор с переменным лимитом, общий для всех потоков процесса.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = PPLX_CONCURRENCY_INITIAL,
+        minimum: int = PPLX_CONCURRENCY_MIN,
+        maximum: int = PPLX_CONCURRENCY_MAX,
+    ):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self._limit = float(min(self.maximum, max(self.minimum, initial)))
+        self._in_flight = 0
+        self._waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        # Время до первого фрагмента последних успешных запросов (базовая задержка — минимум окна)
+        self._latencies: deque[float] = deque(maxlen=50)
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._in_flight < int(self._limit) and not self._waiters:
+                self._in_flight += 1
+                self._publish_locked()
+                return
+            fut = loop.create_future()
+            self._waiters.append((loop, fut))
+            metrics.inc("llm_concurrency_queued")
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, fut))
+                    handed_over = False
+                except ValueError:
+                    # Слот уже был передан этому ожидающему — возвращаем его
+                    handed_over = True
+            if handed_over:
+                self.release(OUTCOME_ERROR)
+            raise
+
+    def release(self, outcome: str, first_token_latency: Optional[float] = None) -> None:
+        """
+        Освобождает слот и корректирует лимит по результату запроса.
+
+        Args:
+            outcome: OUTCOME_SUCCESS / OUTCOME_OVERLOAD / OUTCOME_ERROR (ошибка, не связанная с нагрузкой)
+            first_token_latency: время до первого фрагмента ответа (для успешных запросов)
+        """
+        with self._lock:
+            saturated = self._in_flight >= int(self._limit)
+            self._in_flight = max(0, self._in_flight - 1)
+            if PPLX_CONCURRENCY_ADAPTIVE:
+                self._adjust_locked(outcome, first_token_latency, saturated)
+            self._wake_locked()
+            self._publish_locked()
+
+    def _adjust_locked(self, outcome: str, latency: Optional[float], saturated: bool) -> None:
+        now = time.monotonic()
+        baseline = min(self._latencies) if self._latencies else None
+
+        if outcome == OUTCOME_SUCCESS and latency is not None:
+            self._latencies.append(latency)
+            if baseline is not None and latency > baseline * PPLX_CONCURRENCY_LATENCY_TOLERANCE:
+                outcome = OUTCOME_OVERLOAD
+
+        if outcome == OUTCOME_OVERLOAD:
+            # Ответы, стартовавшие до прошлого уменьшения, не должны уменьшать лимит повторно
+            if now - self._last_decrease >= max(1.0, baseline or 0.0):
+                self._limit = max(float(self.minimum), self._limit * PPLX_CONCURRENCY_DECREASE_FACTOR)
+                self._last_decrease = now
+                metrics.inc("llm_concurrency_decreases")
+                print(f"Перегрузка API ({self.name}): лимит одновременных запросов снижен до {int(self._limit)}")
+        elif outcome == OUTCOME_SUCCESS and saturated:
+            # Увеличиваем только если лимит реально упирался — иначе он рос бы без нагрузки
+            self._limit = min(float(self.maximum), self._limit + 1.0 / self._limit)
+
+    def _wake_locked(self) -> None:
+        while self._waiters and self._in_flight < int(self._limit):
+            loop, fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            try:
+                loop.call_soon_threadsafe(_set_result, fut)
+            except RuntimeError:
+                # Loop ожидающего уже закрыт
+                continue
+            self._in_flight += 1
+
+    def _publish_locked(self) -> None:
+        metrics.set_gauge(f"llm_concurrency_limit_{self.name}", int(self._limit))
+        metrics.set_gauge(f"llm_concurrency_in_flight_{self.name}", self._in_flight)
+
+
+_limiters: dict[str, AdaptiveConcurrencyLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model: str) -> AdaptiveConcurrencyLimiter:
+    """
+    Лимит одновременных запросов для модели (у sonar и sonar-pro разная пропускная способность).
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(model)
+        if limiter is None:
+            limiter = AdaptiveConcurrencyLimiter(model.replace("-", "_"))
+            _limiters[model] = limiter
+        return limiter
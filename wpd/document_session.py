@@ -0,0 +1,204 @@
+"""
+Документ задания в памяти: рендер переменных, заполнение таблиц и одно сохранение в конце.
+
+Раньше каждый шаг работал с файлом: рендер шаблона сохранял result.docx, заполнение таблиц
+открывало его заново (а последовательное заполнение — на каждую таблицу, плюс ещё раз для диагностики)
+и снова сохраняло. Теперь документ живёт в DocumentSession до конца задания:
+все шаги меняют одно дерево в памяти, а на диск (или в байты для отправки) он пишется один раз.
+"""
+
+from __future__ import annotations
+
+import io
+from pathlib import Path
+from typing import Iterable, Optional, Sequence, Tuple, Union
+
+from docx import Document
+from docxtpl import DocxTemplate
+
+from wpd.compiled_template import COMPILED_TEMPLATES_AVAILABLE, get_compiled_template
+from wpd.docx_package import SourcePackage, write_package
+from wpd.merge_with_docx import render_template
+from wpd.table_writer import TableGrid
+from wpd.template_artifact import TemplateTableInfo, get_template_artifact
+
+
+def fill_doc_table(
+    doc,
+    values: Sequence[str],
+    table_index: int,
+    cols_per_row: int,
+    start_row: int,
+    start_col: int,
+) -> None:
+    """
+    Заполняет таблицу уже открытого документа `doc` (без сохранения).
+    Логика заполнения описана в `wpd.fill_result_table.fill_table_row_major`.
+    """
+    if table_index >= len(doc.tables):
+        raise ValueError(
+            f"В документе нет таблицы с индексом {table_index}. "
+            f"Доступно таблиц: {len(doc.tables)}"
+        )
+
+    table = doc.tables[table_index]
+    if cols_per_row <= 0:
+        raise ValueError("cols_per_row должен быть > 0")
+    if start_row < 0 or start_col < 0:
+        raise ValueError("start_row и start_col должны быть >= 0")
+
+    # Сетка ячеек строится один раз на таблицу (см. wpd/table_writer.py)
+    grid = TableGrid(table)
+    if not grid.rows:
+        raise ValueError("Таблица пуста (нет строк).")
+
+    # Используем максимальное количество ячеек в строке вместо len(table.columns)
+    # для корректной работы с объединенными ячейками
+    max_row_cells = grid.max_row_cells
+    if max_row_cells == 0:
+        raise ValueError("Таблица пуста (нет ячеек).")
+    if start_col + cols_per_row > max_row_cells:
+        raise ValueError(
+            f"Недостаточно колонок: нужно минимум {start_col + cols_per_row}, "
+            f"а в таблице максимум {max_row_cells} ячеек в строке."
+        )
+
+    # недостающие строки добавляются пачкой, значения пишутся прямо в XML ячеек
+    grid.write_row_major(values, cols_per_row, start_row, start_col)
+
+
+class DocumentSession:
+    """
+    Один документ задания в памяти.
+
+    Создаётся рендером шаблона (`from_template`) или открытием готового файла (`open`);
+    таблицы заполняются через `fill_table` / `fill_tables`, результат пишется `save` или `to_bytes`.
+    """
+
+    def __init__(
+        self,
+        doc,
+        table_map: Optional[Sequence[TemplateTableInfo]] = None,
+        source: Optional[SourcePackage] = None,
+    ):
+        # doc — DocxTemplate после render() или документ python-docx
+        self._doc = doc
+        # Карта таблиц шаблона: для диагностики не нужно обходить дерево документа
+        self._table_map = tuple(table_map) if table_map is not None else None
+        # Исходный пакет: неизменённые части при сохранении копируются из него (см. wpd/docx_package.py)
+        self._source = source
+
+    @classmethod
+    def from_template(
+        cls,
+        data: Union[str, Iterable[Union[str, Tuple[str, str]]], dict],
+        template_path: str,
+        all_variables: dict[str, str] | None = None,
+    ) -> "DocumentSession":
+        """
+        Рендерит шаблон с переменными (см. `generate_docx_from_template`) без записи на диск.
+        """
+        artifact = get_template_artifact(template_path)
+        if COMPILED_TEMPLATES_AVAILABLE:
+            source = get_compiled_template(template_path).source
+        else:
+            source = SourcePackage(artifact.data)
+        return cls(
+            render_template(data, template_path, all_variables),
+            table_map=artifact.tables,
+            source=source,
+        )
+
+    @classmethod
+    def open(cls, path: str) -> "DocumentSession":
+        data = Path(path).read_bytes()
+        # Без сериализации частей при открытии: неизменёнными считаются части, совпадающие с записью zip
+        return cls(Document(io.BytesIO(data)), source=SourcePackage(data))
+
+    @property
+    def document(self):
+        """
+        Документ python-docx, с которым работают все шаги.
+        """
+        if isinstance(self._doc, DocxTemplate):
+            return self._doc.docx
+        return self._doc
+
+    def describe_table(self, table_index: int) -> str:
+        """
+        Строка для лога: размеры и заголовок таблицы с индексом python-docx `table_index`.
+        """
+        tables = self.document.tables
+        if table_index < 0 or table_index >= len(tables):
+            raise ValueError(f"doc_index={table_index} вне диапазона. Всего таблиц в документе: {len(tables)}")
+        # Таблицы до заполнения совпадают с шаблоном, поэтому берём описание из артефакта
+        if self._table_map is not None and table_index < len(self._table_map):
+            info = self._table_map[table_index]
+            return f"rows={info.rows} max_row_cells={info.max_row_cells}; header='{info.header[:120]}'"
+        t = tables[table_index]
+        max_cells = max((len(r.cells) for r in t.rows), default=0)
+        header = " | ".join(c.text.strip() for c in (t.rows[0].cells if t.rows else []))[:120]
+        return f"rows={len(t.rows)} max_row_cells={max_cells}; header='{header}'"
+
+    def fill_table(
+        self,
+        values: Sequence[str],
+        table_index: int,
+        cols_per_row: int,
+        start_row: int = 0,
+        start_col: int = 0,
+    ) -> None:
+        fill_doc_table(self.document, values, table_index, cols_per_row, start_row, start_col)
+
+    def fill_tables(self, fills: Sequence[dict]) -> None:
+        """
+        fills — список словарей как у `wpd.fill_result_table.fill_tables_row_major`.
+        """
+        for fill in fills:
+            self.fill_table(
+                fill["values"],
+                fill["table_index"],
+                fill["cols_per_row"],
+                fill.get("start_row", 0),
+                fill.get("start_col", 0),
+            )
+
+    def _write(self, target) -> None:
+        doc = self._doc
+        if isinstance(doc, DocxTemplate) and (
+            doc.pics_to_replace or doc.crc_to_new_media or doc.crc_to_new_embedded or doc.zipname_to_replace
+        ):
+            # Замены картинок/вложений docxtpl делает при сохранении — оставляем это ему
+            doc.save(target)
+            return
+        write_package(self.document, target, self._source)
+
+    def save(self, path: str) -> str:
+        """
+        Сохраняет документ. Возвращает путь, по которому он реально сохранён.
+        """
+        # На Windows docx часто блокируется Word'ом. Если нельзя перезаписать файл —
+        # сохраняем рядом под новым именем.
+        try:
+            self._write(path)
+            return path
+        except PermissionError:
+            p = Path(path)
+            alt = p.with_name(f"{p.stem}_filled{p.suffix}")
+            if alt.exists():
+                import uuid as _uuid
+                alt = p.with_name(f"{p.stem}_filled_{str(_uuid.uuid4())[:8]}{p.suffix}")
+            self._write(str(alt))
+            print(
+                f"Не удалось перезаписать '{path}' (файл, вероятно, открыт). "
+                f"Сохранил результат в '{alt.name}'. Закройте Word и запустите снова, если нужно перезаписать исходный файл."
+            )
+            return str(alt)
+
+    def to_bytes(self) -> bytes:
+        """
+        Документ в виде байтов .docx (для отправки без временного файла).
+        """
+        buf = io.BytesIO()
+        self._write(buf)
+        return buf.getvalue()
@@ -0,0 +1,175 @@
+"""
+Сохранение .docx с переносом неизменённых частей пакета в сжатом виде.
+
+python-docx при сохранении заново сериализует и сжимает все части пакета: стили, нумерацию,
+темы, шрифты, картинки, хотя задание меняет только тело документа (и, может быть, колонтитулы).
+Здесь части, совпадающие с исходным пакетом (шаблоном или открытым файлом), копируются
+из исходного zip как есть — сжатыми байтами, без распаковки и повторного deflate;
+сжимаются только изменённые части, с уровнем DOCX_COMPRESS_LEVEL.
+"""
+
+from __future__ import annotations
+
+import copy
+import io
+import os
+import struct
+import time
+import zipfile
+import zlib
+from typing import IO, Optional, Union
+
+from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.pkgwriter import _ContentTypesItem
+
+from wpd import metrics
+
+DOCX_RAW_COPY_ENABLED = os.getenv("DOCX_RAW_COPY_ENABLED", "true").lower() == "true"
+# Уровень сжатия изменённых частей (0-9, как у zlib; 6 — уровень python-docx по умолчанию)
+DOCX_COMPRESS_LEVEL = int(os.getenv("DOCX_COMPRESS_LEVEL", "6"))
+
+# Локальный заголовок записи zip: сигнатура и фиксированная часть (30 байт)
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_DATA_DESCRIPTOR_FLAG = 0x08
+
+
+def package_entries(document) -> list[tuple[str, bytes]]:
+    """
+    Содержимое пакета в том виде, в каком его записывает python-docx (PackageWriter):
+    [Content_Types].xml, связи пакета, части и их связи.
+    """
+    package = document.part.package
+    parts = list(package.parts)
+    for part in parts:
+        part.before_marshal()
+    entries = [
+        (CONTENT_TYPES_URI.membername, _ContentTypesItem.from_parts(parts).blob),
+        (PACKAGE_URI.rels_uri.membername, package.rels.xml),
+    ]
+    for part in parts:
+        entries.append((part.partname.membername, part.blob))
+        if len(part.rels):
+            entries.append((part.partname.rels_uri.membername, part.rels.xml))
+    return entries
+
+
+class SourcePackage:
+    """
+    Исходный пакет, из которого можно брать неизменённые части сжатыми байтами.
+
+    pristine — содержимое частей исходного пакета в сериализации python-docx (см. `package_entries`):
+    XML шаблона после разбора и сериализации отличается от байтов Word, поэтому для шаблона
+    сравнение идёт с ним. Без pristine часть считается неизменённой, если совпадает с исходной
+    записью zip байт в байт.
+    """
+
+    def __init__(self, data: bytes, pristine: Optional[dict[str, bytes]] = None):
+        self._data = data
+        self._pristine = pristine or {}
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self._members = {info.filename: info for info in zf.infolist()}
+
+    @classmethod
+    def from_document(cls, data: bytes, document) -> "SourcePackage":
+        """
+        Пакет, разобранный в `document` и ещё не изменённый.
+        """
+        return cls(data, dict(package_entries(document)))
+
+    def _raw(self, info: zipfile.ZipInfo) -> bytes:
+        header = _LOCAL_HEADER.unpack_from(self._data, info.header_offset)
+        name_len, extra_len = header[-2], header[-1]
+        start = info.header_offset + _LOCAL_HEADER.size + name_len + extra_len
+        return self._data[start:start + info.compress_size]
+
+    def unchanged_member(self, name: str, blob: bytes) -> Optional[tuple[zipfile.ZipInfo, bytes]]:
+        """
+        (ZipInfo, сжатые байты) исходной записи, если `blob` совпадает с ней, иначе None.
+        """
+        info = self._members.get(name)
+        if info is None or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return None
+        pristine = self._pristine.get(name)
+        if pristine is not None:
+            return (info, self._raw(info)) if blob == pristine else None
+
+        if len(blob) != info.file_size or zlib.crc32(blob) != info.CRC:
+            return None
+        raw = self._raw(info)
+        original = raw if info.compress_type == zipfile.ZIP_STORED else zlib.decompress(raw, -15)
+        return (info, raw) if original == blob else None
+
+
+def _write_raw(zf: zipfile.ZipFile, info: zipfile.ZipInfo, raw: bytes) -> None:
+    """
+    Дописывает в архив запись со сжатыми данными `raw` без перепаковки.
+
+    У zipfile нет публичного API для записи уже сжатых данных, поэтому здесь (и только здесь)
+    используются его внутренние поля: fp, filelist, NameToInfo, start_dir, _didModify
+    (CPython 3.8+). Если они изменятся, `write_package` перепишет пакет обычным writestr.
+    """
+    zinfo = copy.copy(info)
+    # Размеры и CRC известны заранее: дескриптор данных после записи не нужен
+    zinfo.flag_bits &= ~_DATA_DESCRIPTOR_FLAG
+    zinfo.extra = b""
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+    zf.fp.write(raw)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+    zf._didModify = True
+
+
+def _write_entries(
+    target: Union[str, IO[bytes]],
+    entries: list[tuple[str, bytes]],
+    source: Optional[SourcePackage],
+    compresslevel: int,
+) -> int:
+    """
+    Записывает части в zip; возвращает, сколько из них скопировано из `source` без перепаковки.
+    """
+    copied = 0
+    with zipfile.ZipFile(target, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+        for name, blob in entries:
+            member = source.unchanged_member(name, blob) if source is not None else None
+            if member is not None:
+                _write_raw(zf, *member)
+                copied += 1
+            else:
+                zf.writestr(name, blob)
+    return copied
+
+
+def write_package(
+    document,
+    target: Union[str, IO[bytes]],
+    source: Optional[SourcePackage] = None,
+    compresslevel: int = DOCX_COMPRESS_LEVEL,
+) -> None:
+    """
+    Записывает документ python-docx в `target` (путь или файловый объект).
+    Части, не изменившиеся относительно `source`, копируются из него сжатыми байтами;
+    если это не удалось, пакет записывается заново с перепаковкой всех частей.
+    """
+    started = time.perf_counter()
+    entries = package_entries(document)
+    if source is None or not DOCX_RAW_COPY_ENABLED:
+        copied = _write_entries(target, entries, None, compresslevel)
+    else:
+        # Файловый объект при повторной записи обрезается до исходной позиции, путь — перезаписывается
+        start = target.tell() if hasattr(target, "write") else None
+        try:
+            copied = _write_entries(target, entries, source, compresslevel)
+        except Exception as e:
+            print(f"Не удалось скопировать части .docx без перепаковки ({e}), пакет записывается заново")
+            metrics.inc("docx_raw_copy_failed")
+            if start is not None:
+                target.seek(start)
+                target.truncate()
+            copied = _write_entries(target, entries, None, compresslevel)
+
+    metrics.inc("docx_parts_copied", copied)
+    metrics.inc("docx_parts_compressed", len(entries) - copied)
+    metrics.observe("docx_save_seconds", time.perf_counter() - started)
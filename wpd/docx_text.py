@@ -0,0 +1,29 @@
+"""
+Извлечение текста из уже открытого DOCX документа (python-docx).
+"""
+
+from __future__ import annotations
+
+
+def extract_docx_text(doc) -> str:
+    """
+    Собирает текст документа: непустые параграфы, затем строки таблиц (ячейки через " | ").
+    """
+    text_parts = []
+
+    # Извлекаем текст из параграфов
+    for paragraph in doc.paragraphs:
+        if paragraph.text.strip():
+            text_parts.append(paragraph.text)
+
+    # Извлекаем текст из таблиц
+    for table in doc.tables:
+        for row in table.rows:
+            row_text = []
+            for cell in row.cells:
+                if cell.text.strip():
+                    row_text.append(cell.text.strip())
+            if row_text:
+                text_parts.append(" | ".join(row_text))
+
+    return "\n".join(text_parts) if text_parts else ""
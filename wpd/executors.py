@@ -0,0 +1,192 @@
+"""
+Пулы для блокирующей работы и замер задержки event loop.
+
+Чтение и разбор файлов, SQLite, рендер и сохранение docx — синхронная работа: вызванная прямо
+из корутины, она останавливает весь event loop (другие задания, /download, healthcheck на /).
+
+- `run_blocking` выполняет функцию в общем пуле потоков ограниченного размера (BLOCKING_POOL_SIZE),
+  с contextvars вызывающей задачи (этап задания, учёт токенов).
+- `build_document` (рендер шаблона, заполнение таблиц, сохранение) выполняется в пуле процессов
+  (RENDER_PROCESSES; 0 — в пуле потоков): рендер упирается в CPU и GIL, а в процессе-воркере
+  шаблон уже скомпилирован при его запуске.
+- `monitor_loop_lag` раз в LOOP_LAG_INTERVAL секунд меряет, насколько event loop опаздывает
+  с пробуждением, и пишет это в метрики (event_loop_lag_seconds_<имя loop'а>).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Sequence, TypeVar
+
+from wpd import metrics
+
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "4"))
+# Процессы для рендера документов (0 — рендер в пуле потоков, без отдельных процессов)
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", "1"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+T = TypeVar("T")
+
+_blocking_pool = ThreadPoolExecutor(max_workers=max(1, BLOCKING_POOL_SIZE), thread_name_prefix="wpd-blocking")
+
+
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Выполняет синхронную функцию в пуле потоков, не блокируя event loop.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    submitted = time.perf_counter()
+
+    def _call():
+        # Время ожидания свободного потока: если растёт, пул мал для нагрузки
+        metrics.observe("blocking_pool_wait_seconds", time.perf_counter() - submitted)
+        return ctx.run(func, *args, **kwargs)
+
+    return await loop.run_in_executor(_blocking_pool, _call)
+
+
+# --- рендер в пуле процессов ---
+
+_render_pool: Optional[ProcessPoolExecutor] = None
+_render_lock = threading.Lock()
+
+
+def _init_render_process(template_path: str) -> None:
+    # Разбор и компиляция шаблона при запуске процесса, а не на первом задании
+    from wpd.compiled_template import COMPILED_TEMPLATES_AVAILABLE, get_compiled_template
+
+    if not COMPILED_TEMPLATES_AVAILABLE:
+        return
+    try:
+        get_compiled_template(template_path)
+    except Exception as e:
+        print(f"Процесс рендера: не удалось подготовить шаблон {template_path}: {e}")
+
+
+def _build_document(
+    template_path: str,
+    all_variables: dict[str, str],
+    fills: Sequence[dict],
+    result_path: str,
+) -> tuple[str, dict[str, float]]:
+    """
+    Рендерит шаблон, заполняет таблицы и сохраняет результат.
+    Возвращает путь сохранённого файла и прирост счётчиков метрик (в процессе-воркере они свои).
+    """
+    from wpd.document_session import DocumentSession
+
+    before = metrics.snapshot()["counters"]
+    session = DocumentSession.from_template({}, template_path, all_variables=all_variables)
+    if fills:
+        session.fill_tables(fills)
+    saved_path = session.save(result_path)
+    after = metrics.snapshot()["counters"]
+    return saved_path, {name: value - before.get(name, 0.0) for name, value in after.items() if value != before.get(name)}
+
+
+def _build_document_locally(template_path, all_variables, fills, result_path) -> str:
+    return _build_document(template_path, all_variables, fills, result_path)[0]
+
+
+def start_render_pool(template_path: str) -> None:
+    """
+    Запускает процессы рендера с предзагруженным шаблоном (повторный вызов ничего не делает).
+    """
+    global _render_pool
+    if RENDER_PROCESSES <= 0:
+        return
+    with _render_lock:
+        if _render_pool is not None:
+            return
+        # spawn: процесс запускается начисто, без копии потоков и соединений веб-сервера
+        _render_pool = ProcessPoolExecutor(
+            max_workers=RENDER_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_render_process,
+            initargs=(template_path,),
+        )
+        # Процессы стартуют по первой задаче — запускаем их сразу, чтобы шаблон был готов к первому заданию
+        for _ in range(RENDER_PROCESSES):
+            _render_pool.submit(os.getpid)
+    print(f"Пул рендера запущен: процессов {RENDER_PROCESSES}, шаблон {template_path}")
+
+
+def _reset_render_pool(pool: ProcessPoolExecutor) -> None:
+    global _render_pool
+    with _render_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def build_document(
+    template_path: str,
+    all_variables: dict[str, str],
+    fills: Sequence[dict],
+    result_path: str,
+) -> str:
+    """
+    Рендер шаблона с переменными, заполнение таблиц (fills — как у `DocumentSession.fill_tables`)
+    и сохранение в `result_path` вне event loop. Возвращает путь, по которому файл реально сохранён.
+    """
+    started = time.perf_counter()
+    if RENDER_PROCESSES > 0:
+        start_render_pool(template_path)
+    pool = _render_pool
+    if pool is not None:
+        loop = asyncio.get_running_loop()
+        try:
+            saved_path, counters = await loop.run_in_executor(
+                pool, _build_document, template_path, all_variables, list(fills), result_path
+            )
+        except BrokenProcessPool as e:
+            # Процесс рендера упал (например, по памяти): пул пересоздаётся при следующем вызове
+            print(f"Пул рендера недоступен, рендер в потоке: {e}")
+            _reset_render_pool(pool)
+            saved_path = await run_blocking(_build_document_locally, template_path, all_variables, fills, result_path)
+        else:
+            for name, value in counters.items():
+                metrics.inc(name, value)
+    else:
+        saved_path = await run_blocking(_build_document_locally, template_path, all_variables, fills, result_path)
+    metrics.observe("document_build_seconds", time.perf_counter() - started)
+    return saved_path
+
+
+def shutdown_render_pool() -> None:
+    global _render_pool
+    with _render_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# --- задержка event loop ---
+
+async def monitor_loop_lag(name: str, interval: float = LOOP_LAG_INTERVAL) -> None:
+    """
+    Бесконечно меряет задержку пробуждения текущего event loop: если корутина просила спать
+    `interval` секунд, а проснулась позже, loop всё это время был занят синхронной работой.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        metrics.set_gauge(f"event_loop_lag_seconds_{name}", lag)
+        metrics.observe(f"event_loop_lag_seconds_{name}", lag)
+
+
+def start_loop_lag_monitor(name: str) -> asyncio.Task:
+    """
+    Запускает `monitor_loop_lag` фоновой задачей в текущем event loop.
+    """
+    return asyncio.get_running_loop().create_task(monitor_loop_lag(name), name=f"loop-lag-{name}")
@@ -6,9 +6,11 @@ from typing import List, Optional, Sequence
 
 from docx import Document
 
-from wpd.request_api import client, read_file_content, DEFAULT_CHAT_STORE, _load_chat_messages, _save_chat_messages
+from wpd.document_session import DocumentSession
+from wpd.llm_client import stream_chat_completion
+from wpd.stream_sinks import PrintSink
+from wpd.request_api import read_file_content, DEFAULT_CHAT_STORE, _load_chat_messages, _save_chat_messages
 import os
-from pathlib import Path
 
 
 def find_table_index_by_headers(
@@ -117,62 +119,24 @@ def fill_table_row_major(
     - и т.д.
     - если строк не хватает — добавляем строки
     """
-    doc = Document(result_docx_path)
-    if table_index >= len(doc.tables):
-        raise ValueError(
-            f"В документе {result_docx_path} нет таблицы с индексом {table_index}. "
-            f"Доступно таблиц: {len(doc.tables)}"
-        )
-
-    table = doc.tables[table_index]
-    if cols_per_row <= 0:
-        raise ValueError("cols_per_row должен быть > 0")
-    if start_row < 0 or start_col < 0:
-        raise ValueError("start_row и start_col должны быть >= 0")
-    if len(table.rows) == 0:
-        raise ValueError("Таблица пуста (нет строк).")
-    
-    # Используем максимальное количество ячеек в строке вместо len(table.columns)
-    # для корректной работы с объединенными ячейками
-    max_row_cells = max((len(r.cells) for r in table.rows), default=0)
-    if max_row_cells == 0:
-        raise ValueError("Таблица пуста (нет ячеек).")
-    if start_col + cols_per_row > max_row_cells:
-        raise ValueError(
-            f"Недостаточно колонок: нужно минимум {start_col + cols_per_row}, "
-            f"а в таблице максимум {max_row_cells} ячеек в строке."
-        )
+    session = DocumentSession.open(result_docx_path)
+    session.fill_table(values, table_index, cols_per_row, start_row, start_col)
+    return session.save(result_docx_path)
 
-    # гарантируем, что строк хватит
-    needed_rows = start_row + ((len(values) + cols_per_row - 1) // cols_per_row)
-    while len(table.rows) < needed_rows:
-        table.add_row()
 
-    for idx, value in enumerate(values):
-        r = start_row + (idx // cols_per_row)
-        c = start_col + (idx % cols_per_row)
-        table.rows[r].cells[c].text = str(value)
+def fill_tables_row_major(result_docx_path: str, fills: Sequence[dict]) -> str:
+    """
+    Заполняет несколько таблиц за один проход: документ открывается и сохраняется один раз.
 
-    # На Windows docx часто блокируется Word'ом. Если нельзя перезаписать файл —
-    # сохраняем рядом под новым именем.
-    try:
-        doc.save(result_docx_path)
-        return result_docx_path
-    except PermissionError:
-        p = Path(result_docx_path)
-        alt = p.with_name(f"{p.stem}_filled{p.suffix}")
-        if alt.exists():
-            import uuid as _uuid
-            alt = p.with_name(f"{p.stem}_filled_{str(_uuid.uuid4())[:8]}{p.suffix}")
-        doc.save(str(alt))
-        print(
-            f"Не удалось перезаписать '{result_docx_path}' (файл, вероятно, открыт). "
-            f"Сохранил результат в '{alt.name}'. Закройте Word и запустите снова, если нужно перезаписать исходный файл."
-        )
-        return str(alt)
+    fills — список словарей с ключами как у `fill_table_row_major`:
+      {"values": [...], "table_index": 5, "cols_per_row": 3, "start_row": 1, "start_col": 0}
+    """
+    session = DocumentSession.open(result_docx_path)
+    session.fill_tables(fills)
+    return session.save(result_docx_path)
 
 
-def fill_result_table_from_perplexity(
+async def fill_result_table_from_perplexity(
     result_docx_path: str = "result.docx",
     model: str = "sonar",
     thread_id: Optional[str] = "7b33ace1-39ff-4ab1-aa21-29e796bff58a",
@@ -218,27 +182,14 @@ def fill_result_table_from_perplexity(
         }
     )
 
-    stream = client.chat.completions.create(
+    print("Получение списка значений от API...")
+    answer_text, completion_id = await stream_chat_completion(
+        messages,
         model=model,
-        messages=messages,
         temperature=0.2,
-        stream=True,
+        sinks=[PrintSink()],
     )
-
-    completion_id = None
-    answer_text = ""
-    print("Получение списка значений от API...")
-    for chunk in stream:
-        if completion_id is None and hasattr(chunk, "id") and chunk.id:
-            completion_id = chunk.id
-            print(f"COMPLETION_ID: {completion_id}")
-        if getattr(chunk, "choices", None) and len(chunk.choices) > 0:
-            delta = chunk.choices[0].delta
-            content = getattr(delta, "content", None)
-            if content:
-                answer_text += content
-                print(content, end="", flush=True)
-    print()
+    print(f"COMPLETION_ID: {completion_id}")
 
     print("\n--- RAW_TABLE_RESPONSE (first 500 chars) ---")
     print(answer_text[:500])
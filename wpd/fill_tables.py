@@ -1,14 +1,25 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import os
 import re
 from typing import List, Optional, Sequence
 
-from docx import Document
+from wpd.json_stream import JsonArrayStreamParser
+from wpd.llm_client import stream_chat_completion
+from wpd.stream_sinks import IncrementalParseSink
+from wpd import retrieval
+from wpd.request_api import DEFAULT_CHAT_STORE, _load_chat_messages, _save_chat_messages, load_source_text
+from wpd.document_session import DocumentSession
+from wpd.executors import run_blocking
+from wpd.job_queue import emit, set_stage
 
-from wpd.request_api import DEFAULT_CHAT_STORE, _load_chat_messages, _save_chat_messages, client
-from wpd.fill_result_table import fill_table_row_major
+# Верхняя граница одновременных запросов по таблицам в одном задании (1 — последовательно, как раньше).
+# Фактическое число запросов в полёте регулирует общий адаптивный лимит (wpd/concurrency.py).
+TABLE_FILL_CONCURRENCY = int(os.getenv("TABLE_FILL_CONCURRENCY", "8"))
+# Режим запросов по таблицам: "per_table" (запрос на таблицу) или "single_call" (все таблицы одним запросом)
+TABLE_FILL_MODE = os.getenv("TABLE_FILL_MODE", "per_table").strip().lower()
 
 
 def _to_zero_based_table_index(table_index: int, index_base: int, table_index_offset: int = 0) -> int:
@@ -84,6 +95,20 @@ def _normalize_messages(messages: list[dict]) -> list[dict]:
     return systems + merged
 
 
+def _flatten_values(obj: list) -> List[str]:
+    """
+    list[str] или list[list[str]] -> плоский список строк.
+    Пустые значения сохраняются (они задают позицию ячейки).
+    """
+    flat: list[str] = []
+    for x in obj:
+        if isinstance(x, list):
+            flat.extend(str(v).strip() if v is not None else "" for v in x)
+        else:
+            flat.append(str(x).strip() if x is not None else "")
+    return flat
+
+
 def _extract_values_from_ai_response(text: str) -> List[str]:
     """
     Универсальный парсер для "значений таблицы" из ответа ИИ.
@@ -108,15 +133,7 @@ def _extract_values_from_ai_response(text: str) -> List[str]:
         obj = json.loads(s)
         if isinstance(obj, list):
             # list[str] или list[list[str]] -> flatten
-            flat: list[str] = []
-            for x in obj:
-                if isinstance(x, list):
-                    # Сохраняем все значения, включая пустые
-                    flat.extend(str(v).strip() if v is not None else "" for v in x)
-                else:
-                    # Сохраняем значение, включая пустое
-                    flat.append(str(x).strip() if x is not None else "")
-            return flat  # Возвращаем все значения, включая пустые
+            return _flatten_values(obj)
     except Exception:
         pass
 
@@ -126,15 +143,7 @@ def _extract_values_from_ai_response(text: str) -> List[str]:
         try:
             obj = json.loads(m.group(0))
             if isinstance(obj, list):
-                flat: list[str] = []
-                for x in obj:
-                    if isinstance(x, list):
-                        # Сохраняем все значения, включая пустые
-                        flat.extend(str(v).strip() if v is not None else "" for v in x)
-                    else:
-                        # Сохраняем значение, включая пустое
-                        flat.append(str(x).strip() if x is not None else "")
-                return flat  # Возвращаем все значения, включая пустые
+                return _flatten_values(obj)
         except Exception:
             pass
 
@@ -164,7 +173,138 @@ def _extract_values_from_ai_response(text: str) -> List[str]:
     return [s] if s else []
 
 
-def fill_one_table_from_perplexity(
+def _load_base_messages(thread_id: Optional[str], store_path: str) -> list[dict]:
+    """
+    Загружает и нормализует историю чата — базовый контекст для запросов по таблицам.
+    """
+    if not thread_id:
+        raise ValueError("Нужно передать thread_id (CHAT_ID), чтобы модель имела контекст предыдущих файлов/сообщений.")
+
+    messages = _load_chat_messages(thread_id, store_path=store_path)
+    if not messages:
+        raise ValueError(
+            f"История чата пуста для CHAT_ID={thread_id}. "
+            "Сначала запустите шаг, который загружает шаблон/материалы в чат."
+        )
+
+    # Нормализуем историю, чтобы Perplexity не ругался на порядок ролей (400 invalid_message)
+    return _normalize_messages(messages)
+
+
+def _with_prompt(messages: list[dict], prompt: str) -> list[dict]:
+    """
+    Возвращает копию истории с добавленным промптом (исходный список не меняется).
+    """
+    messages = [dict(m) for m in messages]
+
+    # Добавляем новый промпт: если последний user — дописываем, иначе добавляем новым user
+    if messages and messages[-1]["role"] == "user":
+        prev = messages[-1]["content"].strip()
+        messages[-1]["content"] = f"{prev}\n\n{prompt}" if prev else prompt
+    else:
+        messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def _table_chat_id(thread_id: str, table_index: int) -> str:
+    """
+    CHAT_ID, под которым хранится промпт и ответ по одной таблице.
+
+    Ответы по таблицам не дописываются в основной чат: иначе каждая следующая таблица
+    отправляла бы заново все предыдущие (рост входных токенов квадратичный по числу таблиц).
+    """
+    return f"{thread_id}:table:{table_index}"
+
+
+def _save_table_answer(thread_id: str, table_index: int, prompt: str, answer_text: str, store_path: str) -> None:
+    _save_chat_messages(
+        _table_chat_id(thread_id, table_index),
+        [{"role": "user", "content": prompt}, {"role": "assistant", "content": answer_text}],
+        store_path=store_path,
+    )
+
+
+def _load_table_answer(thread_id: str, table_index: int, store_path: str) -> Optional[str]:
+    """
+    Последний сохранённый ответ модели по таблице (или None, если таблица ещё не заполнялась).
+    """
+    for m in reversed(_load_chat_messages(_table_chat_id(thread_id, table_index), store_path=store_path)):
+        if m.get("role") == "assistant":
+            return _stringify_content(m.get("content"))
+    return None
+
+
+def _materials_excerpt(source_text: Optional[str], queries: Sequence[str]) -> str:
+    """
+    Фрагменты материалов под промпт(ы) таблиц — только если материалы не поместились в основной чат целиком.
+    """
+    if not source_text:
+        return ""
+    excerpt = retrieval.select_context(source_text, queries)
+    return f"Фрагменты учебных материалов, относящиеся к этому заданию:\n{excerpt}\n\n"
+
+
+def _build_table_messages(
+    base_messages: list[dict],
+    prompt: str,
+    dependency_answers: Optional[dict[int, str]] = None,
+    source_text: Optional[str] = None,
+) -> list[dict]:
+    """
+    Сообщения для запроса по таблице: базовый контекст (шаблон + материалы + ответ по переменным)
+    и промпт таблицы. Ответы по другим таблицам добавляются, только если таблица от них зависит.
+    Если материалы большие (source_text), к промпту добавляются фрагменты, найденные по самому промпту.
+    """
+    prompt = _materials_excerpt(source_text, [prompt]) + prompt
+    if dependency_answers:
+        context = "\n\n".join(
+            f"Ранее ты уже заполнил Таблицу {dep_index}, твой ответ был:\n{answer}"
+            for dep_index, answer in dependency_answers.items()
+        )
+        prompt = f"{context}\n\n{prompt}"
+    return _with_prompt(base_messages, prompt)
+
+
+async def _request_table_values(
+    messages: list[dict],
+    *,
+    table_index: int,
+    model: str,
+) -> tuple[str, List[str]]:
+    """
+    Отправляет запрос по одной таблице и парсит значения из ответа.
+
+    JSON-массив разбирается по мере поступления (wpd/json_stream.py): как только он закрылся,
+    поток больше не читается. Значения пишутся в документ после закрытия массива, при рендере задания.
+    Если массив в потоке не найден, ответ разбирается целиком (_extract_values_from_ai_response).
+
+    Returns:
+        (answer_text, values)
+    """
+    parser = JsonArrayStreamParser()
+    parse_sink = IncrementalParseSink(parser, stop_on_done=True)
+    # Отправляем запрос точно так же, как в call_api_in_one
+    answer_text, _completion_id = await stream_chat_completion(
+        messages,
+        model=model,
+        temperature=0.2,
+        label=f" для таблицы {table_index}",
+        sinks=[parse_sink],
+        allow_partial=True,
+        hedge_group="table",
+    )
+
+    # Парсим значения из ответа ИИ
+    if parser.done and parse_sink.items:
+        values = _flatten_values(parse_sink.items)
+    else:
+        values = _extract_values_from_ai_response(answer_text)
+    if not values:
+        raise ValueError(f"Не удалось распарсить значения из ответа ИИ для таблицы {table_index} (ожидался JSON-массив). Ответ был: {answer_text[:200]}...")
+    return answer_text, values
+
+
+async def fill_one_table_from_perplexity(
     *,
     result_docx_path: str,
     table_index: int,
@@ -177,6 +317,8 @@ def fill_one_table_from_perplexity(
     store_path: str = DEFAULT_CHAT_STORE,
     index_base: int = 1,
     table_index_offset: int = 0,
+    depends_on: Sequence[int] = (),
+    session: Optional[DocumentSession] = None,
 ) -> List[str]:
     """
     Универсальная функция для заполнения ОДНОЙ таблицы.
@@ -186,81 +328,33 @@ def fill_one_table_from_perplexity(
     - cols_per_row: количество колонок (ширина области заполнения)
     - start_row/start_col: стартовая точка (например 1:0 если 0-я строка — заголовки)
     - prompt: промпт (передаётся снаружи)
+    - depends_on: номера таблиц, ответы по которым нужно показать модели
+    - session: документ задания в памяти; если передан, таблица заполняется в нём без сохранения
+      (сохраняет вызывающий), иначе result_docx_path открывается и сохраняется один раз
 
     Важно: Perplexity Chat Completions контекст держит только через `messages`,
     поэтому мы используем `thread_id` как локальный CHAT_ID для загрузки истории.
+    Запрос строится из истории основного чата и промпта таблицы; ответ сохраняется
+    в отдельный чат таблицы (см. `_table_chat_id`).
     """
-    if not os.path.exists(result_docx_path):
+    if session is None and not os.path.exists(result_docx_path):
         raise ValueError(f"Файл результата не найден: {result_docx_path}")
-    if not thread_id:
-        raise ValueError("Нужно передать thread_id (CHAT_ID), чтобы модель имела контекст предыдущих файлов/сообщений.")
-
-    messages = _load_chat_messages(thread_id, store_path=store_path)
-    if not messages:
-        raise ValueError(
-            f"История чата пуста для CHAT_ID={thread_id}. "
-            "Сначала запустите шаг, который загружает шаблон/материалы в чат."
-        )
-
-    # Нормализуем историю, чтобы Perplexity не ругался на порядок ролей (400 invalid_message)
-    messages = _normalize_messages(messages)
 
-    # Добавляем новый промпт: если последний user — дописываем, иначе добавляем новым user
-    if messages and messages[-1]["role"] == "user":
-        prev = messages[-1]["content"].strip()
-        messages[-1]["content"] = f"{prev}\n\n{prompt}" if prev else prompt
-    else:
-        messages.append({"role": "user", "content": prompt})
+    # История чата (SQLite) и отбор фрагментов материалов — синхронная работа, она идёт в пуле потоков
+    base_messages = await run_blocking(_load_base_messages, thread_id, store_path)
+    dependency_answers = {}
+    for dep_index in depends_on:
+        answer = await run_blocking(_load_table_answer, thread_id, dep_index, store_path)
+        if answer is not None:
+            dependency_answers[dep_index] = answer
+    source_text = await run_blocking(load_source_text, thread_id, store_path=store_path)
+    messages = await run_blocking(_build_table_messages, base_messages, prompt, dependency_answers, source_text)
 
     # Минимальное логирование для оптимизации
     print(f"\n=== TABLE {table_index} (start {start_row}:{start_col}, cols {cols_per_row}) ===")
     print(f"История чата: {len(messages)} сообщений")
-    
-    # Отправляем запрос точно так же, как в call_api_in_one
-    stream_params = {
-        "model": model,
-        "messages": messages,
-        "temperature": 0.2,
-        "stream": True
-    }
-    
-    try:
-        stream = client.chat.completions.create(**stream_params)
-    except Exception as api_error:
-        error_msg = str(api_error)
-        print(f"ОШИБКА при запросе к API для таблицы {table_index}: {error_msg}")
-        import traceback
-        traceback.print_exc()
-        if "api_key" in error_msg.lower() or "authentication" in error_msg.lower() or "401" in error_msg:
-            raise ValueError(
-                f"Ошибка аутентификации API для таблицы {table_index}: Проверьте что PPLX_API_KEY установлен правильно. "
-                f"Детали: {error_msg}"
-            )
-        elif "connection" in error_msg.lower() or "timeout" in error_msg.lower() or "network" in error_msg.lower():
-            raise ConnectionError(
-                f"Ошибка подключения к Perplexity API для таблицы {table_index}: {error_msg}. "
-                f"Проверьте интернет-соединение и доступность api.perplexity.ai"
-            )
-        else:
-            raise Exception(f"Ошибка при запросе к API для таблицы {table_index}: {error_msg}")
 
-    completion_id = None
-    answer_text = ""
-    
-    try:
-        for chunk in stream:
-            if completion_id is None and hasattr(chunk, "id") and chunk.id:
-                completion_id = chunk.id
-                
-            if getattr(chunk, "choices", None) and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                content = getattr(delta, "content", None)
-                if content:
-                    answer_text += content
-    except Exception as stream_error:
-        error_msg = str(stream_error)
-        if not answer_text:
-            raise Exception(f"Не удалось получить ответ от API для таблицы {table_index}: {error_msg}")
+    answer_text, values = await _request_table_values(messages, table_index=table_index, model=model)
 
     # Преобразуем номер таблицы из вашей схемы (1-based) в python-docx индекс (0-based)
     doc_table_index = _to_zero_based_table_index(
@@ -269,47 +363,273 @@ def fill_one_table_from_perplexity(
         table_index_offset=table_index_offset,
     )
 
-    # Диагностика: какая таблица реально будет изменена и сколько колонок она имеет по мнению python-docx
+    # Диагностика: какая таблица реально будет изменена (по документу в памяти, без повторного открытия файла)
+    owns_session = session is None
+    if owns_session:
+        session = await run_blocking(DocumentSession.open, result_docx_path)
     try:
-        d = Document(result_docx_path)
-        if doc_table_index < 0 or doc_table_index >= len(d.tables):
-            raise ValueError(
-                f"table_index={table_index} (index_base={index_base}) -> doc_index={doc_table_index} вне диапазона. "
-                f"Всего таблиц в документе: {len(d.tables)}"
-            )
-        t = d.tables[doc_table_index]
-        max_cells = max((len(r.cells) for r in t.rows), default=0)
-        header = " | ".join(c.text.strip() for c in (t.rows[0].cells if t.rows else []))[:120]
         print(
             f"[TABLE] table_index={table_index} (base={index_base}, offset={table_index_offset}) -> doc_index={doc_table_index}; "
-            f"rows={len(t.rows)} len(columns)={len(t.columns)} max_row_cells={max_cells}; header='{header}'"
+            f"{session.describe_table(doc_table_index)}"
+        )
+    except ValueError as e:
+        print(f"[TABLE] table_index={table_index} (index_base={index_base}): {e}")
+
+    # Сохраняем ответ в чат таблицы (основной чат остаётся базовым контекстом)
+    await run_blocking(_save_table_answer, thread_id, table_index, prompt, answer_text, store_path)
+
+    # заполняем таблицу (ВАЖНО: table_index здесь уже doc_index)
+    await run_blocking(session.fill_table, values, doc_table_index, cols_per_row, start_row, start_col)
+    if owns_session:
+        await run_blocking(session.save, result_docx_path)
+    return values
+
+
+async def request_tables_concurrently(
+    *,
+    table_indices: Sequence[int],
+    prompts: Sequence[str],
+    model: str = "sonar",
+    thread_id: Optional[str],
+    store_path: str = DEFAULT_CHAT_STORE,
+    max_concurrency: int = TABLE_FILL_CONCURRENCY,
+    depends_on_list: Optional[Sequence[Sequence[int]]] = None,
+) -> List[List[str]]:
+    """
+    Запрашивает значения для нескольких таблиц параллельно (не более `max_concurrency` запросов одновременно).
+
+    Все запросы строятся от одного снимка основного чата (шаблон + материалы + ответ по переменным).
+    Если таблица зависит от другой (depends_on_list[i]), она ждёт ответ этой таблицы, когда та стоит
+    раньше в списке, иначе берёт сохранённый ранее ответ. Ответ каждой таблицы сохраняется в её чат.
+
+    Returns:
+        списки значений в том же порядке, что и table_indices
+    """
+    if len(table_indices) != len(prompts):
+        raise ValueError("Длины списков table_indices / prompts должны совпадать.")
+    if depends_on_list is None:
+        depends_on_list = [()] * len(table_indices)
+    if len(depends_on_list) != len(table_indices):
+        raise ValueError("Длины списков table_indices / depends_on_list должны совпадать.")
+
+    base_messages = await run_blocking(_load_base_messages, thread_id, store_path)
+    source_text = await run_blocking(load_source_text, thread_id, store_path=store_path)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    position = {table_index: i for i, table_index in enumerate(table_indices)}
+    tasks: list[asyncio.Task] = []
+    done = 0
+    print(f"Параллельное заполнение {len(table_indices)} таблиц (одновременно: {max(1, max_concurrency)})")
+
+    async def _one(i: int) -> tuple[str, List[str]]:
+        nonlocal done
+        # Зависимости ждём до захвата слота семафора, чтобы не занимать его впустую
+        dependency_answers = {}
+        for dep_index in depends_on_list[i]:
+            dep_pos = position.get(dep_index)
+            if dep_pos is not None and dep_pos < i:
+                dependency_answers[dep_index] = (await tasks[dep_pos])[0]
+            else:
+                answer = await run_blocking(_load_table_answer, thread_id, dep_index, store_path)
+                if answer is not None:
+                    dependency_answers[dep_index] = answer
+
+        async with semaphore:
+            print(f"\n=== TABLE {table_indices[i]} (параллельно) ===")
+            messages = await run_blocking(_build_table_messages, base_messages, prompts[i], dependency_answers, source_text)
+            answer_text, values = await _request_table_values(messages, table_index=table_indices[i], model=model)
+        await run_blocking(_save_table_answer, thread_id, table_indices[i], prompts[i], answer_text, store_path)
+        done += 1
+        # Номер готовой таблицы фиксируется до await: пока пишется этап, могут завершиться другие
+        finished = done
+        emit("table", table_index=table_indices[i], done=finished, total=len(table_indices), values=len(values))
+        await set_stage("tables", f"таблица {table_indices[i]} готова ({finished} из {len(table_indices)})")
+        return answer_text, values
+
+    tasks.extend(asyncio.create_task(_one(i)) for i in range(len(table_indices)))
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # Одна таблица упала — остальные запросы больше не нужны
+        for task in tasks:
+            task.cancel()
+        raise
+
+    return [values for _answer, values in results]
+
+
+def _build_multi_table_prompt(table_indices: Sequence[int], prompts: Sequence[str]) -> str:
+    """
+    Собирает один промпт на все таблицы: ответ ожидается JSON-объектом {table_index: [значения]}.
+    """
+    sections = []
+    for table_index, prompt in zip(table_indices, prompts):
+        sections.append(f"### Таблица {table_index}\n{prompt}")
+
+    keys = ", ".join(f'"{i}"' for i in table_indices)
+    return (
+        "Сейчас нужно заполнить сразу несколько таблиц. Ниже для каждой таблицы дано отдельное задание "
+        "(заголовок '### Таблица N'). Выполни каждое задание по его правилам, но верни ОДИН JSON-объект, "
+        "где ключ — номер таблицы N (строкой), а значение — JSON-список значений этой таблицы "
+        "ровно в том формате, который требует её задание. "
+        f"Ключи объекта: {keys}. "
+        "Никакого текста до и после JSON-объекта.\n\n"
+        + "\n\n".join(sections)
+    )
+
+
+def _parse_multi_table_response(text: str, table_indices: Sequence[int]) -> dict[int, List[str]]:
+    """
+    Разбирает ответ вида {"1": [...], "2": [...]} в {table_index: values}.
+
+    Таблицы, которых нет в ответе или чьё значение не удалось разобрать, в результат не попадают.
+    """
+    if not text:
+        return {}
+
+    s = text.strip()
+    obj = None
+    try:
+        obj = json.loads(s)
+    except Exception:
+        m = re.search(r"\{[\s\S]*\}", s)
+        if m:
+            try:
+                obj = json.loads(m.group(0))
+            except Exception:
+                obj = None
+    if not isinstance(obj, dict):
+        return {}
+
+    wanted = {str(i): i for i in table_indices}
+    result: dict[int, List[str]] = {}
+    for key, value in obj.items():
+        table_index = wanted.get(str(key).strip())
+        if table_index is None:
+            continue
+        if isinstance(value, list):
+            values = _flatten_values(value)
+        elif isinstance(value, str):
+            values = _extract_values_from_ai_response(value)
+        else:
+            continue
+        if values:
+            result[table_index] = values
+    return result
+
+
+async def request_tables_single_call(
+    *,
+    table_indices: Sequence[int],
+    prompts: Sequence[str],
+    model: str = "sonar",
+    thread_id: Optional[str],
+    store_path: str = DEFAULT_CHAT_STORE,
+    max_concurrency: int = TABLE_FILL_CONCURRENCY,
+    depends_on_list: Optional[Sequence[Sequence[int]]] = None,
+) -> List[List[str]]:
+    """
+    Запрашивает значения для всех таблиц одним запросом (шаблон и материалы отправляются один раз).
+
+    Если какая-то таблица отсутствует в ответе или не разобралась, только для неё
+    делается отдельный запрос (см. `request_tables_concurrently`).
+
+    Returns:
+        списки значений в том же порядке, что и table_indices
+    """
+    if len(table_indices) != len(prompts):
+        raise ValueError("Длины списков table_indices / prompts должны совпадать.")
+
+    if depends_on_list is None:
+        depends_on_list = [()] * len(table_indices)
+
+    base_messages = await run_blocking(_load_base_messages, thread_id, store_path)
+    multi_prompt = _build_multi_table_prompt(table_indices, prompts)
+    # Бюджет фрагментов делится между таблицами (см. retrieval.select_context)
+    source_text = await run_blocking(load_source_text, thread_id, store_path=store_path)
+    multi_prompt = await run_blocking(_materials_excerpt, source_text, prompts) + multi_prompt
+    messages = _with_prompt(base_messages, multi_prompt)
+
+    print(f"\n=== TABLES {list(table_indices)} (одним запросом) ===")
+    await set_stage("tables", f"все таблицы одним запросом ({len(table_indices)})")
+    try:
+        answer_text, _completion_id = await stream_chat_completion(
+            messages,
+            model=model,
+            temperature=0.2,
+            label=f" для таблиц {list(table_indices)}",
+            allow_partial=True,
         )
     except Exception as e:
-        print(f"[TABLE] Не удалось прочитать структуру таблицы перед заполнением: {e}")
+        # Общий запрос не удался — все таблицы уходят в отдельные запросы
+        print(f"Запрос по всем таблицам не удался, заполняем по одной: {e}")
+        answer_text = ""
+
+    parsed = _parse_multi_table_response(answer_text, table_indices)
+    # Ответы раскладываем по чатам таблиц: на них могут опираться зависимые таблицы при откате
+    for i, table_index in enumerate(table_indices):
+        if table_index in parsed:
+            await run_blocking(
+                _save_table_answer,
+                thread_id, table_index, prompts[i], json.dumps(parsed[table_index], ensure_ascii=False), store_path
+            )
 
-    # Парсим значения из ответа ИИ
-    values = _extract_values_from_ai_response(answer_text)
-    if not values:
-        raise ValueError(f"Не удалось распарсить значения из ответа ИИ для таблицы {table_index} (ожидался JSON-массив). Ответ был: {answer_text[:200]}...")
+    for done, table_index in enumerate(parsed, 1):
+        emit("table", table_index=table_index, done=done, total=len(table_indices), values=len(parsed[table_index]))
+
+    missing = [i for i, table_index in enumerate(table_indices) if table_index not in parsed]
+    print(f"Получено таблиц одним запросом: {len(parsed)} из {len(table_indices)}")
+    if missing:
+        print(f"Отдельные запросы для таблиц: {[table_indices[i] for i in missing]}")
+        fallback_values = await request_tables_concurrently(
+            table_indices=[table_indices[i] for i in missing],
+            prompts=[prompts[i] for i in missing],
+            model=model,
+            thread_id=thread_id,
+            store_path=store_path,
+            max_concurrency=max_concurrency,
+            depends_on_list=[depends_on_list[i] for i in missing],
+        )
+        for i, values in zip(missing, fallback_values):
+            parsed[table_indices[i]] = values
 
-    # Сохраняем в историю (и сразу нормализуем, чтобы не копить "ломаную" последовательность)
-    messages.append({"role": "assistant", "content": answer_text})
-    messages = _normalize_messages(messages)
-    _save_chat_messages(thread_id, messages, store_path=store_path)
+    return [parsed[table_index] for table_index in table_indices]
 
-    # заполняем таблицу (ВАЖНО: table_index здесь уже doc_index)
-    fill_table_row_major(
-        result_docx_path=result_docx_path,
-        values=values,
-        table_index=doc_table_index,
-        cols_per_row=cols_per_row,
-        start_row=start_row,
-        start_col=start_col,
+
+async def request_tables_values(
+    *,
+    table_indices: Sequence[int],
+    prompts: Sequence[str],
+    model: str = "sonar",
+    thread_id: Optional[str],
+    store_path: str = DEFAULT_CHAT_STORE,
+    max_concurrency: int = TABLE_FILL_CONCURRENCY,
+    mode: str = TABLE_FILL_MODE,
+    depends_on_list: Optional[Sequence[Sequence[int]]] = None,
+) -> List[List[str]]:
+    """
+    Запрашивает значения для нескольких таблиц в выбранном режиме:
+    - "per_table": отдельный запрос на каждую таблицу (параллельно, до max_concurrency)
+    - "single_call": один запрос на все таблицы с откатом на отдельные запросы
+    """
+    if mode == "single_call":
+        request = request_tables_single_call
+    elif mode == "per_table":
+        request = request_tables_concurrently
+    else:
+        raise ValueError(f"Неизвестный режим заполнения таблиц: {mode} (ожидается 'per_table' или 'single_call')")
+
+    return await request(
+        table_indices=table_indices,
+        prompts=prompts,
+        model=model,
+        thread_id=thread_id,
+        store_path=store_path,
+        max_concurrency=max_concurrency,
+        depends_on_list=depends_on_list,
     )
-    return values
 
 
-def fill_tables_from_lists(
+async def fill_tables_from_lists(
     *,
     result_docx_path: str,
     table_indices: Sequence[int],
@@ -321,27 +641,77 @@ def fill_tables_from_lists(
     store_path: str = DEFAULT_CHAT_STORE,
     index_base: int = 1,
     table_index_offset: int = 0,
+    max_concurrency: int = 1,
+    mode: str = "per_table",
+    depends_on_list: Optional[Sequence[Sequence[int]]] = None,
+    session: Optional[DocumentSession] = None,
 ) -> None:
     """
     Вызов в цикле по параллельным спискам (как вы описали).
+
+    depends_on_list[i] — номера таблиц, ответы по которым нужны для таблицы i (см. TableFillSpec.depends_on).
+
+    При max_concurrency > 1 или mode="single_call" таблицы запрашиваются пакетно
+    (см. `request_tables_values`), а результат записывается в документ одним проходом.
+
+    session — документ задания в памяти: таблицы заполняются в нём, сохранение делает вызывающий.
+    Без session документ result_docx_path открывается и сохраняется один раз на весь вызов.
     """
     if not (len(table_indices) == len(cols_per_row_list) == len(start_coords) == len(prompts)):
         raise ValueError("Длины списков table_indices / cols_per_row_list / start_coords / prompts должны совпадать.")
+    if depends_on_list is None:
+        depends_on_list = [()] * len(table_indices)
 
-    for i in range(len(table_indices)):
-        r, c = start_coords[i]
-        fill_one_table_from_perplexity(
-            result_docx_path=result_docx_path,
-            table_index=table_indices[i],
-            cols_per_row=cols_per_row_list[i],
-            start_row=r,
-            start_col=c,
-            prompt=prompts[i],
+    if session is None and not os.path.exists(result_docx_path):
+        raise ValueError(f"Файл результата не найден: {result_docx_path}")
+    owns_session = session is None
+    if owns_session:
+        session = await run_blocking(DocumentSession.open, result_docx_path)
+
+    if max_concurrency > 1 or mode != "per_table":
+        values_list = await request_tables_values(
+            table_indices=table_indices,
+            prompts=prompts,
             model=model,
             thread_id=thread_id,
             store_path=store_path,
-            index_base=index_base,
-            table_index_offset=table_index_offset,
+            max_concurrency=max_concurrency,
+            mode=mode,
+            depends_on_list=depends_on_list,
         )
+        fills = []
+        for i, values in enumerate(values_list):
+            r, c = start_coords[i]
+            fills.append({
+                "values": values,
+                "table_index": _to_zero_based_table_index(
+                    table_indices[i],
+                    index_base=index_base,
+                    table_index_offset=table_index_offset,
+                ),
+                "cols_per_row": cols_per_row_list[i],
+                "start_row": r,
+                "start_col": c,
+            })
+        await run_blocking(session.fill_tables, fills)
+    else:
+        for i in range(len(table_indices)):
+            r, c = start_coords[i]
+            await fill_one_table_from_perplexity(
+                result_docx_path=result_docx_path,
+                table_index=table_indices[i],
+                cols_per_row=cols_per_row_list[i],
+                start_row=r,
+                start_col=c,
+                prompt=prompts[i],
+                model=model,
+                thread_id=thread_id,
+                store_path=store_path,
+                index_base=index_base,
+                table_index_offset=table_index_offset,
+                depends_on=depends_on_list[i],
+                session=session,
+            )
 
-
+    if owns_session:
+        await run_blocking(session.save, result_docx_path)
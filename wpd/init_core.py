@@ -4,14 +4,15 @@
 
 from pathlib import Path
 
-from wpd.fill_tables import fill_tables_from_lists
-from wpd.merge_with_docx import generate_docx_from_template
+from wpd import token_budget
+from wpd.fill_tables import TABLE_FILL_CONCURRENCY, TABLE_FILL_MODE, fill_tables_from_lists
+from wpd.document_session import DocumentSession
 from wpd.request_api import call_api_in_one
 from wpd.table_prompts import TABLE_PROMPTS
 from wpd.tables_config import TABLE_SPECS, TABLE_INDEX_OFFSET
 
 
-def init_core(
+async def init_core(
         file1_path: str,
         file2_path: str,
         prompt: str,
@@ -43,10 +44,11 @@ def init_core(
         template_path = "../files/Шаблон.docx"
     if result_path is None:
         result_path = "files/result.docx"
+    token_usage = token_budget.start_job()
     # Шаг 1: Отправка запроса в API Perplexity
     print(f"Отправка запроса в API Perplexity (модель: {model})...")
     try:
-        answer, thread_id = call_api_in_one(file1_path, file2_path, prompt, model)
+        answer, thread_id = await call_api_in_one(file1_path, file2_path, prompt, model)
         print("\n" + "=" * 50)
         print("Полный ответ API:")
         print("=" * 50)
@@ -80,8 +82,8 @@ def init_core(
         except PermissionError:
             print(f"Предупреждение: Не удалось удалить старый файл {result_path} (возможно, открыт в Word)")
 
-    generate_docx_from_template(answer, template_path, result_path)
-    print(f"Создан файл: {result_path}")
+    # Документ остаётся в памяти до заполнения таблиц и сохраняется один раз в конце
+    session = DocumentSession.from_template(answer, template_path)
 
     # Шаг 3: Заполнение всех нужных таблиц в цикле по конфигу (если не пропущено)
     if not skip_tables:
@@ -90,8 +92,9 @@ def init_core(
             cols_per_row_list = [s.cols_per_row for s in TABLE_SPECS]
             start_coords = [(s.start_row, s.start_col) for s in TABLE_SPECS]
             prompts = [TABLE_PROMPTS[s.prompt_idx] for s in TABLE_SPECS]
+            depends_on_list = [s.depends_on for s in TABLE_SPECS]
 
-            fill_tables_from_lists(
+            await fill_tables_from_lists(
                 result_docx_path=result_path,
                 table_indices=table_indices,
                 cols_per_row_list=cols_per_row_list,
@@ -101,8 +104,12 @@ def init_core(
                 thread_id=thread_id,
                 index_base=1,  # table_index в tables_config.py у вас начинается с 1
                 table_index_offset=TABLE_INDEX_OFFSET,
+                max_concurrency=TABLE_FILL_CONCURRENCY,
+                mode=TABLE_FILL_MODE,
+                depends_on_list=depends_on_list,
+                session=session,
             )
-            print(f"\nЗаполнение таблиц завершено. Результат сохранен в: {result_path}")
+            print("\nЗаполнение таблиц завершено.")
         except Exception as e:
             error_msg = f"Не удалось заполнить таблицы по спискам: {e}"
             print(error_msg)
@@ -111,5 +118,9 @@ def init_core(
             raise Exception(error_msg) from e
     else:
         print("Пропущено заполнение таблиц по конфигурации (будут обработаны из JSON)")
-    
+
+    result_path = session.save(result_path)
+    print(f"Создан файл: {result_path}")
+
+    print(f"Токены за задание: {token_usage.as_dict()}")
     return (result_path, thread_id)
@@ -0,0 +1,625 @@
+"""
+Очередь заданий: загрузка ставит задание и сразу получает его id, обработку ведут фоновые воркеры.
+
+Раньше /upload держал HTTP-запрос открытым всё время обработки (минуты запросов к модели):
+прокси Railway обрывал его по таймауту, а повтор запроса запускал ту же работу ещё раз.
+
+- Задания хранятся в SQLite (JOB_STORE_PATH): после перезапуска процесса незавершённые задания
+  снова ставятся в очередь (не больше JOB_MAX_ATTEMPTS попыток).
+- Обработку ведут JOB_WORKERS воркеров в отдельном потоке со своим event loop: веб-сервер и бот
+  только ставят задания и читают их состояние.
+- Обработчик задания сообщает текущий этап через `set_stage` (переменные, таблицы, рендер) —
+  его видно в /jobs/{id}. Задание определяется contextvar'ом, как учёт токенов в token_budget.
+- Повтор той же загрузки (тот же dedupe_key), пока задание в очереди или выполняется,
+  возвращает существующее задание, а не создаёт новое.
+- События задания (смена состояния и этапа, готовность таблиц, по запросу — фрагменты ответа модели)
+  раздаются подписчикам (`subscribe`) в их event loop'ах прямо из воркера: поток прогресса
+  (/jobs/{id}/events) и бот узнают об изменениях без опроса хранилища.
+- Допуск в очередь ограничен: одновременно выполняется не больше JOB_WORKERS заданий, ждать
+  может не больше JOB_QUEUE_MAX. Сверх этого `submit` отказывает (QueueFull) с оценкой, когда
+  повторить; ожидание оценивается по средней длительности последних заданий того же вида.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Awaitable, Callable, Iterator, Optional
+
+from wpd import metrics
+from wpd.executors import monitor_loop_lag, run_blocking
+
+# Сколько заданий обрабатывается одновременно
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "files/jobs.sqlite3")
+# Сколько раз задание запускается заново после перезапуска процесса, прежде чем считается упавшим
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
+# Сколько заданий может ждать в очереди; новые сверх этого отклоняются (429 / сообщение в боте)
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "20"))
+# Длительность задания для оценки ожидания, пока по этому виду заданий нет истории (секунды)
+JOB_ESTIMATE_SECONDS = float(os.getenv("JOB_ESTIMATE_SECONDS", "180"))
+# Сколько при остановке ждать завершения выполняемых заданий (секунды); прерванные
+# задания остаются в running и при следующем запуске снова ставятся в очередь
+JOB_STOP_TIMEOUT = float(os.getenv("JOB_STOP_TIMEOUT", "30"))
+# По скольким последним заданиям вида считается средняя длительность
+_ESTIMATE_SAMPLE = 20
+# Как часто свободный воркер проверяет очередь, если его не разбудили (секунды)
+_POLL_SECONDS = 5.0
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+JobHandler = Callable[[str, dict], Awaitable[dict]]
+
+
+class JobFailed(Exception):
+    """
+    Ошибка задания, текст которой показывается пользователю как есть.
+    """
+
+
+class QueueFull(Exception):
+    """
+    Очередь заполнена: задание не принято. retry_after — через сколько секунд имеет смысл повторить.
+    """
+
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(
+            f"Сейчас обрабатывается слишком много заданий. Повторите попытку через {format_wait(retry_after)}."
+        )
+
+
+def format_wait(seconds: float) -> str:
+    """
+    Оценка ожидания для пользователя: "~40 с", "~3 мин".
+    """
+    seconds = max(0, int(math.ceil(seconds)))
+    if seconds < 60:
+        return f"~{max(seconds, 1)} с"
+    return f"~{int(math.ceil(seconds / 60))} мин"
+
+
+_current_job_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("wpd_job_id", default=None)
+
+
+def current_job_id() -> Optional[str]:
+    return _current_job_id.get()
+
+
+async def set_stage(stage: str, detail: str = "") -> None:
+    """
+    Записывает текущий этап задания (если код выполняется внутри задания, иначе ничего не делает).
+    Запись в SQLite идёт в пуле потоков, не блокируя event loop.
+    """
+    job_id = _current_job_id.get()
+    if job_id is not None:
+        await run_blocking(get_job_queue().update_stage, job_id, stage, detail)
+
+
+# --- события заданий ---
+
+class _Subscription:
+    def __init__(self, loop: asyncio.AbstractEventLoop, tokens: bool):
+        self.loop = loop
+        self.tokens = tokens
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+
+_subscribers: dict[str, list[_Subscription]] = {}
+_subscribers_lock = threading.Lock()
+
+
+def publish(job_id: str, event: dict) -> None:
+    """
+    Передаёт событие задания всем подписчикам (из любого потока).
+    События "tokens" получают только подписчики, которые их запросили.
+    """
+    with _subscribers_lock:
+        subscriptions = list(_subscribers.get(job_id, ()))
+    for sub in subscriptions:
+        if event.get("type") == "tokens" and not sub.tokens:
+            continue
+        try:
+            sub.loop.call_soon_threadsafe(sub.queue.put_nowait, event)
+        except RuntimeError:
+            # Event loop подписчика уже закрыт
+            pass
+
+
+def _publish_queue_moved() -> None:
+    # Очередь сдвинулась: у ждущих заданий меняются позиция и оценка ожидания
+    with _subscribers_lock:
+        job_ids = list(_subscribers)
+    for job_id in job_ids:
+        publish(job_id, {"type": "queue"})
+
+
+def emit(event_type: str, **data) -> None:
+    """
+    Событие текущего задания (вне задания ничего не делает).
+    """
+    job_id = _current_job_id.get()
+    if job_id is not None:
+        publish(job_id, {"type": event_type, **data})
+
+
+def wants_tokens() -> bool:
+    """
+    Есть ли у текущего задания подписчик на фрагменты ответа модели.
+    """
+    job_id = _current_job_id.get()
+    if job_id is None:
+        return False
+    with _subscribers_lock:
+        return any(sub.tokens for sub in _subscribers.get(job_id, ()))
+
+
+@contextlib.contextmanager
+def subscribe(job_id: str, tokens: bool = False) -> Iterator[asyncio.Queue]:
+    """
+    Подписка на события задания в текущем event loop: очередь словарей {"type": ..., ...}.
+    Подписываться нужно до чтения состояния из хранилища, чтобы не пропустить переход между ними.
+    """
+    sub = _Subscription(asyncio.get_running_loop(), tokens)
+    with _subscribers_lock:
+        _subscribers.setdefault(job_id, []).append(sub)
+    try:
+        yield sub.queue
+    finally:
+        with _subscribers_lock:
+            subscriptions = _subscribers.get(job_id, [])
+            if sub in subscriptions:
+                subscriptions.remove(sub)
+            if not subscriptions:
+                _subscribers.pop(job_id, None)
+
+
+def _row_to_dict(row: sqlite3.Row) -> dict:
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"]) if job["payload"] else {}
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+class JobQueue:
+    """
+    Очередь заданий в SQLite с пулом воркеров.
+
+    Обработчики регистрируются по виду задания (`register`); воркеры берут только задания
+    зарегистрированных видов, поэтому задания бота, оставшиеся с прошлого запуска,
+    не попадут к веб-серверу, запущенному без бота.
+    """
+
+    def __init__(self, store_path: str = JOB_STORE_PATH, workers: int = JOB_WORKERS):
+        self._store_path = Path(store_path)
+        self._workers = max(1, workers)
+        self._handlers: dict[str, JobHandler] = {}
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._thread: Optional[threading.Thread] = None
+        self._worker_tasks: list[asyncio.Task] = []
+        self._stopping = False
+        # Число выполняемых заданий (меняется только в потоке воркеров)
+        self._running = 0
+
+    # --- хранилище ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    self._store_path.parent.mkdir(parents=True, exist_ok=True)
+                    conn = sqlite3.connect(str(self._store_path), timeout=30)
+                    try:
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.execute(
+                            "CREATE TABLE IF NOT EXISTS jobs ("
+                            " id TEXT PRIMARY KEY,"
+                            " kind TEXT NOT NULL,"
+                            " state TEXT NOT NULL,"
+                            " stage TEXT NOT NULL DEFAULT '',"
+                            " detail TEXT NOT NULL DEFAULT '',"
+                            " payload TEXT NOT NULL,"
+                            " result TEXT,"
+                            " error TEXT,"
+                            " dedupe_key TEXT,"
+                            " attempts INTEGER NOT NULL DEFAULT 0,"
+                            " created_at REAL NOT NULL,"
+                            " started_at REAL,"
+                            " finished_at REAL,"
+                            " updated_at REAL NOT NULL)"
+                        )
+                        conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+                        conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, state)")
+                        conn.commit()
+                    finally:
+                        conn.close()
+                    self._initialized = True
+
+        conn = sqlite3.connect(str(self._store_path), timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def submit(self, kind: str, payload: dict, dedupe_key: Optional[str] = None) -> dict:
+        """
+        Ставит задание в очередь. Возвращает задание (новое или уже стоящее в очереди с тем же dedupe_key).
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if dedupe_key is not None:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE dedupe_key = ? AND state IN (?, ?) ORDER BY created_at LIMIT 1",
+                    (dedupe_key, *ACTIVE_STATES),
+                ).fetchone()
+                if row is not None:
+                    conn.rollback()
+                    metrics.inc("jobs_deduplicated")
+                    print(f"Задание {row['id']} уже в работе, повторная загрузка не ставится в очередь")
+                    return _row_to_dict(row)
+
+            # Считаются только задания, которые этот процесс может взять: задания бота,
+            # оставшиеся при запуске без бота, не заполняют очередь веб-сервера
+            kinds = list(self._handlers)
+            queued = conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE state = ? AND kind IN ({', '.join('?' * len(kinds))})",
+                (QUEUED, *kinds),
+            ).fetchone()[0]
+            if queued >= JOB_QUEUE_MAX:
+                retry_after = self._retry_after(conn)
+                conn.rollback()
+                metrics.inc("jobs_rejected")
+                print(f"Очередь заполнена ({queued} заданий ждут), задание {kind} отклонено; повтор через {retry_after} с")
+                raise QueueFull(retry_after)
+
+            job_id = str(uuid.uuid4())
+            conn.execute(
+                "INSERT INTO jobs (id, kind, state, payload, dedupe_key, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, json.dumps(payload, ensure_ascii=False), dedupe_key, now, now),
+            )
+            conn.commit()
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        metrics.inc("jobs_submitted")
+        self._notify()
+        return _row_to_dict(row)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return _row_to_dict(row) if row is not None else None
+
+    def list_jobs(self, kind: str, states: tuple[str, ...] = ACTIVE_STATES) -> list[dict]:
+        """
+        Задания вида `kind` в состояниях `states` (от старых к новым).
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE kind = ? AND state IN ({', '.join('?' * len(states))}) ORDER BY created_at",
+                (kind, *states),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [_row_to_dict(row) for row in rows]
+
+    def _average_durations(self, conn: sqlite3.Connection) -> dict[str, float]:
+        """
+        Средняя длительность выполнения по видам заданий (по последним завершённым).
+        """
+        averages = {}
+        for (kind,) in conn.execute("SELECT DISTINCT kind FROM jobs").fetchall():
+            row = conn.execute(
+                "SELECT AVG(finished_at - started_at) FROM (SELECT finished_at, started_at FROM jobs"
+                " WHERE kind = ? AND state = ? AND started_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?)",
+                (kind, DONE, _ESTIMATE_SAMPLE),
+            ).fetchone()
+            if row[0] is not None:
+                averages[kind] = row[0]
+        return averages
+
+    def _remaining_running(self, conn: sqlite3.Connection, averages: dict[str, float]) -> list[float]:
+        """
+        Оценка оставшегося времени каждого выполняющегося задания.
+        """
+        now = time.time()
+        return [
+            max(averages.get(kind, JOB_ESTIMATE_SECONDS) - (now - (started_at or now)), 0.0)
+            for kind, started_at in conn.execute("SELECT kind, started_at FROM jobs WHERE state = ?", (RUNNING,))
+        ]
+
+    def _retry_after(self, conn: sqlite3.Connection) -> int:
+        # Место в очереди освободится, когда закончится ближайшее из выполняющихся заданий
+        averages = self._average_durations(conn)
+        remaining = self._remaining_running(conn, averages)
+        seconds = min(remaining) if remaining else max(averages.values(), default=JOB_ESTIMATE_SECONDS)
+        return max(1, int(math.ceil(seconds)))
+
+    def queue_estimate(self, job_id: str) -> Optional[tuple[int, float]]:
+        """
+        Для задания в очереди: (сколько заданий перед ним, оценка ожидания до начала в секундах).
+        None, если задание уже не в очереди.
+        """
+        conn = self._connect()
+        try:
+            job = conn.execute("SELECT created_at FROM jobs WHERE id = ? AND state = ?", (job_id, QUEUED)).fetchone()
+            if job is None:
+                return None
+            ahead = [
+                kind for (kind,) in conn.execute(
+                    "SELECT kind FROM jobs WHERE state = ? AND created_at < ?", (QUEUED, job["created_at"])
+                )
+                if kind in self._handlers
+            ]
+            averages = self._average_durations(conn)
+            remaining = self._remaining_running(conn, averages)
+        finally:
+            conn.close()
+        # Раскладываем задания впереди по воркерам: каждое берёт тот, кто освободится раньше
+        free_at = sorted(remaining)[:self._workers]
+        free_at += [0.0] * (self._workers - len(free_at))
+        heapq.heapify(free_at)
+        for kind in ahead:
+            heapq.heappush(free_at, heapq.heappop(free_at) + averages.get(kind, JOB_ESTIMATE_SECONDS))
+        return len(ahead), free_at[0]
+
+    def update_stage(self, job_id: str, stage: str, detail: str = "") -> None:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE jobs SET stage = ?, detail = ?, updated_at = ? WHERE id = ?",
+                    (stage, detail, time.time(), job_id),
+                )
+        finally:
+            conn.close()
+        publish(job_id, {"type": "stage", "stage": stage, "detail": detail})
+
+    def _finish(self, job_id: str, state: str, result: Optional[dict] = None, error: Optional[str] = None) -> None:
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE jobs SET state = ?, result = ?, error = ?, finished_at = ?, updated_at = ? WHERE id = ?",
+                    (
+                        state,
+                        json.dumps(result, ensure_ascii=False) if result is not None else None,
+                        error,
+                        now,
+                        now,
+                        job_id,
+                    ),
+                )
+        finally:
+            conn.close()
+        publish(job_id, {"type": "state", "state": state})
+        _publish_queue_moved()
+
+    def _claim(self) -> Optional[dict]:
+        """
+        Берёт самое старое задание зарегистрированного вида и переводит его в running.
+        """
+        kinds = list(self._handlers)
+        if not kinds:
+            return None
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE state = ? AND kind IN ({', '.join('?' * len(kinds))})"
+                " ORDER BY created_at LIMIT 1",
+                (QUEUED, *kinds),
+            ).fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            conn.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ?, updated_at = ? WHERE id = ?",
+                (RUNNING, now, now, row["id"]),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        publish(row["id"], {"type": "state", "state": RUNNING})
+        _publish_queue_moved()
+        job = _row_to_dict(row)
+        job["attempts"] += 1
+        return job
+
+    def _recover(self) -> None:
+        """
+        Задания, которые выполнялись при остановке процесса, ставятся в очередь заново
+        (или помечаются упавшими, если попытки исчерпаны).
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                failed = conn.execute(
+                    "UPDATE jobs SET state = ?, error = ?, finished_at = ?, updated_at = ? WHERE state = ? AND attempts >= ?",
+                    (FAILED, "Обработка прервана перезапуском сервера", now, now, RUNNING, JOB_MAX_ATTEMPTS),
+                ).rowcount
+                requeued = conn.execute(
+                    "UPDATE jobs SET state = ?, stage = '', detail = '', updated_at = ? WHERE state = ?",
+                    (QUEUED, now, RUNNING),
+                ).rowcount
+        finally:
+            conn.close()
+        if requeued or failed:
+            print(f"Незавершённые задания после перезапуска: снова в очереди {requeued}, прервано {failed}")
+
+    # --- воркеры ---
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        """
+        Регистрирует обработчик заданий вида `kind`: async handler(job_id, payload) -> dict (результат задания).
+        Ошибки JobFailed показываются пользователю как есть, остальные — как внутренняя ошибка.
+        """
+        self._handlers[kind] = handler
+        self._notify()
+
+    def start(self) -> None:
+        """
+        Запускает поток воркеров (повторный вызов ничего не делает).
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="job-workers", daemon=True)
+            self._thread.start()
+        ready.wait()
+        print(f"Очередь заданий запущена: воркеров {self._workers}, хранилище {self._store_path}")
+
+    def stop(self, timeout: float = JOB_STOP_TIMEOUT) -> None:
+        """
+        Останавливает воркеры: новые задания не берутся, выполняемые получают `timeout` секунд
+        на завершение, затем отменяются. Клиент Perplexity цикла воркеров закрывается.
+        Повторный вызов ничего не делает.
+        """
+        with self._lock:
+            thread, loop = self._thread, self._loop
+            if thread is None or loop is None or self._stopping:
+                return
+            self._stopping = True
+        if not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._drain(timeout), loop)
+        thread.join(timeout + 10)
+        print("Очередь заданий остановлена")
+
+    def _run_loop(self, ready: threading.Event) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        ready.set()
+        try:
+            self._recover()
+        except Exception as e:
+            print(f"Не удалось восстановить задания после перезапуска: {e}")
+        try:
+            loop.run_until_complete(self._serve())
+        finally:
+            loop.close()
+
+    async def _serve(self) -> None:
+        lag_monitor = asyncio.create_task(monitor_loop_lag("jobs"))
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        lag_monitor.cancel()
+        # Все запросы к Perplexity из заданий шли через клиент этого цикла
+        try:
+            from wpd.llm_client import close_client
+
+            await close_client()
+        except Exception as e:
+            print(f"Не удалось закрыть клиент Perplexity очереди заданий: {e}")
+
+    async def _drain(self, timeout: float) -> None:
+        self._wakeup.set()
+        _, pending = await asyncio.wait(self._worker_tasks, timeout=timeout)
+        if pending:
+            print(f"Остановка очереди: прерывается выполняемых заданий: {len(pending)}")
+        for task in pending:
+            task.cancel()
+
+    def _notify(self) -> None:
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    async def _worker(self) -> None:
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                # SQLite (BEGIN IMMEDIATE с ожиданием блокировки) — в пуле потоков, чтобы не останавливать
+                # цикл, в котором идут потоки ответов и события остальных заданий
+                job = await run_blocking(self._claim)
+            except Exception as e:
+                print(f"Ошибка очереди заданий: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), _POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Отдельная задача: contextvars задания (id, учёт токенов) не переходят к следующему
+            await asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: dict) -> None:
+        job_id = job["id"]
+        _current_job_id.set(job_id)
+        handler = self._handlers[job["kind"]]
+        started = time.perf_counter()
+        print(f"Задание {job_id} ({job['kind']}): начато, попытка {job['attempts']}")
+        self._running += 1
+        metrics.set_gauge("jobs_running", self._running)
+        try:
+            result = await handler(job_id, job["payload"])
+        except JobFailed as e:
+            await run_blocking(self._finish, job_id, FAILED, error=str(e))
+            metrics.inc("jobs_failed")
+            print(f"Задание {job_id}: ошибка: {e}")
+        except Exception as e:
+            await run_blocking(self._finish, job_id, FAILED, error=f"Внутренняя ошибка при обработке: {e}")
+            metrics.inc("jobs_failed")
+            print(f"Задание {job_id}: внутренняя ошибка: {e}")
+            traceback.print_exc()
+        else:
+            await run_blocking(self._finish, job_id, DONE, result=result or {})
+            metrics.inc("jobs_done")
+            print(f"Задание {job_id}: готово за {time.perf_counter() - started:.1f} с")
+        finally:
+            self._running -= 1
+            metrics.set_gauge("jobs_running", self._running)
+            metrics.observe("job_seconds", time.perf_counter() - started)
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """
+    Общая очередь процесса (веб-сервер и бот работают в одном процессе и делят воркеров).
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
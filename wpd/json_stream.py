@@ -0,0 +1,135 @@
+"""
+Потоковый разбор JSON-массива из ответа модели.
+
+Ответ по таблице — JSON-массив значений (или строк-массивов), иногда с пояснениями до и после.
+Парсер получает ответ по фрагментам, отдаёт элементы верхнего уровня по мере их завершения
+и отмечает `done`, как только массив закрылся — после этого поток можно не дочитывать.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from typing import Any, List
+
+# Массив из одного числа: сноска Perplexity вида [1], [2] — или ответ из одного значения
+_CITATION_RE = re.compile(r"^\d+$")
+
+
+class JsonArrayStreamParser:
+    """
+    Инкрементальный парсер первого JSON-массива в тексте.
+
+    - текст до '[' пропускается (вступление, ```json);
+    - элемент верхнего уровня отдаётся, когда встречена ',' или закрывающая ']' на первом уровне;
+    - массив, первый элемент которого не JSON ([Таблица 1]), пропускается;
+    - массив из одного числа ([1]) откладывается: если за ним последует другой массив, это была сноска,
+      если нет — он и есть ответ (отдаётся в `finish`, когда ответ закончился);
+    - если до массива встретился JSON-объект — разбор прекращается (failed);
+    - если невалидным оказался не первый элемент — разбор прекращается (failed), и вызывающий
+      разбирает полный ответ прежним способом.
+    """
+
+    def __init__(self):
+        self.done = False
+        self.failed = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._item: list[str] = []
+        self._emitted = 0
+        # Отложенный массив из одного числа (см. _CITATION_RE)
+        self._single_number: Any = None
+
+    def feed(self, text: str) -> List[Any]:
+        items: List[Any] = []
+        if self.done or self.failed:
+            return items
+
+        for ch in text:
+            if self._depth == 0:
+                if ch == "[":
+                    self._depth = 1
+                    self._item = []
+                    self._emitted = 0
+                elif ch == "{":
+                    # Ответ — JSON-объект, а не массив: пусть его разбирает полный парсер
+                    self.failed = True
+                    break
+                continue
+
+            if self._in_string:
+                self._item.append(ch)
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._item.append(ch)
+            elif ch in "[{":
+                self._depth += 1
+                self._item.append(ch)
+            elif ch in "]}":
+                self._depth -= 1
+                if self._depth > 0:
+                    self._item.append(ch)
+                    continue
+                # Закрылся массив верхнего уровня
+                raw = "".join(self._item).strip()
+                if self._emitted == 0 and _CITATION_RE.match(raw):
+                    # Сноска или ответ [5] — станет ясно, найдётся ли дальше другой массив
+                    if self._single_number is None:
+                        self._single_number = int(raw)
+                    self._item = []
+                    continue
+                if not self._finish_item(items, last=True):
+                    continue
+                self.done = True
+                break
+            elif ch == "," and self._depth == 1:
+                if not self._finish_item(items, last=False):
+                    if self.failed:
+                        break
+                    continue
+            else:
+                self._item.append(ch)
+        return items
+
+    def _finish_item(self, items: List[Any], last: bool) -> bool:
+        """
+        Разбирает накопленный элемент. Возвращает False, если массив оказался не тем (сброс или failed).
+        """
+        raw = "".join(self._item).strip()
+        self._item = []
+        if not raw:
+            # Пустой массив или висячая запятая
+            return last and self._emitted > 0 or not last
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            if self._emitted == 0:
+                # Похоже на текст в квадратных скобках, а не на ответ — ищем следующий массив
+                self._depth = 0
+            else:
+                self.failed = True
+            return False
+        if self._emitted == 0:
+            # Нашёлся массив с ответом: отложенное число было сноской
+            self._single_number = None
+        items.append(value)
+        self._emitted += 1
+        return True
+
+    def finish(self) -> List[Any]:
+        """
+        Конец ответа: если другого массива так и не нашлось, отложенный массив из одного числа — ответ.
+        """
+        if self.done or self.failed or self._single_number is None:
+            return []
+        self.done = True
+        return [self._single_number]
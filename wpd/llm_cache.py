@@ -0,0 +1,148 @@
+"""
+Постоянный кэш ответов модели (SQLite на диске).
+
+Ключ — sha256 от (модель, нормализованные сообщения, температура, версия промптов),
+поэтому повторная загрузка того же учебника или повтор таблицы не оплачиваются заново.
+Вытеснение: по TTL и по суммарному размеру (самые давно использованные записи — первыми).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from wpd import metrics
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    str(Path(__file__).resolve().parent.parent / "files" / "cache" / "llm_cache.sqlite3"),
+)
+# Максимальный суммарный размер ответов в кэше (байты) и время жизни записи (секунды)
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Меняйте при изменении формата промптов/разбора ответов, чтобы не получать старые ответы
+PROMPT_VERSION = os.getenv("LLM_CACHE_PROMPT_VERSION", "1")
+
+_init_lock = threading.Lock()
+_initialized_paths: set[str] = set()
+
+
+def _connect(path: str = LLM_CACHE_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30)
+    if path not in _initialized_paths:
+        with _init_lock:
+            if path not in _initialized_paths:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache ("
+                    " key TEXT PRIMARY KEY,"
+                    " response TEXT NOT NULL,"
+                    " size INTEGER NOT NULL,"
+                    " created_at REAL NOT NULL,"
+                    " last_access REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache(last_access)")
+                conn.commit()
+                _initialized_paths.add(path)
+    return conn
+
+
+def _normalize_content(content) -> str:
+    if content is None:
+        return ""
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+    return content.replace("\r\n", "\n").strip()
+
+
+def make_key(model: str, messages: list[dict], temperature: float) -> str:
+    """
+    Строит ключ кэша. Из сообщений учитываются только role и content (без лишних пробелов по краям).
+    """
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": m.get("role"), "content": _normalize_content(m.get("content"))}
+            for m in messages
+        ],
+        "temperature": round(float(temperature), 4),
+        "prompt_version": PROMPT_VERSION,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get(key: str, path: str = LLM_CACHE_PATH) -> Optional[str]:
+    """
+    Возвращает сохранённый ответ или None. Просроченная запись удаляется.
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    conn = _connect(path)
+    try:
+        row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            metrics.inc("llm_cache_misses")
+            return None
+        response, created_at = row
+        if LLM_CACHE_TTL_SECONDS > 0 and now - created_at > LLM_CACHE_TTL_SECONDS:
+            conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            conn.commit()
+            metrics.inc("llm_cache_misses")
+            metrics.inc("llm_cache_evictions")
+            return None
+        conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+        conn.commit()
+        metrics.inc("llm_cache_hits")
+        return response
+    finally:
+        conn.close()
+
+
+def put(key: str, response: str, path: str = LLM_CACHE_PATH) -> None:
+    """
+    Сохраняет ответ и вытесняет просроченные и самые давно использованные записи сверх лимита размера.
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    size = len(response.encode("utf-8"))
+    conn = _connect(path)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, response, size, now, now),
+        )
+        evicted = 0
+        if LLM_CACHE_TTL_SECONDS > 0:
+            evicted += conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (now - LLM_CACHE_TTL_SECONDS,)
+            ).rowcount
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total > LLM_CACHE_MAX_BYTES:
+            # LRU: удаляем записи с самым старым last_access, пока не уложимся в лимит
+            for old_key, old_size in conn.execute(
+                "SELECT key, size FROM llm_cache ORDER BY last_access ASC"
+            ).fetchall():
+                if total <= LLM_CACHE_MAX_BYTES:
+                    break
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (old_key,))
+                total -= old_size
+                evicted += 1
+        conn.commit()
+
+        entries = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        metrics.inc("llm_cache_stores")
+        if evicted:
+            metrics.inc("llm_cache_evictions", evicted)
+        metrics.set_gauge("llm_cache_entries", entries)
+        metrics.set_gauge("llm_cache_bytes", total)
+    finally:
+        conn.close()
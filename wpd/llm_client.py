@@ -0,0 +1,854 @@
+"""
+Асинхронный слой запросов к Perplexity API.
+
+Все вызовы модели (переменные шаблона, таблицы) идут через `stream_chat_completion`,
+который использует общий `AsyncOpenAI` клиент с ограниченным пулом keep-alive соединений.
+Так один процесс может вести десятки заданий одновременно и не блокирует event loop uvicorn.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Sequence
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from wpd import concurrency, job_queue, llm_cache, metrics, token_budget
+from wpd.executors import run_blocking
+from wpd.rate_limiter import limiter
+from wpd.stream_sinks import CompletionStats, JobEventSink, StreamSink
+
+# API ключ должен быть установлен через переменную окружения PPLX_API_KEY
+PPLX_API_KEY = os.getenv("PPLX_API_KEY")
+if not PPLX_API_KEY:
+    raise ValueError(
+        "PPLX_API_KEY не установлен. "
+        "Установите переменную окружения: export PPLX_API_KEY=your_key "
+        "или настройте на сервере через панель управления хостинга."
+    )
+
+PPLX_BASE_URL = "https://api.perplexity.ai"
+
+# Ограничения пула соединений (на один event loop)
+PPLX_MAX_CONNECTIONS = int(os.getenv("PPLX_MAX_CONNECTIONS", "32"))
+PPLX_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("PPLX_MAX_KEEPALIVE_CONNECTIONS", "16"))
+PPLX_KEEPALIVE_EXPIRY = float(os.getenv("PPLX_KEEPALIVE_EXPIRY", "60"))
+# Общий таймаут запроса (секунды): ответы по таблицам могут генерироваться несколько минут
+PPLX_TIMEOUT = float(os.getenv("PPLX_TIMEOUT", "600"))
+PPLX_CONNECT_TIMEOUT = float(os.getenv("PPLX_CONNECT_TIMEOUT", "10"))
+
+# Повторы при временных ошибках (429, 5xx, обрыв соединения/потока): число повторов и пределы паузы (секунды)
+PPLX_MAX_RETRIES = int(os.getenv("PPLX_MAX_RETRIES", "3"))
+PPLX_RETRY_BASE_DELAY = float(os.getenv("PPLX_RETRY_BASE_DELAY", "1"))
+PPLX_RETRY_MAX_DELAY = float(os.getenv("PPLX_RETRY_MAX_DELAY", "30"))
+# Retry-After от сервера соблюдаем, но не дольше этого значения
+PPLX_RETRY_AFTER_MAX = float(os.getenv("PPLX_RETRY_AFTER_MAX", "120"))
+# Предохранитель: после стольких ошибок подряд запросы отклоняются сразу, пока не пройдёт пауза (секунды)
+PPLX_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("PPLX_CIRCUIT_FAILURE_THRESHOLD", "5"))
+PPLX_CIRCUIT_RESET_SECONDS = float(os.getenv("PPLX_CIRCUIT_RESET_SECONDS", "30"))
+
+# Зависание потока: сколько ждать первого фрагмента ответа и паузу между фрагментами (секунды)
+PPLX_FIRST_TOKEN_TIMEOUT = float(os.getenv("PPLX_FIRST_TOKEN_TIMEOUT", "90"))
+PPLX_STREAM_IDLE_TIMEOUT = float(os.getenv("PPLX_STREAM_IDLE_TIMEOUT", "30"))
+# Дублирующие запросы (hedging) для таблиц: если запрос идёт дольше p95 наблюдаемой длительности,
+# запускается дубликат, берётся ответ, пришедший первым, второй запрос отменяется
+PPLX_HEDGE_ENABLED = os.getenv("PPLX_HEDGE_ENABLED", "false").lower() == "true"
+PPLX_HEDGE_MIN_SAMPLES = int(os.getenv("PPLX_HEDGE_MIN_SAMPLES", "10"))
+PPLX_HEDGE_MIN_DELAY = float(os.getenv("PPLX_HEDGE_MIN_DELAY", "5"))
+
+_CONTINUE_PROMPT = (
+    "Твой предыдущий ответ оборвался. Продолжи его ровно с того места, где он прервался, "
+    "не повторяя уже написанный текст и без вступлений."
+)
+
+# httpx.AsyncClient привязан к event loop, в котором был создан.
+# Веб-сервер и Telegram бот (run_all.py) работают в разных потоках со своими loop'ами,
+# поэтому держим по одному клиенту (и пулу) на каждый loop.
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def _build_client() -> AsyncOpenAI:
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=PPLX_MAX_CONNECTIONS,
+            max_keepalive_connections=PPLX_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=PPLX_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(PPLX_TIMEOUT, connect=PPLX_CONNECT_TIMEOUT),
+    )
+    return AsyncOpenAI(
+        api_key=PPLX_API_KEY,
+        base_url=PPLX_BASE_URL,
+        http_client=http_client,
+        # Повторы делает stream_chat_completion (с учётом Retry-After и предохранителя)
+        max_retries=0,
+    )
+
+
+def get_client() -> AsyncOpenAI:
+    """
+    Возвращает общий AsyncOpenAI клиент для текущего event loop (создаёт при первом обращении).
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        client = _clients.get(loop)
+        if client is None:
+            client = _build_client()
+            _clients[loop] = client
+        return client
+
+
+async def close_client() -> None:
+    """
+    Закрывает клиент (и пул соединений) текущего event loop. Вызывается при остановке приложения.
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        client = _clients.pop(loop, None)
+    if client is not None:
+        await client.close()
+
+
+def _raise_api_error(api_error: Exception, label: str = "") -> None:
+    """
+    Переклассифицирует ошибку создания запроса в понятное пользователю исключение.
+
+    label — уточнение для сообщений (например " для таблицы 5").
+    """
+    error_msg = str(api_error)
+    if "api_key" in error_msg.lower() or "authentication" in error_msg.lower() or "401" in error_msg:
+        raise ValueError(
+            f"Ошибка аутентификации API{label}: Проверьте что PPLX_API_KEY установлен правильно. "
+            f"Детали: {error_msg}"
+        ) from api_error
+    elif "connection" in error_msg.lower() or "timeout" in error_msg.lower() or "network" in error_msg.lower():
+        raise ConnectionError(
+            f"Ошибка подключения к Perplexity API{label}: {error_msg}. "
+            f"Проверьте интернет-соединение и доступность api.perplexity.ai"
+        ) from api_error
+    else:
+        raise Exception(f"Ошибка при запросе к Perplexity API{label}: {error_msg}") from api_error
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Запрос отклонён предохранителем без обращения к API.
+    """
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для вызовов Perplexity (общий для всех потоков и event loop'ов процесса).
+
+    - closed: запросы идут как обычно, считаются ошибки подряд;
+    - open: после `failure_threshold` ошибок подряд запросы сразу отклоняются (ConnectionError),
+      чтобы задания не копились в ожидании недоступного API;
+    - через `reset_seconds` пропускается один пробный запрос: успех закрывает предохранитель, ошибка — снова открывает.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        # Номер идущего пробного запроса (None — пробного запроса нет)
+        self._trial: Optional[int] = None
+        self._trials = 0
+
+    def before_call(self, label: str = "") -> Optional[int]:
+        """
+        Пропускает запрос или выбрасывает CircuitOpenError.
+
+        Returns:
+            номер пробного запроса, если этот запрос — пробный (его передают в record_* и release_trial),
+            иначе None
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return None
+            remaining = self.reset_seconds - (time.monotonic() - self._opened_at)
+            if remaining <= 0 and self._trial is None:
+                self._trials += 1
+                self._trial = self._trials
+                return self._trial
+        metrics.inc("llm_circuit_rejected")
+        raise CircuitOpenError(
+            f"Perplexity API временно недоступен{label}: несколько запросов подряд завершились ошибкой. "
+            f"Повторите попытку через {max(1, int(remaining))} c."
+        )
+
+    def record_success(self, trial: Optional[int] = None) -> None:
+        with self._lock:
+            self._failures = 0
+            # Предохранитель закрыт: пробный запрос (чей бы он ни был) больше не нужен
+            self._trial = None
+            if self._opened_at is not None:
+                print("Perplexity API снова отвечает, предохранитель закрыт")
+            self._opened_at = None
+        metrics.set_gauge("llm_circuit_open", 0)
+
+    def release_trial(self, trial: Optional[int]) -> None:
+        # Пробный запрос отменён (например, проиграл дублирующему) — пропускаем следующий.
+        # Отмена чужого запроса (начатого до открытия или проигравшего) пробный запрос не снимает
+        with self._lock:
+            if trial is not None and trial == self._trial:
+                self._trial = None
+
+    def record_failure(self, trial: Optional[int] = None) -> None:
+        with self._lock:
+            self._failures += 1
+            was_trial = trial is not None and trial == self._trial
+            if was_trial:
+                self._trial = None
+            if not (was_trial or self._failures >= self.failure_threshold):
+                return
+            self._opened_at = time.monotonic()
+        print(f"Предохранитель Perplexity API открыт на {self.reset_seconds:.0f} c (ошибок подряд: {self._failures})")
+        metrics.set_gauge("llm_circuit_open", 1)
+
+
+_circuit = CircuitBreaker(PPLX_CIRCUIT_FAILURE_THRESHOLD, PPLX_CIRCUIT_RESET_SECONDS)
+
+
+class LatencyTracker:
+    """
+    Скользящее окно длительностей успешных запросов по группам (например "table") для оценки p95.
+    """
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self._samples: dict[str, deque] = {}
+        self._window = window
+
+    def record(self, group: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(group, deque(maxlen=self._window)).append(seconds)
+        p95 = self.p95(group, min_samples=1)
+        if p95 is not None:
+            metrics.set_gauge(f"llm_latency_p95_{group}_seconds", round(p95, 3))
+
+    def p95(self, group: str, min_samples: int = PPLX_HEDGE_MIN_SAMPLES) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(group, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+
+_latency = LatencyTracker()
+
+
+class _StreamInterrupted(Exception):
+    """
+    Поток ответа оборвался после успешного начала запроса.
+    """
+
+
+class _StreamStalled(_StreamInterrupted):
+    """
+    Поток завис (таймаут первого фрагмента или паузы между фрагментами).
+    """
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, _StreamInterrupted):
+        return True
+    if isinstance(error, openai.APIConnectionError):  # включая APITimeoutError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def _is_overload(error: Exception) -> bool:
+    """
+    Ошибка говорит о перегрузке API (для адаптивного лимита одновременных запросов).
+    """
+    if isinstance(error, (_StreamStalled, openai.APITimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    Пауза из заголовков Retry-After / retry-after-ms ответа с ошибкой (если есть).
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_ms = headers.get("retry-after-ms")
+    if retry_ms:
+        try:
+            return float(retry_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_delay(attempt: int, error: Exception) -> float:
+    """
+    Экспоненциальная пауза с полным джиттером; Retry-After от сервера имеет приоритет.
+    """
+    retry_after = _retry_after_seconds(error)
+    if retry_after is not None:
+        return min(retry_after, PPLX_RETRY_AFTER_MAX)
+    return random.uniform(0, min(PPLX_RETRY_MAX_DELAY, PPLX_RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+async def _stream_once(
+        messages: list[dict],
+        *,
+        model: str,
+        temperature: float,
+        parts: list[str],
+        on_content: Optional[Callable[[str], None]],
+        should_stop: Optional[Callable[[], bool]] = None,
+) -> tuple[Optional[str], object, Optional[float]]:
+    """
+    Один потоковый запрос: фрагменты ответа дописываются в `parts`.
+
+    Ошибки создания запроса пробрасываются как есть, ошибки во время чтения потока — как _StreamInterrupted.
+    Если `should_stop()` вернул True (приёмнику уже хватает ответа), поток закрывается без дочитывания.
+    Зависший поток тоже считается оборванным: если первый фрагмент не пришёл за PPLX_FIRST_TOKEN_TIMEOUT
+    (от начала запроса) или между фрагментами прошло больше PPLX_STREAM_IDLE_TIMEOUT.
+
+    Returns:
+        (completion_id, usage из последнего чанка с usage или None, время до первого фрагмента)
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    first_token_deadline = started + PPLX_FIRST_TOKEN_TIMEOUT
+    first_token_latency: Optional[float] = None
+    try:
+        stream = await asyncio.wait_for(
+            get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+            ),
+            timeout=PPLX_FIRST_TOKEN_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        metrics.inc("llm_stream_stalls")
+        raise _StreamStalled(f"нет ответа от API за {PPLX_FIRST_TOKEN_TIMEOUT:g} c")
+
+    # В streaming у чанков обычно есть chunk.id (completion id). Это НЕ chat/thread id, но полезно для логов.
+    completion_id: Optional[str] = None
+    usage = None
+    received = False
+    chunks = stream.__aiter__()
+    try:
+        while True:
+            if received:
+                timeout = PPLX_STREAM_IDLE_TIMEOUT
+            else:
+                timeout = max(0.0, first_token_deadline - loop.time())
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                metrics.inc("llm_stream_stalls")
+                if received:
+                    raise _StreamStalled(f"поток завис: нет новых фрагментов ответа {PPLX_STREAM_IDLE_TIMEOUT:g} c")
+                raise _StreamStalled(f"поток завис: нет первого фрагмента ответа {PPLX_FIRST_TOKEN_TIMEOUT:g} c")
+
+            if completion_id is None and getattr(chunk, "id", None):
+                completion_id = chunk.id
+            # Perplexity присылает usage в чанках ответа (итоговое значение — в последнем)
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+
+            if getattr(chunk, "choices", None) and len(chunk.choices) > 0:
+                delta = chunk.choices[0].delta
+                content = None
+
+                if hasattr(delta, "content"):
+                    content = delta.content
+                elif isinstance(delta, dict):
+                    content = delta.get("content")
+
+                if content:
+                    if not received:
+                        first_token_latency = loop.time() - started
+                    received = True
+                    parts.append(content)
+                    if on_content is not None:
+                        on_content(content)
+                    if should_stop is not None and should_stop():
+                        metrics.inc("llm_streams_stopped_early")
+                        await _close_stream(stream)
+                        break
+    except _StreamInterrupted:
+        await _close_stream(stream)
+        raise
+    except Exception as stream_error:
+        await _close_stream(stream)
+        raise _StreamInterrupted(str(stream_error)) from stream_error
+    except asyncio.CancelledError:
+        # Отменённый (например, дублирующий) запрос не должен держать соединение
+        await _close_stream(stream)
+        raise
+    return completion_id, usage, first_token_latency
+
+
+async def _gated_stream(
+        messages: list[dict],
+        *,
+        model: str,
+        temperature: float,
+        label: str,
+        parts: list[str],
+        on_content: Optional[Callable[[str], None]],
+        should_stop: Optional[Callable[[], bool]] = None,
+) -> tuple[Optional[str], object]:
+    """
+    Одна попытка запроса в пределах адаптивного лимита одновременных запросов (wpd/concurrency.py).
+    Результат попытки (успех, перегрузка, прочая ошибка) корректирует лимит.
+    """
+    slots = concurrency.get_limiter(model)
+    await slots.acquire()
+    outcome = concurrency.OUTCOME_ERROR
+    first_token_latency: Optional[float] = None
+    try:
+        # Итог попытки сообщается предохранителю здесь: только эта попытка знает, пробная ли она
+        trial = _circuit.before_call(label)
+        try:
+            completion_id, usage, first_token_latency = await _stream_once(
+                messages,
+                model=model,
+                temperature=temperature,
+                parts=parts,
+                on_content=on_content,
+                should_stop=should_stop,
+            )
+        except asyncio.CancelledError:
+            _circuit.release_trial(trial)
+            raise
+        except Exception as error:
+            if _is_retryable(error):
+                _circuit.record_failure(trial)
+            else:
+                # API ответил (например 400/401) — это не признак недоступности
+                _circuit.record_success(trial)
+            raise
+        _circuit.record_success(trial)
+        outcome = concurrency.OUTCOME_SUCCESS
+        return completion_id, usage
+    except Exception as error:
+        if _is_overload(error):
+            outcome = concurrency.OUTCOME_OVERLOAD
+        raise
+    finally:
+        slots.release(outcome, first_token_latency)
+
+
+async def _close_stream(stream) -> None:
+    close = getattr(stream, "close", None)
+    if close is None:
+        return
+    try:
+        await close()
+    except Exception:
+        pass
+
+
+@dataclass
+class _CompletionResult:
+    text: str
+    completion_id: Optional[str]
+    complete: bool
+    last_error: Optional[Exception]
+    prompt_tokens: int
+    completion_tokens: int
+    usage_estimated: bool
+
+
+async def _complete_with_retries(
+        messages: list[dict],
+        *,
+        model: str,
+        temperature: float,
+        label: str,
+        on_content: Optional[Callable[[str], None]],
+        should_stop: Optional[Callable[[], bool]] = None,
+) -> _CompletionResult:
+    """
+    Запрос с повторами, продолжением оборванного потока и предохранителем.
+    Каждая попытка проходит через общий ограничитель частоты (wpd/rate_limiter.py).
+
+    Ошибки API не выбрасывает (кроме открытого предохранителя): итог описывается _CompletionResult.
+    """
+    completion_id: Optional[str] = None
+    parts: list[str] = []
+    prompt_tokens = 0
+    completion_tokens = 0
+    usage_estimated = False
+    last_error: Optional[Exception] = None
+
+    for attempt in range(PPLX_MAX_RETRIES + 1):
+        request_messages = messages
+        if parts:
+            # Продолжение оборванного ответа: модель видит уже полученную часть
+            request_messages = [
+                *messages,
+                {"role": "assistant", "content": "".join(parts)},
+                {"role": "user", "content": _CONTINUE_PROMPT},
+            ]
+            metrics.inc("llm_stream_resumed")
+        received_before = len(parts)
+
+        # Ответ при резервировании неизвестен: резервируем вход, разницу списываем после попытки
+        reserved_tokens = token_budget.count_message_tokens(request_messages)
+        await limiter.acquire(reserved_tokens, label)
+
+        try:
+            attempt_id, usage = await _gated_stream(
+                request_messages,
+                model=model,
+                temperature=temperature,
+                label=label,
+                parts=parts,
+                on_content=on_content,
+                should_stop=should_stop,
+            )
+        except CircuitOpenError:
+            limiter.settle(reserved_tokens, 0)
+            raise
+        except asyncio.CancelledError:
+            limiter.settle(reserved_tokens, reserved_tokens + token_budget.estimate_tokens("".join(parts[received_before:])))
+            raise
+        except Exception as error:
+            last_error = error
+            if not _is_retryable(error):
+                limiter.settle(reserved_tokens, 0)
+                break
+            # Токены оборванной попытки тоже оплачены, но usage не пришёл — оцениваем
+            if isinstance(error, _StreamInterrupted):
+                attempt_completion = token_budget.estimate_tokens("".join(parts[received_before:]))
+                prompt_tokens += reserved_tokens
+                completion_tokens += attempt_completion
+                usage_estimated = True
+                limiter.settle(reserved_tokens, reserved_tokens + attempt_completion)
+            else:
+                limiter.settle(reserved_tokens, 0)
+            if attempt == PPLX_MAX_RETRIES:
+                break
+            delay = _backoff_delay(attempt, error)
+            print(
+                f"Временная ошибка API{label}: {error}. "
+                f"Повтор {attempt + 1}/{PPLX_MAX_RETRIES} через {delay:.1f} c"
+            )
+            metrics.inc("llm_retries")
+            await asyncio.sleep(delay)
+            continue
+
+        completion_id = completion_id or attempt_id
+        if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+            attempt_prompt = int(usage.prompt_tokens)
+            attempt_completion = int(getattr(usage, "completion_tokens", 0) or 0)
+        else:
+            attempt_prompt = reserved_tokens
+            attempt_completion = token_budget.estimate_tokens("".join(parts[received_before:]))
+            usage_estimated = True
+        prompt_tokens += attempt_prompt
+        completion_tokens += attempt_completion
+        limiter.settle(reserved_tokens, attempt_prompt + attempt_completion)
+        return _CompletionResult("".join(parts), completion_id, True, None, prompt_tokens, completion_tokens, usage_estimated)
+
+    return _CompletionResult("".join(parts), completion_id, False, last_error, prompt_tokens, completion_tokens, usage_estimated)
+
+
+async def _run_hedged(
+        run: Callable[[], Awaitable[_CompletionResult]],
+        delay: float,
+        label: str,
+        prompt_tokens: int,
+) -> _CompletionResult:
+    """
+    Запускает `run()`; если за `delay` секунд ответа нет — запускает дубликат.
+    Возвращает первый полный ответ, второй запрос отменяется.
+    """
+    primary = asyncio.ensure_future(run())
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+
+    print(f"Запрос{label} идёт дольше {delay:.1f} c (p95), запускаем дублирующий запрос")
+    metrics.inc("llm_hedges_started")
+    hedge = asyncio.ensure_future(run())
+    pending = {primary, hedge}
+    # Завершившиеся запросы и их результаты (в порядке завершения); chosen — чей результат возвращается
+    finished: dict[asyncio.Future, _CompletionResult] = {}
+    chosen: Optional[asyncio.Future] = None
+    error: Optional[BaseException] = None
+    try:
+        while pending and chosen is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    finished[task] = task.result()
+                except Exception as task_error:
+                    error = task_error
+                    continue
+                if chosen is None and finished[task].complete:
+                    chosen = task
+        if chosen is None and finished:
+            # Полного ответа нет ни у одного запроса — возвращаем первую полученную часть
+            chosen = next(iter(finished))
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            # Дожидаемся отмены, чтобы соединение проигравшего запроса закрылось
+            await asyncio.gather(*pending, return_exceptions=True)
+            # Проигравший запрос тоже оплачивается (минимум — входные токены); точного usage у него нет
+            for _ in pending:
+                token_budget.record_usage(prompt_tokens, 0, label=f"{label} (дубликат)", estimated=True)
+        # Завершившиеся, но не выбранные запросы тоже оплачены: их usage учитывается здесь,
+        # usage выбранного — у вызывающего. С ограничителем частоты каждая попытка уже
+        # рассчиталась внутри _complete_with_retries.
+        for task, result in finished.items():
+            if task is not chosen:
+                token_budget.record_usage(
+                    result.prompt_tokens,
+                    result.completion_tokens,
+                    label=f"{label} (дубликат)",
+                    estimated=result.usage_estimated,
+                )
+
+    if chosen is not None:
+        if chosen is hedge and finished[chosen].complete:
+            metrics.inc("llm_hedges_won")
+        return finished[chosen]
+    raise error
+
+
+class _SinkDispatcher:
+    """
+    Раздаёт фрагменты ответа приёмникам и засекает время первого фрагмента.
+    """
+
+    def __init__(self, sinks: Sequence[StreamSink], started: float):
+        self.sinks = list(sinks)
+        self.started = started
+        self.first_token_seconds: Optional[float] = None
+
+    def mark(self, content: str) -> None:
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.monotonic() - self.started
+
+    def __call__(self, content: str) -> None:
+        self.mark(content)
+        for sink in self.sinks:
+            sink.on_content(content)
+
+    def should_stop(self) -> bool:
+        return any(sink.stop_stream for sink in self.sinks)
+
+    def finish(self, text: str, stats: CompletionStats) -> None:
+        for sink in self.sinks:
+            sink.on_finish(text, stats)
+
+
+def _report_stats(stats: CompletionStats) -> None:
+    """
+    Пишет статистику вызова в лог и метрики процесса.
+    """
+    if stats.cached:
+        metrics.observe("llm_cached_call_seconds", stats.total_seconds)
+        return
+
+    metrics.observe("llm_call_seconds", stats.total_seconds)
+    parts = [f"всего {stats.total_seconds:.1f} c"]
+    if stats.first_token_seconds is not None:
+        metrics.observe("llm_first_token_seconds", stats.first_token_seconds)
+        parts.insert(0, f"первый фрагмент через {stats.first_token_seconds:.1f} c")
+    if stats.tokens_per_second is not None:
+        metrics.observe("llm_tokens_per_second", stats.tokens_per_second)
+        parts.append(f"{stats.tokens_per_second:.0f} ток/с")
+    parts.append(f"id {stats.completion_id}")
+    print(f"Ответ{stats.label} ({stats.model}): " + ", ".join(parts))
+
+
+async def stream_chat_completion(
+        messages: list[dict],
+        *,
+        model: str = "sonar",
+        temperature: float = 0.4,
+        label: str = "",
+        sinks: Sequence[StreamSink] = (),
+        allow_partial: bool = False,
+        use_cache: bool = True,
+        hedge_group: Optional[str] = None,
+) -> tuple[str, Optional[str]]:
+    """
+    Отправляет потоковый запрос в Perplexity и собирает ответ.
+
+    Единственное место, где читается поток ответа: фрагменты раздаются приёмникам (wpd/stream_sinks.py —
+    печать, прогресс, разбор на лету), а по каждому вызову пишутся время до первого фрагмента,
+    общее время, скорость генерации и completion_id (лог и /metrics).
+
+    Временные ошибки (429, 5xx, обрыв соединения) повторяются с экспоненциальной паузой и джиттером,
+    с учётом Retry-After. Если поток оборвался на середине, следующий запрос просит модель продолжить
+    с места обрыва, а не генерировать ответ заново. Зависший поток (нет первого фрагмента или долгая пауза
+    между фрагментами) обрывается по таймауту и обрабатывается так же. При недоступности API срабатывает
+    предохранитель (см. CircuitBreaker) и запросы отклоняются сразу.
+
+    Args:
+        messages: история сообщений (OpenAI-совместимый формат)
+        model: модель Perplexity ("sonar", "sonar-pro")
+        temperature: температура генерации
+        label: уточнение для сообщений об ошибках (например " для таблицы 5")
+        sinks: приёмники фрагментов ответа (например [PrintSink()] для печати в консоль)
+        allow_partial: если все попытки исчерпаны, но часть ответа уже получена — вернуть её вместо ошибки
+        use_cache: брать ответ из постоянного кэша (wpd/llm_cache.py) и сохранять туда полный ответ
+        hedge_group: группа однотипных запросов (например "table") для учёта p95 длительности;
+            при PPLX_HEDGE_ENABLED запрос дольше p95 дублируется (см. _run_hedged)
+
+    Returns:
+        (answer_text, completion_id); для ответа из кэша completion_id = None
+
+    Raises:
+        ValueError: если запрос не помещается в окно модели даже после сокращения
+        ConnectionError: если API недоступен (в т.ч. открыт предохранитель)
+    """
+    started = time.monotonic()
+    if job_queue.wants_tokens():
+        # Фрагменты ответа нужны подписчику прогресса задания (/jobs/{id}/events?tokens=true)
+        sinks = [*sinks, JobEventSink(job_queue.emit, label)]
+    dispatch = _SinkDispatcher(sinks, started)
+
+    # Проверяем размер до отправки (см. wpd/token_budget.py): слишком большой запрос сокращается или отклоняется
+    messages = token_budget.fit_messages(messages, model, label)
+
+    cache_key: Optional[str] = None
+    if use_cache and llm_cache.LLM_CACHE_ENABLED:
+        try:
+            cache_key = llm_cache.make_key(model, messages, temperature)
+            cached = await run_blocking(llm_cache.get, cache_key)
+        except Exception as cache_error:
+            print(f"Кэш ответов недоступен: {cache_error}")
+            cache_key, cached = None, None
+        if cached is not None:
+            print(f"Ответ{label} взят из кэша")
+            token_budget.record_usage(0, 0, label=label, cached=True)
+            dispatch(cached)
+            stats = CompletionStats(
+                label=label,
+                model=model,
+                completion_id=None,
+                cached=True,
+                complete=True,
+                first_token_seconds=None,
+                total_seconds=time.monotonic() - started,
+                completion_tokens=0,
+                tokens_per_second=None,
+            )
+            _report_stats(stats)
+            dispatch.finish(cached, stats)
+            return cached, None
+
+    hedge_delay = None
+    if hedge_group:
+        p95 = _latency.p95(hedge_group)
+        if PPLX_HEDGE_ENABLED and p95 is not None:
+            hedge_delay = max(PPLX_HEDGE_MIN_DELAY, p95)
+
+    if hedge_delay is None:
+        result = await _complete_with_retries(
+            messages,
+            model=model,
+            temperature=temperature,
+            label=label,
+            on_content=dispatch,
+            should_stop=dispatch.should_stop,
+        )
+    else:
+        # Фрагменты двух параллельных запросов нельзя смешивать: приёмники получают ответ победителя целиком,
+        # а время первого фрагмента засекается по любому из запросов
+        result = await _run_hedged(
+            lambda: _complete_with_retries(
+                messages, model=model, temperature=temperature, label=label, on_content=dispatch.mark
+            ),
+            hedge_delay,
+            label,
+            token_budget.count_message_tokens(messages),
+        )
+        if result.text:
+            for sink in dispatch.sinks:
+                sink.on_content(result.text)
+
+    if not result.complete:
+        if not (allow_partial and result.text):
+            print(f"ОШИБКА при запросе к API{label}: {result.last_error}")
+            if isinstance(result.last_error, _StreamInterrupted):
+                raise Exception(f"Не удалось получить ответ от API{label}: {result.last_error}") from result.last_error
+            _raise_api_error(result.last_error, label)
+        print(f"Поток ответа{label} оборвался, используем полученную часть: {result.last_error}")
+    elif hedge_group:
+        _latency.record(hedge_group, time.monotonic() - started)
+
+    answer_text = result.text
+    completion_id = result.completion_id
+    complete = result.complete
+    total_seconds = time.monotonic() - started
+    token_budget.record_usage(
+        result.prompt_tokens,
+        result.completion_tokens,
+        label=label,
+        estimated=result.usage_estimated,
+        seconds=total_seconds,
+    )
+
+    tokens_per_second = None
+    if dispatch.first_token_seconds is not None and total_seconds > dispatch.first_token_seconds:
+        tokens_per_second = result.completion_tokens / (total_seconds - dispatch.first_token_seconds)
+    stats = CompletionStats(
+        label=label,
+        model=model,
+        completion_id=completion_id,
+        cached=False,
+        complete=complete,
+        first_token_seconds=dispatch.first_token_seconds,
+        total_seconds=total_seconds,
+        completion_tokens=result.completion_tokens,
+        tokens_per_second=tokens_per_second,
+    )
+    _report_stats(stats)
+    dispatch.finish(answer_text, stats)
+
+    # Неполные ответы не кэшируем, чтобы повторный запрос получил шанс на полный
+    if cache_key and complete and answer_text:
+        try:
+            await run_blocking(llm_cache.put, cache_key, answer_text)
+        except Exception as cache_error:
+            print(f"Не удалось сохранить ответ в кэш: {cache_error}")
+
+    return answer_text, completion_id
@@ -6,6 +6,8 @@ from typing import Iterable, Union, Tuple
 import re
 from docxtpl import DocxTemplate  # pip install docxtpl
 
+from wpd.compiled_template import COMPILED_TEMPLATES_AVAILABLE, CompiledDocxTemplate, get_compiled_template
+
 
 _KEY_CLEAN_RE = re.compile(r"^\s*\{\{\s*|\s*\}\}\s*$")
 
@@ -40,25 +42,14 @@ def _parse_pairs_from_text(text: str) -> list[tuple[str, str]]:
     return pairs
 
 
-def generate_docx_from_template(
+def render_template(
     data: Union[str, Iterable[Union[str, Tuple[str, str]]], dict],
     template_path: str,
-    output_path: str,
     all_variables: dict[str, str] | None = None,
-) -> None:
+) -> DocxTemplate:
     """
-    data:
-        - либо строка (ответ ИИ) вида "key:value; key2:value2; ..."
-        - либо список строк вида "key:value"
-        - либо список кортежей ("key", "value")
-        - либо словарь {"key": "value", ...}
-    template_path:
-        путь к docx-шаблону (с плейсхолдерами {{ key }})
-    output_path:
-        путь, куда сохранить сгенерированный docx
-    all_variables:
-        словарь со всеми переменными из шаблона (для поддержки условных блоков {% if переменная %})
-        Если передан, все переменные из этого словаря будут добавлены в контекст, даже если пустые
+    Рендерит шаблон в памяти и возвращает DocxTemplate (параметры — как у `generate_docx_from_template`).
+    Документ дальше можно дозаполнить (см. wpd/document_session.py) и сохранить один раз.
     """
     context = {}
 
@@ -109,7 +100,39 @@ def generate_docx_from_template(
             if key:
                 context[key] = value
     
-    doc = DocxTemplate(template_path)
+    # Шаблон берём скомпилированным (см. wpd/compiled_template.py): на рендер остаётся только подстановка.
+    # С несовместимой версией docxtpl — обычный разбор шаблона на каждый рендер
+    if COMPILED_TEMPLATES_AVAILABLE:
+        doc = CompiledDocxTemplate(get_compiled_template(template_path))
+    else:
+        doc = DocxTemplate(template_path)
     doc.render(context)
-    doc.save(output_path)
+    return doc
+
+
+def generate_docx_from_template(
+    data: Union[str, Iterable[Union[str, Tuple[str, str]]], dict],
+    template_path: str,
+    output_path: str,
+    all_variables: dict[str, str] | None = None,
+) -> None:
+    """
+    data:
+        - либо строка (ответ ИИ) вида "key:value; key2:value2; ..."
+        - либо список строк вида "key:value"
+        - либо список кортежей ("key", "value")
+        - либо словарь {"key": "value", ...}
+    template_path:
+        путь к docx-шаблону (с плейсхолдерами {{ key }})
+    output_path:
+        путь, куда сохранить сгенерированный docx
+    all_variables:
+        словарь со всеми переменными из шаблона (для поддержки условных блоков {% if переменная %})
+        Если передан, все переменные из этого словаря будут добавлены в контекст, даже если пустые
+    """
+    # Сохранение через DocumentSession: неизменённые части копируются из шаблона без перепаковки
+    # (wpd/docx_package.py). Импорт здесь — document_session сам импортирует этот модуль
+    from wpd.document_session import DocumentSession
+
+    DocumentSession.from_template(data, template_path, all_variables=all_variables).save(output_path)
 
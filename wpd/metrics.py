@@ -0,0 +1,46 @@
+"""
+Простой потокобезопасный реестр метрик процесса (счётчики и текущие значения).
+
+Веб-сервер и Telegram бот работают в одном процессе, поэтому метрики общие.
+Снимок отдаётся эндпоинтом /metrics в api.py.
+"""
+
+from __future__ import annotations
+
+import threading
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_gauges: dict[str, float] = {}
+_summaries: dict[str, dict[str, float]] = {}
+
+
+def inc(name: str, value: float = 1.0) -> None:
+    """Увеличивает счётчик `name` на `value`."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0.0) + value
+
+
+def set_gauge(name: str, value: float) -> None:
+    """Устанавливает текущее значение `name`."""
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    """Добавляет наблюдение в сводку `name` (количество, сумма, максимум)."""
+    with _lock:
+        summary = _summaries.setdefault(name, {"count": 0.0, "sum": 0.0, "max": 0.0})
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["max"] = max(summary["max"], value)
+
+
+def snapshot() -> dict:
+    """Возвращает копию всех метрик: {"counters": {...}, "gauges": {...}, "summaries": {...}}."""
+    with _lock:
+        return {
+            "counters": dict(sorted(_counters.items())),
+            "gauges": dict(sorted(_gauges.items())),
+            "summaries": {name: dict(s) for name, s in sorted(_summaries.items())},
+        }
@@ -0,0 +1,117 @@
+"""
+Общий для процесса ограничитель частоты запросов к Perplexity (token bucket).
+
+Веб-сервер и Telegram бот (run_all.py) работают в одном процессе, но в разных потоках и event loop'ах,
+поэтому состояние защищено threading.Lock, а ожидание — обычный asyncio.sleep в loop'е вызывающего.
+
+Два ведра: запросы в минуту (PPLX_RATE_LIMIT_RPM) и токены в минуту (PPLX_RATE_LIMIT_TPM).
+Ёмкость резервируется сразу (баланс может уйти в минус), а вызывающий ждёт, пока долг не погасится, —
+так запросы обслуживаются в порядке обращения и большой запрос не голодает за потоком мелких.
+Значение 0 отключает соответствующее ограничение.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+
+from wpd import metrics
+
+PPLX_RATE_LIMIT_RPM = float(os.getenv("PPLX_RATE_LIMIT_RPM", "50"))
+PPLX_RATE_LIMIT_TPM = float(os.getenv("PPLX_RATE_LIMIT_TPM", "0"))
+
+
+class _Bucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Списывает `amount` и возвращает, сколько секунд ждать до погашения долга.
+        """
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def release(self, amount: float) -> None:
+        """
+        Возвращает неиспользованный резерв `amount` (обратное к `reserve`).
+        """
+        self.level = min(self.capacity, self.level + min(amount, self.capacity))
+
+
+class RateLimiter:
+    """
+    Ограничитель запросов и токенов в минуту.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self._lock = threading.Lock()
+        self._requests = _Bucket(requests_per_minute)
+        self._tokens = _Bucket(tokens_per_minute)
+
+    async def acquire(self, tokens: int, label: str = "") -> float:
+        """
+        Резервирует один запрос и `tokens` токенов; ждёт, если ёмкости нет.
+
+        Returns:
+            время ожидания в очереди (секунды)
+        """
+        if not (self._requests.enabled or self._tokens.enabled):
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self._requests.enabled:
+                self._requests.refill(now)
+                wait = max(wait, self._requests.reserve(1))
+            if self._tokens.enabled:
+                self._tokens.refill(now)
+                wait = max(wait, self._tokens.reserve(tokens))
+
+        metrics.observe("llm_rate_limit_wait_seconds", wait)
+        if wait > 0:
+            metrics.inc("llm_rate_limit_delayed")
+            print(f"Лимит запросов к API{label}: ожидание {wait:.1f} c")
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # Запрос так и не отправлен (проигравшая попытка, отмена задания, таймаут) —
+                # резерв возвращается, иначе лимит считал бы ёмкость, которой никто не пользовался
+                with self._lock:
+                    now = time.monotonic()
+                    if self._requests.enabled:
+                        self._requests.refill(now)
+                        self._requests.release(1)
+                    if self._tokens.enabled:
+                        self._tokens.refill(now)
+                        self._tokens.release(tokens)
+                raise
+        return wait
+
+    def settle(self, reserved_tokens: int, actual_tokens: int) -> None:
+        """
+        Поправка после ответа: списывает разницу между фактическими и зарезервированными токенами
+        (ответ модели при резервировании неизвестен).
+        """
+        if not self._tokens.enabled or actual_tokens == reserved_tokens:
+            return
+        with self._lock:
+            self._tokens.refill(time.monotonic())
+            self._tokens.level -= actual_tokens - reserved_tokens
+
+
+limiter = RateLimiter(PPLX_RATE_LIMIT_RPM, PPLX_RATE_LIMIT_TPM)
@@ -1,89 +1,86 @@
-import json
+import io
 import os
 import uuid
 from pathlib import Path
 
 from docx import Document
-from openai import OpenAI
-
-# API ключ должен быть установлен через переменную окружения PPLX_API_KEY
-PPLX_API_KEY = os.getenv("PPLX_API_KEY")
-if not PPLX_API_KEY:
-    raise ValueError(
-        "PPLX_API_KEY не установлен. "
-        "Установите переменную окружения: export PPLX_API_KEY=your_key "
-        "или настройте на сервере через панель управления хостинга."
-    )
 
-client = OpenAI(
-    api_key=PPLX_API_KEY,
-    base_url="https://api.perplexity.ai",
-)
+from wpd import chat_store, retrieval, text_cache
+from wpd.docx_text import extract_docx_text
+from wpd.executors import run_blocking
+from wpd.template_artifact import peek_template_text
+from wpd.llm_client import stream_chat_completion
 
-# Путь к файлу истории чатов в корне проекта (рядом с main.py)
-DEFAULT_CHAT_STORE = str(Path(__file__).resolve().parent.parent / "perplexity_chats.json")
+# Путь к хранилищу истории чатов в корне проекта (рядом с main.py).
+# Старый perplexity_chats.json переносится в эту базу автоматически (см. wpd/chat_store.py).
+DEFAULT_CHAT_STORE = str(Path(__file__).resolve().parent.parent / "perplexity_chats.sqlite3")
 
 
 def _load_chat_messages(chat_id: str, store_path: str = DEFAULT_CHAT_STORE) -> list[dict]:
-    store_file = Path(store_path)
-    if not store_file.exists():
-        return []
-
     try:
-        data = json.loads(store_file.read_text(encoding="utf-8"))
-    except Exception:
+        return chat_store.load_messages(chat_id, store_path)
+    except Exception as e:
+        print(f"Не удалось загрузить историю чата {chat_id}: {e}")
         return []
 
-    msgs = data.get(chat_id, [])
-    return msgs if isinstance(msgs, list) else []
-
 
 def _save_chat_messages(chat_id: str, messages: list[dict], store_path: str = DEFAULT_CHAT_STORE) -> None:
-    store_file = Path(store_path)
-    data: dict = {}
+    chat_store.save_messages(chat_id, messages, store_path)
 
-    if store_file.exists():
-        try:
-            data = json.loads(store_file.read_text(encoding="utf-8"))
-        except Exception:
-            data = {}
 
-    data[chat_id] = messages
-    store_file.parent.mkdir(parents=True, exist_ok=True)
-    store_file.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+def _source_chat_id(chat_id: str) -> str:
+    # Полный текст материалов, если в основной чат попали только фрагменты (см. wpd/retrieval.py)
+    return f"{chat_id}:source"
 
 
-def read_docx_file(file_path: str) -> str:
+def load_source_text(chat_id: str, store_path: str = DEFAULT_CHAT_STORE) -> str | None:
+    """
+    Возвращает полный текст материалов чата, если для него выполнялся поиск по фрагментам, иначе None.
+    """
+    messages = _load_chat_messages(_source_chat_id(chat_id), store_path=store_path)
+    return messages[-1].get("content") if messages else None
+
+
+def _materials_for_prompt(
+        chat_id: str,
+        content: str,
+        queries: list[str],
+        store_path: str,
+) -> tuple[str, str]:
+    """
+    Если материалы больше бюджета контекста — оставляет только релевантные запросам фрагменты
+    и сохраняет полный текст для последующих запросов по таблицам.
+
+    Returns:
+        (текст для промпта, пометка к заголовку файла)
+    """
+    if not retrieval.needs_retrieval(content):
+        return content, ""
+
+    excerpt = retrieval.select_context(content, queries)
+    _save_chat_messages(_source_chat_id(chat_id), [{"role": "user", "content": content}], store_path=store_path)
+    print(
+        f"Материалы слишком большие (~{retrieval.estimate_tokens(content)} токенов), "
+        f"в запрос отобрано ~{retrieval.estimate_tokens(excerpt)} токенов"
+    )
+    return excerpt, " — фрагменты, относящиеся к запросу"
+
+
+def read_docx_file(file_path: str, data: bytes | None = None) -> str:
     """
     Читает содержимое DOCX или DOTM файла.
 
     Args:
         file_path: путь к файлу
+        data: уже прочитанное содержимое файла (если передано, файл повторно не читается)
 
     Returns:
         текстовое содержимое файла
     """
 
     try:
-        doc = Document(file_path)
-        text_parts = []
-
-        # Извлекаем текст из параграфов
-        for paragraph in doc.paragraphs:
-            if paragraph.text.strip():
-                text_parts.append(paragraph.text)
-
-        # Извлекаем текст из таблиц
-        for table in doc.tables:
-            for row in table.rows:
-                row_text = []
-                for cell in row.cells:
-                    if cell.text.strip():
-                        row_text.append(cell.text.strip())
-                if row_text:
-                    text_parts.append(" | ".join(row_text))
-
-        return "\n".join(text_parts) if text_parts else ""
+        doc = Document(io.BytesIO(data) if data is not None else file_path)
+        return extract_docx_text(doc)
     except Exception as e:
         raise ValueError(f"Не удалось прочитать DOCX файл {file_path}: {e}")
 
@@ -93,6 +90,10 @@ def read_file_content(file_path: str) -> str:
     Читает содержимое файла с автоматическим определением формата и кодировки.
     Поддерживает текстовые файлы, DOCX и DOTM.
 
+    Для шаблона, уже разобранного при запуске (wpd/template_artifact.py), текст берётся из артефакта.
+    Остальные файлы кэшируются по хэшу содержимого (wpd/text_cache.py): один и тот же файл
+    разбирается один раз, сколько бы раз и из какого процесса его ни читали.
+
     Args:
         file_path: путь к файлу
 
@@ -102,43 +103,86 @@ def read_file_content(file_path: str) -> str:
     Raises:
         ValueError: если файл не может быть прочитан
     """
+    template_text = peek_template_text(file_path)
+    if template_text is not None:
+        return template_text
+
     # Определяем расширение файла
     file_ext = os.path.splitext(file_path)[1].lower()
+    kind = "docx" if file_ext in ['.docx', '.dotm'] else "text"
+
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read()
+    except Exception as e:
+        raise ValueError(f"Не удалось прочитать файл {file_path}: {e}")
+
+    cache_key = text_cache.make_key(data, kind)
+    cached = text_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
     # Обработка DOCX и DOTM файлов
-    if file_ext in ['.docx', '.dotm']:
-        return read_docx_file(file_path)
+    if kind == "docx":
+        content = read_docx_file(file_path, data=data)
+    else:
+        content = _decode_text(data, file_path)
+
+    text_cache.put(cache_key, content)
+    return content
 
-    # Обработка текстовых файлов
+
+def _decode_text(data: bytes, file_path: str) -> str:
+    """
+    Декодирует содержимое текстового файла с автоматическим определением кодировки.
+    """
     # Список кодировок для попытки чтения
     encodings = ["utf-8", "cp1251", "latin-1", "iso-8859-1"]
 
     for encoding in encodings:
         try:
-            with open(file_path, "r", encoding=encoding) as f:
-                return f.read()
+            text = data.decode(encoding)
         except UnicodeDecodeError:
             continue
-        except Exception as e:
-            raise ValueError(f"Не удалось прочитать файл {file_path}: {e}")
+        # Как при чтении в текстовом режиме: переводы строк приводим к '\n'
+        return text.replace("\r\n", "\n").replace("\r", "\n")
 
-    # Если все кодировки не подошли, пробуем прочитать как бинарный и предупреждаем
-    try:
-        with open(file_path, "rb") as f:
-            content = f.read()
-            # Проверяем, является ли файл текстовым (первые байты)
-            if b'\x00' in content[:1024]:  # Наличие нулевых байтов указывает на бинарный файл
-                raise ValueError(
-                    f"Файл {file_path} является бинарным. "
-                    f"Поддерживаются только текстовые файлы и файлы формата DOCX/DOTM."
-                )
-            # Пробуем декодировать как UTF-8 с обработкой ошибок
-            return content.decode("utf-8", errors="replace")
-    except Exception as e:
-        raise ValueError(f"Не удалось прочитать файл {file_path}: {e}")
+    # Если все кодировки не подошли, проверяем, не бинарный ли это файл
+    # Проверяем, является ли файл текстовым (первые байты)
+    if b'\x00' in data[:1024]:  # Наличие нулевых байтов указывает на бинарный файл
+        raise ValueError(
+            f"Файл {file_path} является бинарным. "
+            f"Поддерживаются только текстовые файлы и файлы формата DOCX/DOTM."
+        )
+    # Пробуем декодировать как UTF-8 с обработкой ошибок
+    return data.decode("utf-8", errors="replace")
 
 
-def call_api_in_one(
+def materials_message(
+        chat_id: str,
+        file1_path: str,
+        file2_path: str,
+        fallback_queries: list[str],
+        store_path: str = DEFAULT_CHAT_STORE,
+) -> str:
+    """
+    Текст сообщения с шаблоном (файл 1) и учебником (файл 2) для основного чата.
+
+    Учебник, не помещающийся в контекст, заменяется фрагментами, относящимися к переменным шаблона
+    (или к `fallback_queries`, если переменных нет), а полный текст сохраняется для запросов по таблицам.
+    """
+    file1_content = read_file_content(file1_path)
+    file2_content = read_file_content(file2_path)
+    file2_content, file2_note = _materials_for_prompt(
+        chat_id, file2_content, retrieval.template_queries(file1_content) or list(fallback_queries), store_path
+    )
+    return (
+        f"Файл 1 ({os.path.basename(file1_path)}):\n{file1_content}\n\n"
+        f"Файл 2 ({os.path.basename(file2_path)}){file2_note}:\n{file2_content}"
+    )
+
+
+async def call_api_in_one(
         file1_path: str,
         file2_path: str,
         prompt: str,
@@ -153,7 +197,7 @@ def call_api_in_one(
     который можно передать потом и продолжить "тот же чат" как в Assistants API.
     Поэтому для "подключения к тому же чату" мы делаем правильно и надежно:
     - печатаем локальный **CHAT_ID**
-    - сохраняем историю `messages` в файл `perplexity_chats.json`
+    - сохраняем историю `messages` в локальное хранилище чатов (`perplexity_chats.sqlite3`)
     - при следующем вызове с тем же `thread_id` (CHAT_ID) подхватываем историю и продолжаем контекст
 
     Args:
@@ -162,7 +206,7 @@ def call_api_in_one(
         prompt: промпт для обработки файлов
         model: модель Perplexity (по умолчанию "sonar", также доступна "sonar-pro")
         thread_id: CHAT_ID для продолжения разговора (опционально)
-        store_path: путь к файлу-хранилищу истории чатов
+        store_path: путь к хранилищу истории чатов
 
     Returns:
         (answer_text, chat_id)
@@ -172,7 +216,8 @@ def call_api_in_one(
     chat_id = thread_id or str(uuid.uuid4())
     print(f"CHAT_ID: {chat_id}")
 
-    messages: list[dict] = _load_chat_messages(chat_id, store_path=store_path)
+    # Чтение истории, разбор файлов и отбор фрагментов — синхронная работа, она идёт в пуле потоков
+    messages: list[dict] = await run_blocking(_load_chat_messages, chat_id, store_path=store_path)
     print(f"Загружено сообщений из истории: {len(messages)} (store: {store_path})")
 
     if not any(m.get("role") == "system" for m in messages):
@@ -181,77 +226,23 @@ def call_api_in_one(
             {"role": "system", "content": "Вы — полезный ассистент, который анализирует файлы и отвечает на вопросы."},
         )
 
-    # Читаем содержимое файлов
-    file1_content = read_file_content(file1_path)
-    file2_content = read_file_content(file2_path)
-
-    messages.append(
-        {
-            "role": "user",
-            "content": (
-                f"Файл 1 ({os.path.basename(file1_path)}):\n{file1_content}\n\n"
-                f"Файл 2 ({os.path.basename(file2_path)}):\n{file2_content}\n\n"
-                f"Промпт: {prompt}"
-            ),
-        }
-    )
+    # Читаем содержимое файлов (учебник — целиком или фрагментами, см. materials_message)
+    materials = await run_blocking(materials_message, chat_id, file1_path, file2_path, [prompt], store_path)
 
-    # Параметры для потокового запроса
-    stream_params = {
-        "model": model,
-        "messages": messages,
-        "temperature": 0.4,
-        "stream": True
-    }
+    messages.append({"role": "user", "content": f"{materials}\n\nПромпт: {prompt}"})
 
-    # Отправляем потоковый запрос с обработкой ошибок
-    try:
-        stream = client.chat.completions.create(**stream_params)
-    except Exception as api_error:
-        error_msg = str(api_error)
-        if "api_key" in error_msg.lower() or "authentication" in error_msg.lower() or "401" in error_msg:
-            raise ValueError(
-                f"Ошибка аутентификации API: Проверьте что PPLX_API_KEY установлен правильно. "
-                f"Детали: {error_msg}"
-            )
-        elif "connection" in error_msg.lower() or "timeout" in error_msg.lower() or "network" in error_msg.lower():
-            raise ConnectionError(
-                f"Ошибка подключения к Perplexity API: {error_msg}. "
-                f"Проверьте интернет-соединение и доступность api.perplexity.ai"
-            )
-        else:
-            raise Exception(f"Ошибка при запросе к Perplexity API: {error_msg}")
-
-    # В streaming у чанков обычно есть chunk.id (completion id). Это НЕ chat/thread id, но полезно для логов.
-    completion_id: str | None = None
-    full_response = ""
-
-    for chunk in stream:
-        if completion_id is None and hasattr(chunk, "id") and chunk.id:
-            completion_id = chunk.id
-
-        # Собираем содержимое ответа
-        if getattr(chunk, "choices", None) and len(chunk.choices) > 0:
-            delta = chunk.choices[0].delta
-            content = None
-
-            if hasattr(delta, "content"):
-                content = delta.content
-            elif isinstance(delta, dict):
-                content = delta.get("content")
-
-            if content:
-                full_response += content
+    # Отправляем потоковый запрос (ошибки API переклассифицируются внутри)
+    full_response, _completion_id = await stream_chat_completion(messages, model=model, temperature=0.4)
 
     # Сохраняем историю для продолжения "того же чата" через CHAT_ID
     if full_response:
         messages.append({"role": "assistant", "content": full_response})
-        _save_chat_messages(chat_id, messages, store_path=store_path)
+        await run_blocking(_save_chat_messages, chat_id, messages, store_path=store_path)
 
     return (full_response if full_response else "Ответ не содержит данных.", chat_id)
 
 
-def call_api_in_two(
+async def call_api_in_two(
         file1_path: str,
         prompt: str,
         model: str = "sonar",
@@ -265,7 +256,7 @@ def call_api_in_two(
     который можно передать потом и продолжить "тот же чат" как в Assistants API.
     Поэтому для "подключения к тому же чату" мы делаем правильно и надежно:
     - печатаем локальный **CHAT_ID**
-    - сохраняем историю `messages` в файл `perplexity_chats.json`
+    - сохраняем историю `messages` в локальное хранилище чатов (`perplexity_chats.sqlite3`)
     - при следующем вызове с тем же `thread_id` (CHAT_ID) подхватываем историю и продолжаем контекст
 
     Args:
@@ -273,7 +264,7 @@ def call_api_in_two(
         prompt: промпт для обработки файлов
         model: модель Perplexity (по умолчанию "sonar", также доступна "sonar-pro")
         thread_id: CHAT_ID для продолжения разговора (опционально)
-        store_path: путь к файлу-хранилищу истории чатов
+        store_path: путь к хранилищу истории чатов
 
     Returns:
         ответ от API в виде строки
@@ -284,13 +275,13 @@ def call_api_in_two(
             "Для call_api_in_two нужно передать thread_id (это ваш CHAT_ID из предыдущего запуска)."
         )
 
-    messages: list[dict] = _load_chat_messages(thread_id, store_path=store_path)
+    messages: list[dict] = await run_blocking(_load_chat_messages, thread_id, store_path=store_path)
     if not messages:
         raise ValueError(
             "История чата не найдена для указанного CHAT_ID.\n"
             f"- CHAT_ID: {thread_id}\n"
             f"- store: {store_path}\n"
-            "Сначала запустите call_api_in_one и возьмите CHAT_ID из консоли (и убедитесь, что сохранился perplexity_chats.json)."
+            "Сначала запустите call_api_in_one и возьмите CHAT_ID из консоли (и убедитесь, что история сохранилась в хранилище чатов)."
         )
 
     print(f"CHAT_ID: {thread_id}")
@@ -303,70 +294,26 @@ def call_api_in_two(
         )
 
     # Читаем содержимое файлов
-    file1_content = read_file_content(file1_path)
-
+    file1_content = await run_blocking(read_file_content, file1_path)
+    file1_content, file1_note = await run_blocking(_materials_for_prompt, thread_id, file1_content, [prompt], store_path)
 
     messages.append(
         {
             "role": "user",
             "content": (
-                f"Файл 1 ({os.path.basename(file1_path)}):\n{file1_content}\n\n"
+                f"Файл 1 ({os.path.basename(file1_path)}){file1_note}:\n{file1_content}\n\n"
                 f"Промпт: {prompt}"
             ),
         }
     )
 
-    # Параметры для потокового запроса
-    stream_params = {
-        "model": model,
-        "messages": messages,
-        "temperature": 0.4,
-        "stream": True
-    }
-
-    # Отправляем потоковый запрос с обработкой ошибок
-    try:
-        stream = client.chat.completions.create(**stream_params)
-    except Exception as api_error:
-        error_msg = str(api_error)
-        if "api_key" in error_msg.lower() or "authentication" in error_msg.lower() or "401" in error_msg:
-            raise ValueError(
-                f"Ошибка аутентификации API: Проверьте что PPLX_API_KEY установлен правильно. "
-                f"Детали: {error_msg}"
-            )
-        elif "connection" in error_msg.lower() or "timeout" in error_msg.lower() or "network" in error_msg.lower():
-            raise ConnectionError(
-                f"Ошибка подключения к Perplexity API: {error_msg}. "
-                f"Проверьте интернет-соединение и доступность api.perplexity.ai"
-            )
-        else:
-            raise Exception(f"Ошибка при запросе к Perplexity API: {error_msg}")
-
-    # В streaming у чанков обычно есть chunk.id (completion id). Это НЕ chat/thread id, но полезно для логов.
-    completion_id: str | None = None
-    full_response = ""
-
-    for chunk in stream:
-        if completion_id is None and hasattr(chunk, "id") and chunk.id:
-            completion_id = chunk.id
-
-        # Собираем содержимое ответа
-        if getattr(chunk, "choices", None) and len(chunk.choices) > 0:
-            delta = chunk.choices[0].delta
-            content = None
-
-            if hasattr(delta, "content"):
-                content = delta.content
-            elif isinstance(delta, dict):
-                content = delta.get("content")
-
-            if content:
-                full_response += content
+    # Отправляем потоковый запрос (ошибки API переклассифицируются внутри)
+    full_response, _completion_id = await stream_chat_completion(messages, model=model, temperature=0.4)
 
     # Сохраняем историю для продолжения "того же чата" через CHAT_ID
     if full_response:
         messages.append({"role": "assistant", "content": full_response})
-        _save_chat_messages(thread_id, messages, store_path=store_path)
+        await run_blocking(_save_chat_messages, thread_id, messages, store_path=store_path)
 
     return full_response if full_response else "Ответ не содержит данных."
 
@@ -0,0 +1,261 @@
+"""
+Локальный поиск по учебным материалам (BM25 на NumPy, без внешних сервисов).
+
+Большой учебник целиком в каждый запрос не помещается: запросы становятся медленными,
+а при превышении контекста модели API отвечает ошибкой 400. Поэтому текст режется на фрагменты,
+по ним строится индекс BM25, и каждый промпт (переменные шаблона, каждая таблица) получает
+только самые релевантные фрагменты в пределах бюджета токенов.
+
+Материалы, которые укладываются в бюджет, отправляются целиком, как раньше.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Sequence
+
+import numpy as np
+
+from wpd import metrics
+
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true").lower() == "true"
+# Бюджет (в токенах) на фрагменты материалов в одном запросе; материалы меньше бюджета идут целиком
+RETRIEVAL_CONTEXT_TOKENS = int(os.getenv("RETRIEVAL_CONTEXT_TOKENS", "16000"))
+# Размер одного фрагмента (в токенах) и сколько лучших фрагментов брать на один поисковый запрос
+RETRIEVAL_CHUNK_TOKENS = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "400"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+# Сколько построенных индексов держать в памяти
+RETRIEVAL_INDEX_CACHE_SIZE = int(os.getenv("RETRIEVAL_INDEX_CACHE_SIZE", "8"))
+
+# Грубая оценка: для русского текста ~3 символа на токен
+_CHARS_PER_TOKEN = 3
+# Русские слова сильно меняют окончания, поэтому сравниваем по началу слова
+_STEM_LENGTH = 6
+
+_WORD_RE = re.compile(r"[^\W_]+")
+_VARIABLE_RE = re.compile(r"\{\{\s*([^}]+)\s*\}\}")
+_STOP_WORDS = frozenset(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было "
+    "вот от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас нибудь "
+    "опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была "
+    "сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним "
+    "здесь этом один почти мой тем чтобы нее были куда зачем всех никогда можно при наконец два об "
+    "другой хоть после над больше тот через эти нас про всего них какая много разве три эту моя "
+    "впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между "
+    "это нужно тебе твоя твой нужно который которые которых также либо".split()
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Приблизительное число токенов в тексте.
+    """
+    return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Разбивает текст на нормализованные термы (нижний регистр, ё→е, усечение до основы, без стоп-слов).
+    """
+    terms = []
+    for word in _WORD_RE.findall(text.lower().replace("ё", "е")):
+        if len(word) < 2 or word in _STOP_WORDS:
+            continue
+        terms.append(word[:_STEM_LENGTH])
+    return terms
+
+
+def split_into_chunks(text: str, chunk_tokens: int = RETRIEVAL_CHUNK_TOKENS) -> list[str]:
+    """
+    Режет текст на фрагменты примерно по `chunk_tokens` токенов, стараясь не разрывать абзацы.
+    """
+    max_chars = max(1, chunk_tokens) * _CHARS_PER_TOKEN
+    chunks: list[str] = []
+    current: list[str] = []
+    current_len = 0
+
+    def _flush() -> None:
+        nonlocal current, current_len
+        if current:
+            chunks.append("\n".join(current))
+        current, current_len = [], 0
+
+    for paragraph in text.split("\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Слишком длинный абзац режем по словам
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            _flush()
+            chunks.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if current_len + len(paragraph) > max_chars:
+            _flush()
+        current.append(paragraph)
+        current_len += len(paragraph) + 1
+    _flush()
+    return chunks
+
+
+class BM25Index:
+    """
+    Индекс BM25 по списку фрагментов.
+
+    Постинги хранятся в плоских массивах NumPy, отсортированных по терму
+    (аналог CSR-матрицы терм × фрагмент), с заранее посчитанным весом BM25 для каждой пары.
+    Оценка запроса — сложение весов через np.bincount, без циклов по фрагментам.
+    """
+
+    def __init__(self, chunks: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self.chunks = list(chunks)
+        self.chunk_tokens = np.array([estimate_tokens(c) for c in self.chunks], dtype=np.int64)
+        self.vocabulary: dict[str, int] = {}
+
+        term_ids: list[int] = []
+        doc_ids: list[int] = []
+        freqs: list[int] = []
+        lengths = np.zeros(len(self.chunks), dtype=np.float64)
+        for doc_id, chunk in enumerate(self.chunks):
+            counts = Counter(tokenize(chunk))
+            lengths[doc_id] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                doc_ids.append(doc_id)
+                freqs.append(tf)
+
+        terms = np.array(term_ids, dtype=np.int64)
+        order = np.argsort(terms, kind="stable")
+        terms = terms[order]
+        self._doc_ids = np.array(doc_ids, dtype=np.int64)[order]
+        tf = np.array(freqs, dtype=np.float64)[order]
+
+        n_docs = max(1, len(self.chunks))
+        df = np.bincount(terms, minlength=len(self.vocabulary)).astype(np.float64)
+        # Начало постингов каждого терма: _offsets[t]:_offsets[t + 1]
+        self._offsets = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        avg_length = float(lengths.mean()) if len(lengths) and lengths.mean() > 0 else 1.0
+        norm = k1 * (1.0 - b + b * lengths[self._doc_ids] / avg_length)
+        self._weights = idf[terms] * tf * (k1 + 1.0) / (tf + norm)
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        Оценки BM25 всех фрагментов для запроса.
+        """
+        term_ids = sorted({self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary})
+        if not term_ids or not self.chunks:
+            return np.zeros(len(self.chunks), dtype=np.float64)
+        slices = [np.arange(self._offsets[t], self._offsets[t + 1]) for t in term_ids]
+        positions = np.concatenate(slices)
+        return np.bincount(self._doc_ids[positions], weights=self._weights[positions], minlength=len(self.chunks))
+
+    def search(self, query: str, top_k: int = RETRIEVAL_TOP_K) -> list[int]:
+        """
+        Индексы до `top_k` лучших фрагментов (только с ненулевой оценкой), по убыванию оценки.
+        """
+        scores = self.scores(query)
+        if top_k <= 0 or not scores.any():
+            return []
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [int(i) for i in best if scores[i] > 0]
+
+
+_lock = threading.Lock()
+_indexes: "OrderedDict[str, BM25Index]" = OrderedDict()
+
+
+def get_index(text: str) -> BM25Index:
+    """
+    Возвращает индекс для текста (строит при первом обращении, держит несколько последних в памяти).
+    """
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+
+    index = BM25Index(split_into_chunks(text))
+    metrics.inc("retrieval_indexes_built")
+    print(f"Построен поисковый индекс по материалам: фрагментов {len(index.chunks)}, термов {len(index.vocabulary)}")
+
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > max(1, RETRIEVAL_INDEX_CACHE_SIZE):
+            _indexes.popitem(last=False)
+    return index
+
+
+def needs_retrieval(text: str, budget_tokens: int = RETRIEVAL_CONTEXT_TOKENS) -> bool:
+    """
+    True, если материалы не помещаются в бюджет и их нужно заменять выбранными фрагментами.
+    """
+    return RETRIEVAL_ENABLED and estimate_tokens(text) > budget_tokens
+
+
+def template_queries(template_text: str) -> list[str]:
+    """
+    Поисковые запросы по переменным шаблона: по одному на каждую {{ПЕРЕМЕННУЮ}}.
+    """
+    queries = []
+    for match in _VARIABLE_RE.findall(template_text):
+        query = match.replace("_", " ").strip()
+        if query and query not in queries:
+            queries.append(query)
+    return queries
+
+
+def select_context(
+    text: str,
+    queries: Sequence[str],
+    budget_tokens: int = RETRIEVAL_CONTEXT_TOKENS,
+    top_k: int = RETRIEVAL_TOP_K,
+) -> str:
+    """
+    Собирает из материалов фрагменты, релевантные запросам, в пределах `budget_tokens`.
+
+    Лучшие фрагменты разных запросов берутся по очереди (сначала первый по каждому запросу, затем второй...),
+    чтобы каждая переменная или таблица получила свою долю бюджета.
+    Фрагменты возвращаются в порядке следования в материалах; пропуски отмечаются "[...]".
+    """
+    index = get_index(text)
+    ranked = [index.search(q, top_k) for q in queries if q.strip()]
+
+    selected: set[int] = set()
+    used = 0
+    for rank in range(max((len(r) for r in ranked), default=0)):
+        for hits in ranked:
+            if rank >= len(hits) or hits[rank] in selected:
+                continue
+            size = int(index.chunk_tokens[hits[rank]])
+            if used + size > budget_tokens:
+                continue
+            selected.add(hits[rank])
+            used += size
+
+    if not selected:
+        # Совпадений нет — отдаём начало материалов (обычно там оглавление и введение)
+        for i, size in enumerate(index.chunk_tokens):
+            if used + int(size) > budget_tokens:
+                break
+            selected.add(i)
+            used += int(size)
+
+    metrics.inc("retrieval_selections")
+    parts = []
+    previous = -1
+    for i in sorted(selected):
+        if previous >= 0 and i != previous + 1:
+            parts.append("[...]")
+        parts.append(index.chunks[i])
+        previous = i
+    return "\n".join(parts)
@@ -0,0 +1,188 @@
+"""
+Приёмники (sinks) потокового ответа модели для `stream_chat_completion`.
+
+Поток ответа читается в одном месте (wpd/llm_client.py), а что делать с фрагментами
+решают подключаемые приёмники: накопить текст, разбирать по мере поступления,
+сообщать о прогрессе, печатать в консоль. В конце каждый приёмник получает полный текст
+и статистику вызова (CompletionStats).
+"""
+
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Optional, Protocol
+
+
+@dataclass(frozen=True)
+class CompletionStats:
+    """
+    Статистика одного вызова модели (с учётом повторов и продолжений оборванного потока).
+    """
+
+    label: str
+    model: str
+    completion_id: Optional[str]
+    cached: bool
+    complete: bool
+    # Время до первого фрагмента ответа, общее время вызова (секунды)
+    first_token_seconds: Optional[float]
+    total_seconds: float
+    completion_tokens: int
+    # Скорость генерации после первого фрагмента
+    tokens_per_second: Optional[float]
+
+
+class StreamSink:
+    """
+    Базовый приёмник: методы по умолчанию ничего не делают.
+
+    Если приёмник выставил `stop_stream = True`, остаток ответа не дочитывается (поток закрывается).
+    """
+
+    stop_stream = False
+
+    def on_content(self, content: str) -> None:
+        pass
+
+    def on_finish(self, text: str, stats: CompletionStats) -> None:
+        pass
+
+
+class AccumulateSink(StreamSink):
+    """
+    Накапливает фрагменты (join в конце, без квадратичной конкатенации строк).
+    """
+
+    def __init__(self):
+        self.parts: list[str] = []
+        self.stats: Optional[CompletionStats] = None
+
+    def on_content(self, content: str) -> None:
+        self.parts.append(content)
+
+    def on_finish(self, text: str, stats: CompletionStats) -> None:
+        self.stats = stats
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+class PrintSink(StreamSink):
+    """
+    Печатает ответ в консоль по мере поступления.
+    """
+
+    def on_content(self, content: str) -> None:
+        print(content, end="", flush=True)
+
+    def on_finish(self, text: str, stats: CompletionStats) -> None:
+        print()
+
+
+class ProgressSink(StreamSink):
+    """
+    Вызывает callback(received_chars, finished) не чаще раза в `min_interval` секунд и в конце ответа.
+    """
+
+    def __init__(self, callback: Callable[[int, bool], None], min_interval: float = 1.0):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.received_chars = 0
+        self._last_report = 0.0
+
+    def on_content(self, content: str) -> None:
+        self.received_chars += len(content)
+        now = time.monotonic()
+        if now - self._last_report >= self.min_interval:
+            self._last_report = now
+            self.callback(self.received_chars, False)
+
+    def on_finish(self, text: str, stats: CompletionStats) -> None:
+        self.callback(len(text), True)
+
+
+class JobEventSink(StreamSink):
+    """
+    Передаёт фрагменты ответа подписчикам прогресса задания: emit("tokens", label=..., text=...)
+    пачками не чаще раза в `min_interval` секунд, остаток — в конце ответа.
+    """
+
+    def __init__(self, emit: Callable[..., None], label: str, min_interval: float = 0.25):
+        self.emit = emit
+        self.label = label
+        self.min_interval = min_interval
+        self._parts: list[str] = []
+        self._last_emit = 0.0
+
+    def _flush(self, final: bool) -> None:
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._last_emit = time.monotonic()
+        if text or final:
+            self.emit("tokens", label=self.label, text=text, final=final)
+
+    def on_content(self, content: str) -> None:
+        self._parts.append(content)
+        if time.monotonic() - self._last_emit >= self.min_interval:
+            self._flush(False)
+
+    def on_finish(self, text: str, stats: CompletionStats) -> None:
+        self._flush(True)
+
+
+class IncrementalParser(Protocol):
+    done: bool
+
+    def feed(self, text: str) -> Iterable[Any]:
+        """Принимает очередной фрагмент и возвращает элементы, которые стали полностью известны."""
+
+    def finish(self) -> Iterable[Any]:
+        """Конец ответа: возвращает элементы, которые стали известны только теперь."""
+
+
+class IncrementalParseSink(StreamSink):
+    """
+    Разбирает ответ по мере поступления: каждый готовый элемент передаётся в on_item.
+
+    stop_on_done: прекратить чтение потока, как только парсер нашёл всё (parser.done),
+    чтобы не ждать и не оплачивать пояснения модели после ответа.
+    """
+
+    def __init__(
+        self,
+        parser: IncrementalParser,
+        on_item: Optional[Callable[[Any], None]] = None,
+        stop_on_done: bool = False,
+    ):
+        self.parser = parser
+        self.on_item = on_item
+        self.stop_on_done = stop_on_done
+        self.items: list[Any] = []
+
+    def _add(self, items: Iterable[Any]) -> None:
+        for item in items:
+            self.items.append(item)
+            if self.on_item is not None:
+                self.on_item(item)
+
+    def on_content(self, content: str) -> None:
+        self._add(self.parser.feed(content))
+        if self.stop_on_done and self.parser.done:
+            self.stop_stream = True
+
+    def on_finish(self, text: str, stats: CompletionStats) -> None:
+        self._add(self.parser.finish())
+
+
+class CallbackSink(StreamSink):
+    """
+    Передаёт каждый фрагмент в произвольную функцию.
+    """
+
+    def __init__(self, callback: Callable[[str], None]):
+        self.callback = callback
+
+    def on_content(self, content: str) -> None:
+        self.callback(content)
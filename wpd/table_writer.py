@@ -0,0 +1,153 @@
+"""
+Быстрая запись значений в таблицу docx на уровне XML.
+
+python-docx при каждом обращении к `table.rows[r].cells[c]` заново строит список строк
+и сетку ячеек строки (с разворотом gridSpan и поиском начала vMerge через XPath),
+а строки добавляет по одной (`add_row`). При заполнении значения за значением это квадратично:
+календарный план или списки оценочных средств на сотни строк заполнялись заметно дольше рендера.
+
+TableGrid строит сетку таблицы один раз, добавляет недостающие строки пачкой
+и пишет текст прямо в <w:tc>, сохраняя оформление ячейки (свойства абзаца и первого фрагмента).
+Адресация ячеек та же, что у python-docx: `row.cells[c]` с повтором объединённых ячеек.
+"""
+
+from __future__ import annotations
+
+import copy
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+# Свойства ячейки, которые описывают объединение и не должны переходить в новые строки
+_MERGE_TAGS = (qn("w:gridSpan"), qn("w:vMerge"), qn("w:hMerge"))
+
+
+class TableGrid:
+    """
+    Сетка ячеек одной таблицы: rows[r][c] — элемент <w:tc>, как `table.rows[r].cells[c]._tc`.
+    """
+
+    def __init__(self, table):
+        self._tbl = table._tbl
+        self.rows: list[list] = []
+        above: dict[int, object] = {}
+        for tr in self._tbl.tr_lst:
+            cells, above = _resolve_row(tr, above)
+            self.rows.append(cells)
+
+    @property
+    def max_row_cells(self) -> int:
+        return max((len(r) for r in self.rows), default=0)
+
+    def ensure_rows(self, count: int) -> None:
+        """
+        Добавляет строки в конец таблицы, пока их не станет `count`.
+        Новые строки — по ячейке на колонку сетки (как `table.add_row()`), с оформлением последней строки.
+        """
+        missing = count - len(self.rows)
+        if missing <= 0:
+            return
+        prototype = self._row_prototype()
+        for _ in range(missing):
+            tr = copy.deepcopy(prototype)
+            self._tbl.append(tr)
+            self.rows.append(list(tr.tc_lst))
+
+    def _row_prototype(self):
+        tbl = self._tbl
+        last_tr = tbl.tr_lst[-1] if self.rows else None
+        last_offsets: dict[int, object] = {}
+        if last_tr is not None:
+            offset = last_tr.grid_before
+            for tc in last_tr.tc_lst:
+                for i in range(tc.grid_span):
+                    last_offsets[offset + i] = tc
+                offset += tc.grid_span
+
+        tr = OxmlElement("w:tr")
+        if last_tr is not None and last_tr.trPr is not None:
+            trPr = copy.deepcopy(last_tr.trPr)
+            # Повтор заголовка и пропуски сетки относятся к исходной строке, а не к новым
+            for tag in ("w:tblHeader", "w:gridBefore", "w:gridAfter", "w:wBefore", "w:wAfter"):
+                for el in trPr.findall(qn(tag)):
+                    trPr.remove(el)
+            tr.append(trPr)
+
+        for col, gridCol in enumerate(tbl.tblGrid.gridCol_lst):
+            tc = OxmlElement("w:tc")
+            source = last_offsets.get(col)
+            if source is not None and source.tcPr is not None:
+                tcPr = copy.deepcopy(source.tcPr)
+                for el in list(tcPr):
+                    if el.tag in _MERGE_TAGS:
+                        tcPr.remove(el)
+                tc.append(tcPr)
+            if gridCol.w is not None:
+                tc.width = gridCol.w
+            p = tc.add_p()
+            pPr, rPr = _cell_formatting(source) if source is not None else (None, None)
+            if pPr is not None:
+                p.append(copy.deepcopy(pPr))
+            if rPr is not None:
+                r = p.add_r()
+                r.append(copy.deepcopy(rPr))
+            tr.append(tc)
+        return tr
+
+    def write(self, row: int, col: int, text: str) -> None:
+        set_cell_text(self.rows[row][col], text)
+
+    def write_row_major(self, values, cols_per_row: int, start_row: int, start_col: int) -> None:
+        """
+        Записывает значения слева-направо, сверху-вниз (см. `fill_table_row_major`), добавляя строки при нехватке.
+        """
+        self.ensure_rows(start_row + ((len(values) + cols_per_row - 1) // cols_per_row))
+        for idx, value in enumerate(values):
+            self.write(start_row + (idx // cols_per_row), start_col + (idx % cols_per_row), str(value))
+
+
+def _resolve_row(tr, above: dict) -> tuple[list, dict]:
+    """
+    Разворачивает строку в список ячеек: gridSpan повторяет ячейку,
+    продолжение vMerge ссылается на ячейку-начало из строки выше (`above`: колонка сетки -> ячейка).
+    Возвращает ячейки строки и такую же карту колонок для следующей строки.
+    """
+    cells = []
+    offsets: dict[int, object] = {}
+    offset = tr.grid_before
+    for tc in tr.tc_lst:
+        span = tc.grid_span
+        root = above.get(offset, tc) if tc.vMerge == "continue" else tc
+        for i in range(span):
+            offsets[offset + i] = root
+            cells.append(root)
+        offset += span
+    return cells, offsets
+
+
+def _cell_formatting(tc):
+    """
+    Свойства первого абзаца и первого фрагмента текста ячейки (pPr, rPr) или None.
+    """
+    p = tc.find(qn("w:p"))
+    if p is None:
+        return None, None
+    r = p.find(qn("w:r"))
+    return p.pPr, (r.rPr if r is not None else None)
+
+
+def set_cell_text(tc, text: str) -> None:
+    """
+    Заменяет содержимое ячейки текстом (как `_Cell.text = text`), но сохраняет оформление
+    первого абзаца и первого фрагмента — шрифт, размер и выравнивание из шаблона.
+    """
+    # Элементы pPr/rPr переносятся в новый абзац (lxml перемещает узел), копировать их не нужно
+    pPr, rPr = _cell_formatting(tc)
+    tc.clear_content()
+    p = tc.add_p()
+    if pPr is not None:
+        p.insert(0, pPr)
+    r = p.add_r()
+    if rPr is not None:
+        r.insert(0, rPr)
+    r.text = text
+
@@ -14,6 +14,7 @@ class TableFillSpec:
     start_row: int            # с какой строки начинать (например 1, если 0-я строка — заголовок)
     start_col: int            # с какой колонки начинать
     prompt_idx: int           # индекс промпта в table_prompts.TABLE_PROMPTS
+    depends_on: tuple[int, ...] = ()  # table_index таблиц, ответы по которым нужны в контексте этой таблицы
 
 
 """
@@ -34,9 +35,10 @@ TABLE_SPECS: list[TableFillSpec] = [
     TableFillSpec(table_index=1, cols_per_row=3, start_row=1, start_col=0, prompt_idx=0),
     TableFillSpec(table_index=2, cols_per_row=2, start_row=2, start_col=1, prompt_idx=1),
     TableFillSpec(table_index=3, cols_per_row=6, start_row=1, start_col=0, prompt_idx=2),
-    TableFillSpec(table_index=4, cols_per_row=2, start_row=1, start_col=0, prompt_idx=3),
-    TableFillSpec(table_index=5, cols_per_row=6, start_row=1, start_col=0, prompt_idx=4),
-    TableFillSpec(table_index=6, cols_per_row=5, start_row=1, start_col=0, prompt_idx=5),
+    # Таблицы 4-6 ссылаются на разделы дисциплины из таблицы 3
+    TableFillSpec(table_index=4, cols_per_row=2, start_row=1, start_col=0, prompt_idx=3, depends_on=(3,)),
+    TableFillSpec(table_index=5, cols_per_row=6, start_row=1, start_col=0, prompt_idx=4, depends_on=(3,)),
+    TableFillSpec(table_index=6, cols_per_row=5, start_row=1, start_col=0, prompt_idx=5, depends_on=(3,)),
     TableFillSpec(table_index=7, cols_per_row=3, start_row=1, start_col=0, prompt_idx=6),
     TableFillSpec(table_index=8, cols_per_row=3, start_row=1, start_col=0, prompt_idx=7),
     TableFillSpec(table_index=9, cols_per_row=2, start_row=1, start_col=0, prompt_idx=8),
@@ -0,0 +1,166 @@
+"""
+Предразобранный шаблон РПД (files/Шаблон.docx), который строится один раз при запуске.
+
+Артефакт содержит всё, что раньше каждый запрос извлекал из .docx заново:
+- байты файла (docxtpl рендерит из памяти, без чтения с диска);
+- текст шаблона для промпта (read_file_content);
+- список переменных {{ ... }} (эндпоинт /template/variables);
+- карту таблиц (индекс, размеры, заголовок).
+
+Артефакт пересобирается только если у файла изменились mtime/размер и при этом хэш содержимого.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import re
+import threading
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Optional
+
+from docx import Document
+
+from wpd.docx_text import extract_docx_text
+
+DEFAULT_TEMPLATE_PATH = str(Path(__file__).resolve().parent.parent / "files" / "Шаблон.docx")
+
+# Регулярное выражение для поиска переменных в формате {{переменная}}
+_VARIABLE_RE = re.compile(r'\{\{\s*([^}]+)\s*\}\}')
+
+
+@dataclass(frozen=True)
+class TemplateTableInfo:
+    """
+    Описание одной таблицы шаблона (индекс как в python-docx: doc.tables[doc_index]).
+    """
+
+    doc_index: int
+    rows: int
+    max_row_cells: int
+    header: str
+
+
+@dataclass(frozen=True)
+class TemplateArtifact:
+    """
+    Результат однократного разбора шаблона.
+    """
+
+    path: str
+    mtime: float
+    size: int
+    sha256: str
+    data: bytes
+    prompt_text: str
+    variables: tuple[str, ...]
+    tables: tuple[TemplateTableInfo, ...]
+
+
+_lock = threading.Lock()
+_artifacts: dict[str, TemplateArtifact] = {}
+
+
+def _extract_variables(doc) -> tuple[str, ...]:
+    variables = set()
+
+    # Извлекаем текст из параграфов
+    for paragraph in doc.paragraphs:
+        for match in _VARIABLE_RE.findall(paragraph.text):
+            var_name = match.strip()
+            if var_name:
+                variables.add(var_name)
+
+    # Извлекаем текст из таблиц
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                for match in _VARIABLE_RE.findall(cell.text):
+                    var_name = match.strip()
+                    if var_name:
+                        variables.add(var_name)
+
+    return tuple(sorted(variables))
+
+
+def _describe_tables(doc) -> tuple[TemplateTableInfo, ...]:
+    tables = []
+    for i, table in enumerate(doc.tables):
+        rows = table.rows
+        max_cells = max((len(r.cells) for r in rows), default=0)
+        header = " | ".join(c.text.strip() for c in (rows[0].cells if len(rows) else []))[:120]
+        tables.append(TemplateTableInfo(doc_index=i, rows=len(rows), max_row_cells=max_cells, header=header))
+    return tuple(tables)
+
+
+def _build(path: str, st: os.stat_result, data: bytes, digest: str) -> TemplateArtifact:
+    try:
+        doc = Document(io.BytesIO(data))
+    except Exception as e:
+        raise ValueError(f"Не удалось прочитать шаблон {path}: {e}")
+
+    return TemplateArtifact(
+        path=path,
+        mtime=st.st_mtime,
+        size=st.st_size,
+        sha256=digest,
+        data=data,
+        prompt_text=extract_docx_text(doc),
+        variables=_extract_variables(doc),
+        tables=_describe_tables(doc),
+    )
+
+
+def get_template_artifact(template_path: str = DEFAULT_TEMPLATE_PATH) -> TemplateArtifact:
+    """
+    Возвращает артефакт шаблона, собирая его при первом обращении или после изменения файла.
+
+    Raises:
+        FileNotFoundError: если шаблона нет
+        ValueError: если шаблон не удалось разобрать
+    """
+    path = str(Path(template_path).resolve())
+    st = os.stat(path)
+
+    with _lock:
+        artifact = _artifacts.get(path)
+        if artifact is not None and artifact.mtime == st.st_mtime and artifact.size == st.st_size:
+            return artifact
+
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+
+        if artifact is not None and artifact.sha256 == digest:
+            # Файл "тронули", но содержимое то же — пересобирать не нужно
+            artifact = replace(artifact, mtime=st.st_mtime, size=st.st_size)
+        else:
+            artifact = _build(path, st, data, digest)
+            print(
+                f"Шаблон разобран: {path} (переменных: {len(artifact.variables)}, "
+                f"таблиц: {len(artifact.tables)}, sha256: {digest[:12]})"
+            )
+        _artifacts[path] = artifact
+        return artifact
+
+
+def peek_template_text(file_path: str) -> Optional[str]:
+    """
+    Возвращает текст для промпта, если для этого файла уже есть актуальный артефакт, иначе None.
+
+    Ничего не собирает: используется в read_file_content, чтобы шаблон не разбирался повторно.
+    """
+    path = str(Path(file_path).resolve())
+    with _lock:
+        artifact = _artifacts.get(path)
+    if artifact is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if artifact.mtime != st.st_mtime or artifact.size != st.st_size:
+        return None
+    return artifact.prompt_text
@@ -0,0 +1,127 @@
+"""
+Кэш извлечённого текста файлов (учебники, шаблон), ключ — sha256 содержимого.
+
+Два уровня:
+- память процесса (LRU с ограничением по размеру);
+- диск (files/cache/text/<ключ>.txt), чтобы один и тот же учебник разбирался один раз
+  и между запросами, и между процессами (веб-сервер, бот, перезапуски).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from wpd import metrics
+
+TEXT_CACHE_DIR = os.getenv(
+    "TEXT_CACHE_DIR",
+    str(Path(__file__).resolve().parent.parent / "files" / "cache" / "text"),
+)
+TEXT_CACHE_MAX_MEMORY_BYTES = int(os.getenv("TEXT_CACHE_MAX_MEMORY_BYTES", str(64 * 1024 * 1024)))
+TEXT_CACHE_MAX_DISK_BYTES = int(os.getenv("TEXT_CACHE_MAX_DISK_BYTES", str(512 * 1024 * 1024)))
+# Меняйте при изменении логики извлечения текста (read_docx_file и т.п.)
+EXTRACT_VERSION = "1"
+
+_lock = threading.Lock()
+_memory: "OrderedDict[str, str]" = OrderedDict()
+_memory_bytes = 0
+
+
+def make_key(data: bytes, kind: str) -> str:
+    """
+    Ключ кэша: хэш содержимого + способ извлечения (docx/text) + версия извлечения.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{digest}-{kind}-v{EXTRACT_VERSION}"
+
+
+def _remember(key: str, text: str) -> None:
+    global _memory_bytes
+    size = len(text.encode("utf-8"))
+    if size > TEXT_CACHE_MAX_MEMORY_BYTES:
+        return
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return
+        _memory[key] = text
+        _memory_bytes += size
+        while _memory_bytes > TEXT_CACHE_MAX_MEMORY_BYTES and _memory:
+            _old_key, old_text = _memory.popitem(last=False)
+            _memory_bytes -= len(old_text.encode("utf-8"))
+        metrics.set_gauge("text_cache_memory_bytes", _memory_bytes)
+
+
+def get(key: str) -> Optional[str]:
+    """
+    Возвращает текст из памяти или с диска (с подъёмом в память) либо None.
+    """
+    with _lock:
+        text = _memory.get(key)
+        if text is not None:
+            _memory.move_to_end(key)
+    if text is not None:
+        metrics.inc("text_cache_hits_memory")
+        return text
+
+    path = Path(TEXT_CACHE_DIR) / f"{key}.txt"
+    try:
+        text = path.read_text(encoding="utf-8")
+        os.utime(path)  # для вытеснения самых давно использованных файлов
+    except FileNotFoundError:
+        metrics.inc("text_cache_misses")
+        return None
+    except Exception as e:
+        print(f"Не удалось прочитать кэш текста {path}: {e}")
+        metrics.inc("text_cache_misses")
+        return None
+
+    metrics.inc("text_cache_hits_disk")
+    _remember(key, text)
+    return text
+
+
+def put(key: str, text: str) -> None:
+    """
+    Сохраняет текст в память и на диск. Ошибки записи на диск не прерывают обработку.
+    """
+    _remember(key, text)
+
+    cache_dir = Path(TEXT_CACHE_DIR)
+    path = cache_dir / f"{key}.txt"
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # Пишем во временный файл и атомарно переименовываем — параллельные процессы не увидят половину файла
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path)
+        _prune_disk(cache_dir)
+    except Exception as e:
+        print(f"Не удалось сохранить кэш текста {path}: {e}")
+
+
+def _prune_disk(cache_dir: Path) -> None:
+    files = []
+    total = 0
+    for p in cache_dir.glob("*.txt"):
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, p))
+        total += st.st_size
+    if total <= TEXT_CACHE_MAX_DISK_BYTES:
+        return
+    for _mtime, size, p in sorted(files):
+        if total <= TEXT_CACHE_MAX_DISK_BYTES:
+            break
+        try:
+            p.unlink()
+            total -= size
+        except FileNotFoundError:
+            pass
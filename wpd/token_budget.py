@@ -0,0 +1,171 @@
+"""
+Учёт токенов и проверка размера запроса до отправки.
+
+- Перед отправкой размер запроса оценивается и сравнивается с окном контекста модели;
+  слишком большой запрос сокращается (самое длинное сообщение) или отклоняется с понятной ошибкой,
+  а не уходит в Perplexity за ответом 400 или многоминутным ожиданием.
+- Токены запроса и ответа учитываются по каждому вызову и суммируются по заданию
+  (задание — это contextvar: всё, что вызвано внутри одного /upload, в том числе параллельные таблицы,
+  пишет в один счётчик).
+"""
+
+from __future__ import annotations
+
+import contextvars
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+from wpd import metrics
+from wpd.retrieval import estimate_tokens
+
+# Окно контекста моделей Perplexity (токены); PPLX_CONTEXT_TOKENS переопределяет для всех моделей
+MODEL_CONTEXT_TOKENS = {
+    "sonar": 127_000,
+    "sonar-pro": 200_000,
+    "sonar-reasoning": 127_000,
+    "sonar-reasoning-pro": 127_000,
+}
+PPLX_CONTEXT_TOKENS = int(os.getenv("PPLX_CONTEXT_TOKENS", "0"))
+# Сколько токенов оставлять под ответ модели
+PPLX_COMPLETION_RESERVE_TOKENS = int(os.getenv("PPLX_COMPLETION_RESERVE_TOKENS", "8000"))
+# Служебные токены на каждое сообщение (роль, разделители)
+_MESSAGE_OVERHEAD_TOKENS = 4
+_TRIM_MARKER = "\n[... текст сокращён, чтобы запрос поместился в контекст модели ...]\n"
+
+
+def context_window(model: str) -> int:
+    """
+    Окно контекста модели в токенах.
+    """
+    if PPLX_CONTEXT_TOKENS > 0:
+        return PPLX_CONTEXT_TOKENS
+    return MODEL_CONTEXT_TOKENS.get(model, MODEL_CONTEXT_TOKENS["sonar"])
+
+
+def count_message_tokens(messages: list[dict]) -> int:
+    """
+    Оценка числа токенов запроса.
+    """
+    total = 0
+    for m in messages:
+        content = m.get("content")
+        total += _MESSAGE_OVERHEAD_TOKENS + estimate_tokens(content if isinstance(content, str) else str(content or ""))
+    return total
+
+
+def fit_messages(messages: list[dict], model: str, label: str = "") -> list[dict]:
+    """
+    Проверяет, что запрос помещается в окно модели вместе с резервом под ответ.
+
+    Если не помещается — сокращает середину самого длинного сообщения (обычно это материалы),
+    сохраняя начало и конец (заголовок файла и промпт). Исходный список не меняется.
+
+    Raises:
+        ValueError: если запрос не удаётся уложить в окно
+    """
+    limit = context_window(model) - PPLX_COMPLETION_RESERVE_TOKENS
+    prompt_tokens = count_message_tokens(messages)
+    if prompt_tokens <= limit:
+        return messages
+
+    excess = prompt_tokens - limit
+    longest = max(range(len(messages)), key=lambda i: len(str(messages[i].get("content") or "")), default=None)
+    content = str(messages[longest].get("content") or "") if longest is not None else ""
+    # Переводим лишние токены в символы с запасом на маркер сокращения
+    keep_chars = len(content) - (excess + estimate_tokens(_TRIM_MARKER)) * 3
+    if keep_chars < len(content) // 10:
+        raise ValueError(
+            f"Запрос{label} слишком большой для модели {model}: ~{prompt_tokens} токенов "
+            f"при допустимых {limit}. Уменьшите объём материалов."
+        )
+
+    head = keep_chars // 2
+    tail = keep_chars - head
+    trimmed = [dict(m) for m in messages]
+    trimmed[longest]["content"] = content[:head] + _TRIM_MARKER + content[len(content) - tail:]
+    metrics.inc("llm_requests_trimmed")
+    print(f"Запрос{label} сокращён: ~{prompt_tokens} -> ~{count_message_tokens(trimmed)} токенов (лимит {limit})")
+    return trimmed
+
+
+@dataclass
+class JobUsage:
+    """
+    Суммарные токены одного задания.
+    """
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    calls: int = 0
+    cached_calls: int = 0
+    # Суммарное время вызовов модели (параллельные вызовы суммируются)
+    llm_seconds: float = 0.0
+    # True, если хотя бы для одного вызова API не вернул usage и значения оценены
+    estimated: bool = False
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, prompt_tokens: int, completion_tokens: int, *, cached: bool, estimated: bool, seconds: float = 0.0) -> None:
+        with self._lock:
+            self.calls += 1
+            self.llm_seconds += seconds
+            if cached:
+                self.cached_calls += 1
+                return
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.estimated = self.estimated or estimated
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": self.prompt_tokens + self.completion_tokens,
+                "calls": self.calls,
+                "cached_calls": self.cached_calls,
+                "llm_seconds": round(self.llm_seconds, 1),
+                "estimated": self.estimated,
+            }
+
+
+_current_job: contextvars.ContextVar[Optional[JobUsage]] = contextvars.ContextVar("wpd_job_usage", default=None)
+
+
+def start_job() -> JobUsage:
+    """
+    Начинает учёт токенов для текущего задания (текущего контекста и задач, созданных из него).
+    """
+    usage = JobUsage()
+    _current_job.set(usage)
+    return usage
+
+
+def current_job() -> Optional[JobUsage]:
+    return _current_job.get()
+
+
+def record_usage(
+    prompt_tokens: int,
+    completion_tokens: int,
+    *,
+    label: str = "",
+    cached: bool = False,
+    estimated: bool = False,
+    seconds: float = 0.0,
+) -> None:
+    """
+    Учитывает токены одного вызова модели: в логе, в метриках процесса и в текущем задании.
+    """
+    if cached:
+        metrics.inc("llm_calls_cached")
+    else:
+        metrics.inc("llm_prompt_tokens", prompt_tokens)
+        metrics.inc("llm_completion_tokens", completion_tokens)
+        suffix = " (оценка)" if estimated else ""
+        print(f"Токены{label}: запрос {prompt_tokens}, ответ {completion_tokens}{suffix}")
+
+    usage = _current_job.get()
+    if usage is not None:
+        usage.add(prompt_tokens, completion_tokens, cached=cached, estimated=estimated, seconds=seconds)
@@ -0,0 +1,125 @@
+"""
+Приём загруженных .docx без чтения файла целиком в память.
+
+- `UploadSizeLimit` (ASGI middleware) считает байты тела запроса по мере поступления и обрывает
+  загрузку больше UPLOAD_MAX_MB, не дожидаясь её конца; запрос с заведомо большим Content-Length
+  отклоняется сразу.
+- `save_upload` копирует файл на диск частями через асинхронный файловый ввод-вывод, по первой части
+  проверяет сигнатуру zip и считает sha256 по ходу копирования.
+- `check_docx` проверяет, что сохранённый файл — пакет .docx (есть word/document.xml).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import zipfile
+from pathlib import Path
+
+import anyio
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+# Максимальный размер загружаемого файла (мегабайты)
+UPLOAD_MAX_MB = float(os.getenv("UPLOAD_MAX_MB", "50"))
+UPLOAD_MAX_BYTES = int(UPLOAD_MAX_MB * 1024 * 1024)
+# Размер части при копировании загрузки на диск
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Запас на поля формы (JSON переменных и таблиц) и разметку multipart сверх самого файла
+_FORM_OVERHEAD_BYTES = 4 * 1024 * 1024
+
+# .docx — zip-архив: файл начинается с локального заголовка записи zip
+_ZIP_SIGNATURE = b"PK\x03\x04"
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+def _too_large_message() -> str:
+    return f"Файл слишком большой: максимум {UPLOAD_MAX_MB:g} МБ"
+
+
+class UploadSizeLimit:
+    """
+    Ограничивает размер тела POST-запросов к `paths` (UPLOAD_MAX_MB плюс запас на поля формы).
+    """
+
+    def __init__(self, app, paths: tuple[str, ...], max_bytes: int | None = None):
+        self.app = app
+        self.paths = paths
+        self.max_bytes = (UPLOAD_MAX_BYTES if max_bytes is None else max_bytes) + _FORM_OVERHEAD_BYTES
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            # Размер известен заранее — отказываем, не принимая тело
+            response = JSONResponse(status_code=413, content={"detail": _too_large_message()})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Тело без Content-Length (chunked) или с неверным: обрываем разбор формы
+                    raise HTTPException(status_code=413, detail=_too_large_message())
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+async def save_upload(upload, path: Path, max_bytes: int = UPLOAD_MAX_BYTES):
+    """
+    Копирует загруженный файл (`UploadFile`) в `path` частями, не держа его в памяти целиком.
+    Возвращает объект sha256 по содержимому файла (в него можно дописать данные для ключа).
+
+    Raises:
+        UploadTooLarge: если файл больше `max_bytes`
+        ValueError: если файл не zip-архив (не .docx)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with await anyio.open_file(path, "wb") as out:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0 and not chunk.startswith(_ZIP_SIGNATURE):
+                    raise ValueError("Файл не является документом .docx (неверная сигнатура)")
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(_too_large_message())
+                digest.update(chunk)
+                await out.write(chunk)
+        if size == 0:
+            raise ValueError("Загружен пустой файл")
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return digest
+
+
+def check_docx(path: Path) -> None:
+    """
+    Проверяет по оглавлению zip, что файл — пакет .docx (без распаковки содержимого).
+
+    Raises:
+        ValueError: если файл не zip или в нём нет word/document.xml
+    """
+    try:
+        with zipfile.ZipFile(path) as zf:
+            names = set(zf.namelist())
+    except zipfile.BadZipFile:
+        raise ValueError("Файл повреждён или не является документом .docx")
+    if "word/document.xml" not in names or "[Content_Types].xml" not in names:
+        raise ValueError("Файл не является документом .docx (нет word/document.xml)")